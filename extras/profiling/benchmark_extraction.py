@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+#
+# Times the providers' page extractors over extras/sample_provider_pages,
+# to see which parsers dominate backend cpu.
+#
+#   python extras/profiling/benchmark_extraction.py --output before.json
+#   (change something)
+#   python extras/profiling/benchmark_extraction.py --output after.json --compare before.json
+#
+
+import os, sys, time, json, gc, resource, subprocess, logging, argparse
+from multiprocessing import Process, Queue
+
+try:
+    import tracemalloc  # python 3, or the pytracemalloc backport
+except ImportError:
+    tracemalloc = None
+
+from totalimpact.providers.provider import ProviderFactory
+
+logging.disable(logging.CRITICAL)
+
+SAMPLE_PAGES_DIR = os.path.join(os.path.split(__file__)[0], "../sample_provider_pages")
+
+MENDELEY_ALIASES = {"biblio": [{"year": 2011, "authors": "sdf",
+    "title": "Mutations causing syndromic autism define an axis of synaptic pathophysiology"}],
+    "doi": ["10.1038/nature10658"]}
+
+# stands in for the page in a case's kwargs, for methods that don't take it first
+PAGE = "<page>"
+
+WORDPRESSCOM_NID = '{"url": "http://researchremix.wordpress.com", "api_key": "none"}'
+
+# (provider, page, method, kwargs), with the same args the provider unit tests use.
+# Extractors that make http calls of their own, like wordpresscom's metrics, are left out.
+CASES = [
+    ("citeulike", "metrics", "_extract_metrics", {}),
+    ("crossref", "biblio", "_extract_biblio", {}),
+    ("dataone", "aliases", "_extract_aliases", {}),
+    ("delicious", "metrics", "_extract_metrics", {}),
+    ("dryad", "metrics", "_extract_metrics", {}),
+    ("figshare", "members", "_extract_members", {}),
+    ("figshare", "metrics", "_extract_metrics", {"id": "10.6084/m9.figshare.92393"}),
+    ("github", "aliases", "_extract_aliases", {}),
+    ("github", "biblio", "_extract_biblio", {}),
+    ("github", "members", "_extract_members", {"query_string": "egonw"}),
+    ("github", "metrics", "_extract_metrics", {}),
+    ("mendeley", "metrics", "_get_metrics_and_drilldown_from_metrics_page", {}),
+    ("mendeley", "uuidlookup", "_get_uuid_from_title", {"aliases_dict": MENDELEY_ALIASES, "page": PAGE}),
+    ("orcid", "members", "_extract_members", {"query_string": "0000-0003-1613-5981"}),
+    ("orcid", "members2", "_extract_members", {"query_string": "0000-0001-9107-0714"}),
+    ("plosalm", "metrics", "_extract_metrics", {}),
+    ("plossearch", "metrics", "_extract_metrics", {}),
+    ("pmc", "monthly_download", "_extract_metrics", {"id": "222"}),
+    ("pubmed", "aliases_from_doi", "_extract_aliases_from_doi", {"doi": "10.1371/journal.pcbi.1000361"}),
+    ("pubmed", "aliases_from_pmid", "_extract_aliases_from_pmid", {"pmid": "17593900"}),
+    ("pubmed", "biblio", "_extract_biblio", {}),
+    ("pubmed", "metrics", "_extract_citing_pmcids", {}),
+    ("scienceseeker", "metrics", "_extract_metrics", {}),
+    ("scopus", "metrics", "_extract_relevant_record", {"id": "10.1371/journal.pone.0000308"}),
+    ("slideshare", "aliases", "_extract_aliases", {}),
+    ("slideshare", "biblio", "_extract_biblio", {}),
+    ("slideshare", "members", "_extract_members", {"query_string": "cavlec"}),
+    ("slideshare", "metrics", "_extract_metrics", {}),
+    ("topsy", "metrics", "_extract_metrics", {}),
+    ("topsy", "metrics_site", "_extract_metrics", {}),
+    ("vimeo", "biblio", "_extract_biblio", {"id": "http://vimeo.com/48605764"}),
+    ("vimeo", "metrics", "_extract_metrics", {"id": "http://vimeo.com/48605764"}),
+    ("webpage", "biblio", "_extract_biblio", {}),
+    ("wikipedia", "metrics", "_extract_metrics", {}),
+    ("wordpresscom", "biblio", "_extract_biblio", {"nid": WORDPRESSCOM_NID}),
+    ("youtube", "biblio", "_extract_biblio", {"id": "http://www.youtube.com/watch?v=d39DL4ed754"}),
+    ("youtube", "metrics", "_extract_metrics", {}),
+] + [("bibtex", filename, "parse", {})
+        for filename in sorted(os.listdir(os.path.join(SAMPLE_PAGES_DIR, "bibtex")))]
+
+
+def get_call(case):
+    (provider_name, page_name, method_name, kwargs) = case
+    provider = ProviderFactory.get_provider(provider_name)
+    page = open(os.path.join(SAMPLE_PAGES_DIR, provider_name, page_name)).read()
+    method = getattr(provider, method_name)
+    if PAGE in kwargs.values():
+        kwargs = dict([(key, page if value == PAGE else value) for (key, value) in kwargs.items()])
+        return lambda: method(**kwargs)
+    return lambda: method(page, **kwargs)
+
+def max_rss_kb():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def time_call(call, min_time, repeats):
+    """ Best ops/sec over repeats, each running call for at least min_time seconds """
+    number = 1
+    while True:
+        start = time.time()
+        for i in xrange(number):
+            call()
+        elapsed = time.time() - start
+        if elapsed >= min_time / 10.0:
+            break
+        number *= 10
+    number = max(1, int(number * min_time / max(elapsed, 1e-6) / 10))
+
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        for j in xrange(number):
+            call()
+        elapsed = time.time() - start
+        best = min(best, elapsed) if best is not None else elapsed
+    return {"ops_per_sec": number / best, "usec_per_op": best * 1e6 / number, "loops": number}
+
+def measure(case, min_time, repeats):
+    call = get_call(case)
+    rss_before = max_rss_kb()
+    call()  # warm up, and fail early
+
+    result = {}
+    if tracemalloc:
+        tracemalloc.start()
+        call()
+        (current, peak) = tracemalloc.get_traced_memory()
+        result["allocated_blocks"] = sum([stat.count for stat in tracemalloc.take_snapshot().statistics("filename")])
+        result["allocated_kb"] = peak / 1024.0
+        tracemalloc.stop()
+    else:
+        # no allocation tracer in python 2, so count the container objects one call leaves behind
+        gc.collect()
+        objects_before = len(gc.get_objects())
+        call()
+        gc.collect()
+        result["retained_objects"] = len(gc.get_objects()) - objects_before
+
+    gc.collect()
+    result.update(time_call(call, min_time, repeats))
+    result["peak_memory_kb"] = max_rss_kb() - rss_before
+    return result
+
+def measure_in_child(case, min_time, repeats, results_queue):
+    # each case in a fresh process, so peak memory is its own
+    try:
+        results_queue.put(measure(case, min_time, repeats))
+    except Exception, e:
+        results_queue.put({"error": repr(e)})
+
+def run(cases, min_time, repeats):
+    results = {}
+    for case in cases:
+        key = "{provider}.{method}:{page}".format(provider=case[0], method=case[2], page=case[1])
+        results_queue = Queue()
+        child = Process(target=measure_in_child, args=(case, min_time, repeats, results_queue))
+        child.start()
+        results[key] = results_queue.get()
+        child.join()
+        results[key]["provider"] = case[0]
+        results[key]["method"] = case[2]
+        print_result(key, results[key])
+    return results
+
+def print_result(key, result):
+    if "error" in result:
+        print "{key:<70} ERROR {error}".format(key=key, error=result["error"])
+    else:
+        print "{key:<70} {ops:>10.1f} ops/s {usec:>10.1f} us/op {peak:>8} kb peak".format(
+            key=key, ops=result["ops_per_sec"], usec=result["usec_per_op"], peak=result["peak_memory_kb"])
+
+def compare(results, baseline):
+    print "\ncompared to baseline ops/s:"
+    for key in sorted(results):
+        if key not in baseline or "ops_per_sec" not in results[key] or "ops_per_sec" not in baseline[key]:
+            continue
+        change = results[key]["ops_per_sec"] / baseline[key]["ops_per_sec"] - 1
+        print "{key:<70} {change:>+8.1%}".format(key=key, change=change)
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the provider extractors over the sample provider pages.")
+    parser.add_argument('--provider', action="append", help="Only this provider; can be repeated.")
+    parser.add_argument('--min_time', default=1.0, type=float, help="Seconds to run each repeat for.")
+    parser.add_argument('--repeats', default=3, type=int, help="Repeats per case; the best one is reported.")
+    parser.add_argument('--output', default="extraction_benchmark.json", help="JSON file to save results to.")
+    parser.add_argument('--compare', help="Earlier results JSON file to compare against.")
+    args = vars(parser.parse_args())
+
+    cases = [case for case in CASES if not args["provider"] or case[0] in args["provider"]]
+    results = run(cases, args["min_time"], args["repeats"])
+
+    output = {
+        "commit": git_commit(),
+        "run_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "results": results
+    }
+    with open(args["output"], "w") as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+    print "saved to", args["output"]
+
+    if args["compare"]:
+        compare(results, json.load(open(args["compare"]))["results"])
@@ -1,5 +1,8 @@
 import config
 config.set_env_vars_from_dot_env()
 
-from totalimpact import backend
-backend.main()
\ No newline at end of file
+import os, runpy
+
+# runs the backend's __main__ block, so BACKEND_ENGINE=gevent patches before anything else is imported
+runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), "totalimpact", "backend.py"), 
+    run_name="__main__")
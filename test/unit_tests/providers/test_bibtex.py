@@ -1,6 +1,7 @@
 from test.unit_tests.providers import common
 from test.unit_tests.providers.common import ProviderTestCase
 from totalimpact.providers.provider import Provider, ProviderContentMalformedError, ProviderServerError
+from totalimpact.providers import bibtex
 
 
 import os, json
@@ -91,6 +92,16 @@ class TestBibtex(ProviderTestCase):
         expected = [{'title': u'Luftutsl\xe4pp av organiska milj\xf6gifter fr\xe5n ljusb\xe5gsugnar: F\xf6rekomst och m\xf6jliga \xe5tg\xe4rder f\xf6r att minska milj\xf6p\xe5verkan', 'first_author': u'\xd6berg', 'journal': '', 'year': '2003', 'number': '', 'volume': '', 'first_page': '', 'authors': u'\xd6berg'}]
         assert_equals(response, expected)
 
+    def test_to_unicode(self):
+        response = self.provider._to_unicode(r"Milj{\"o} {\aa}tg{\"a}rder {unknown} and {no} braces")
+        assert_equals(response, u"Milj\xf6 \xe5tg\xe4rder {unknown} and {no} braces")
+
+    def test_to_unicode_table_shared_by_instances(self):
+        self.provider._to_unicode("{\\aa}")
+        table = bibtex.get_bibtex_to_unicode()
+        bibtex.Bibtex()._to_unicode("{\\aa}")
+        assert bibtex.get_bibtex_to_unicode() is table
+
     def test_parse_long(self):
         file_contents = SAMPLE_EXTRACT_MEMBER_ITEMS_CONTENTS
         response = self.provider.parse(file_contents)
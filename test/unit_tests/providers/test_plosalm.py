@@ -4,6 +4,7 @@ from totalimpact.providers.provider import Provider, ProviderContentMalformedErr
 from test.utils import http
 
 import os
+import json
 import collections
 from nose.tools import assert_equals, raises, nottest
 
@@ -40,6 +41,39 @@ class TestPlosalm(ProviderTestCase):
         expected = {'plosalm:pdf_views': 952, 'plosalm:html_views': 13642}
         assert_equals(metrics_dict, expected)
 
+    def get_batch_page(self):
+        f = open(SAMPLE_EXTRACT_METRICS_PAGE, "r")
+        first_article = json.loads(f.read())[0]
+        second_article = json.loads(json.dumps(first_article))
+        second_article["doi"] = "10.1371/journal.pone.0000001"
+        second_article["sources"][0]["metrics"]["html"] = 7
+        return json.dumps([first_article, second_article])
+
+    def test_extract_metrics_batch_success(self):
+        ids = ["10.1371/journal.pone.0000001", "10.1371/JOURNAL.PONE.0036240", "10.1371/journal.pone.0000002"]
+        metrics_dict = self.provider._extract_metrics_batch(self.get_batch_page(), ids=ids)
+        expected = {
+            "10.1371/journal.pone.0000001": {'plosalm:pdf_views': 952, 'plosalm:html_views': 7},
+            "10.1371/JOURNAL.PONE.0036240": {'plosalm:pdf_views': 952, 'plosalm:html_views': 13642}
+            }
+        assert_equals(metrics_dict, expected)
+
+    def test_metrics_batch_makes_one_call(self):
+        urls = []
+        batch_page = self.get_batch_page()
+        def get_batch(self, url, headers=None, timeout=None, cache_enabled=True, allow_redirects=False):
+            urls.append(url)
+            return common.DummyResponse(200, batch_page)
+        Provider.http_get = get_batch
+
+        list_of_aliases = [[("doi", "10.1371/journal.pone.0036240")], [("url", "http://example.com")], [("doi", "10.1371/journal.pone.0000001")]]
+        response = self.provider.metrics_batch(list_of_aliases)
+        assert_equals(len(urls), 1)
+        assert "ids=10.1371/journal.pone.0036240,10.1371/journal.pone.0000001&" in urls[0], urls[0]
+        assert_equals(response[0]['plosalm:html_views'], (13642, "http://dx.doi.org/10.1371/journal.pone.0036240"))
+        assert_equals(response[1], {})
+        assert_equals(response[2]['plosalm:html_views'], (7, "http://dx.doi.org/10.1371/journal.pone.0000001"))
+
     @http
     def test_metrics(self):
         metrics_dict = self.provider.metrics([self.testitem_metrics])
@@ -1,10 +1,12 @@
 from totalimpact.providers import provider
 from totalimpact.providers.provider import Provider, ProviderFactory
+from totalimpact import cache
 from nose.tools import assert_equals, nottest
 from xml.dom import minidom 
 
 import simplejson, BeautifulSoup
-import os
+import os, time, threading, BaseHTTPServer, SocketServer
+from contextlib import contextmanager
 
 sampledir = os.path.join(os.path.split(__file__)[0], "../../../extras/sample_provider_pages/")
 
@@ -29,6 +31,11 @@ class Test_Provider():
         provider_names = [provider.__class__.__name__ for provider in providers]
         assert_equals(set(provider_names), set(['Mendeley', 'Wikipedia', "Pubmed"]))
 
+    def test_get_providers_sets_workers_from_config(self):
+        providers = ProviderFactory.get_providers(self.TEST_PROVIDER_CONFIG)
+        workers = dict([(provider.provider_name, provider.max_simultaneous_requests) for provider in providers])
+        assert_equals(workers, {"pubmed": 1, "wikipedia": 3, "mendeley": 3})
+
     def test_get_providers_filters_by_metrics(self):
         # since all the providers do metrics, "metrics" arg changes nought.
         providers = ProviderFactory.get_providers(self.TEST_PROVIDER_CONFIG, "metrics")
@@ -60,6 +67,16 @@ class Test_Provider():
         response = provider._extract_from_json(page, dict_of_keylists)
         assert_equals(response, {'description': u'Git-based ToDo tool.', 'title': u'gtd'})
     
+    def test_json_extractor(self):
+        extractor = provider.JsonExtractor({
+            'title' : ['repository', 'name'],
+            'missing' : ['repository', 'name', 'nope'],
+            'forks' : ['repository', 'forks']})
+        response = extractor.extract(self.TEST_JSON)
+        assert_equals(response, {'title': u'gtd'})  # zero and missing values are left out
+        response = extractor.extract_from_data({"repository": {"name": "cdk", "forks": 3}})
+        assert_equals(response, {'title': 'cdk', 'forks': 3})
+
     def test_lookup_xml_from_dom(self):
         page = self.TEST_XML
         doc = minidom.parseString(page.strip())
@@ -80,6 +97,74 @@ class Test_Provider():
         response = provider._extract_from_xml(page, dict_of_keylists)
         assert_equals(response, {'count': 17})
 
+    def test_lookup_xml_from_tree(self):
+        tree = provider._get_tree_from_xml(self.TEST_XML)
+        response = provider._lookup_xml_from_tree(tree, ['total_count'])
+        assert_equals(response, 17)
+
+    def test_lookup_xml_from_tree_takes_first_match_at_each_step(self):
+        page = """<a><b><c>one</c></b><b><c>two</c><d>three</d></b><dc:e xmlns:dc="http://purl.org/dc/">four</dc:e></a>"""
+        tree = provider._get_tree_from_xml(page)
+        assert_equals(provider._lookup_xml_from_tree(tree, ['a', 'b', 'c']), "one")
+        assert_equals(provider._lookup_xml_from_tree(tree, ['a', 'b', 'd']), None)  # only the first b is searched, like minidom
+        assert_equals(provider._lookup_xml_from_tree(tree, ['a', 'd']), "three")
+        assert_equals(provider._lookup_xml_from_tree(tree, ['dc:e']), "four")
+
+    def test_find_all_in_xml_tree_within_first_match(self):
+        page = """<a><b><c>one</c><c>two</c></b><b><c>three</c></b></a>"""
+        tree = provider._get_tree_from_xml(page)
+        assert_equals([c.text for c in provider._find_all_in_xml_tree(tree, 'c')], ["one", "two", "three"])
+        assert_equals([c.text for c in provider._find_all_in_xml_tree(tree, 'c', within=['b'])], ["one", "two"])
+
+    def test_compiled_xml_paths_are_per_thread(self):
+        compiled = provider._compile_xml_path(["a", "b"])
+        assert compiled is provider._compile_xml_path(["a", "b"])
+        other_thread_compiled = []
+        thread = threading.Thread(target=lambda: other_thread_compiled.append(provider._compile_xml_path(["a", "b"])))
+        thread.start()
+        thread.join()
+        assert other_thread_compiled[0] is not compiled
+
+    def test_extract_xml_falls_back_when_malformed(self):
+        page = "<a><b>17</b><c>unclosed</a>"
+        response = provider._extract_from_xml(page, {'count' : ['b']})
+        assert_equals(response, {'count': 17})
+
+    def test_count_in_xml(self):
+        page = "<posts><post>1</post><post>2</post><other/><post>3</post></posts>"
+        assert_equals(provider._count_in_xml(page, 'post'), 3)
+        assert_equals(provider._count_in_xml("not xml", 'post'), 0)
+
+    def test_get_page_from_cache_skips_404s_unless_asked(self):
+        class FakeCache(object):
+            def get_cache_entry(self, key):
+                return {"status_code": 404, "url": key["url"], "text": "not found"}
+            def is_fresh(self, entry):
+                return True
+
+        response = provider.get_page_from_cache("http://example.com", {}, True, FakeCache())
+        assert_equals(response, None)
+        response = provider.get_page_from_cache("http://example.com", {}, True, FakeCache(), cache_not_found=True)
+        assert_equals(response.status_code, 404)
+
+    def test_parse_retry_after(self):
+        assert_equals(provider._parse_retry_after("120"), 120)
+        assert_equals(provider._parse_retry_after(None), None)
+        assert_equals(provider._parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0)  # already past
+        assert_equals(provider._parse_retry_after("soon"), None)
+
+    def test_get_error_for_rate_limited_response(self):
+        class FakeResponse(object):
+            url = "http://example.com"
+            text = "slow down"
+            headers = {"Retry-After": "10"}
+        try:
+            Provider()._get_error(429, FakeResponse())
+        except provider.ProviderRateLimitError:
+            pass
+        else:
+            assert False, "should have raised ProviderRateLimitError"
+
     def test_doi_from_url_string(self):
         test_url = "https://knb.ecoinformatics.org/knb/d1/mn/v1/object/doi:10.5063%2FAA%2Fnrs.373.1"
         expected = "10.5063/AA/nrs.373.1"
@@ -109,3 +194,182 @@ class TestProviderFactory():
         print md["pubmed"]
         assert_equals(md["pubmed"]['url'], 'http://pubmed.gov')
 
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    statuses_sent = []
+    unavailable_responses = 0  # send this many 503s first
+    retry_after = "0"
+    delay = 0  # seconds before each response
+    in_flight = []  # one entry per request being answered
+    most_in_flight = 0
+
+    def do_GET(self):
+        KeepAliveHandler.in_flight.append(self.path)
+        KeepAliveHandler.most_in_flight = max(KeepAliveHandler.most_in_flight, len(KeepAliveHandler.in_flight))
+        time.sleep(self.delay)
+        KeepAliveHandler.in_flight.pop()
+        # recorded before replying, so the client never sees a reply that isn't counted yet
+        if KeepAliveHandler.unavailable_responses:
+            KeepAliveHandler.unavailable_responses -= 1
+            self.statuses_sent.append(503)
+            self.send_response(503)
+            self.send_header("Retry-After", self.retry_after)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.statuses_sent.append(304)
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = "hello"
+        self.statuses_sent.append(200)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class KeepAliveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # a thread per connection, so an idle kept-alive connection doesn't block shutdown
+    daemon_threads = True
+
+class TestHttpSession():
+
+    def setUp(self):
+        self.server = KeepAliveServer(("localhost", 0), KeepAliveHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.url = "http://localhost:{port}/".format(port=self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        provider._http_sessions.clear()
+        cache._local_cache.clear()
+        provider._update_memo.clear()
+        KeepAliveHandler.statuses_sent = []
+        KeepAliveHandler.unavailable_responses = 0
+        KeepAliveHandler.retry_after = "0"
+        KeepAliveHandler.delay = 0
+        KeepAliveHandler.most_in_flight = 0
+        provider._host_slots.clear()
+
+    def test_session_shared_by_provider_instances(self):
+        first = ProviderFactory.get_provider("wikipedia")
+        second = ProviderFactory.get_provider("wikipedia")
+        assert first.http_session() is second.http_session()
+        assert first.http_session() is not ProviderFactory.get_provider("pubmed").http_session()
+
+    def test_http_get_reuses_connection(self):
+        wikipedia = ProviderFactory.get_provider("wikipedia")
+        for i in range(3):
+            response = wikipedia.http_get(self.url, cache_enabled=False)
+            assert_equals(response.text, "hello")
+        stats = provider.get_http_session_stats("wikipedia")
+        expected = {"num_requests": 3, "num_connections": 1, "num_reused": 2}
+        assert_equals(stats.values(), [expected])
+
+    def test_http_get_shares_responses_within_an_update(self):
+        wikipedia = ProviderFactory.get_provider("wikipedia")
+        with provider.update_scope("update1"):
+            wikipedia.http_get(self.url, cache_enabled=False)
+            response = wikipedia.http_get(self.url, cache_enabled=False)
+        assert_equals(response.text, "hello")
+        assert_equals(len(KeepAliveHandler.statuses_sent), 1)
+        # only what providers read is kept, not the whole response
+        assert isinstance(response, provider.MemoizedResponse)
+        assert_equals(response.status_code, 200)
+        assert_equals(response.headers["etag"], '"v1"')
+
+        # a later update run of the same item fetches again
+        with provider.update_scope("update2"):
+            wikipedia.http_get(self.url, cache_enabled=False)
+        wikipedia.http_get(self.url, cache_enabled=False)
+        assert_equals(len(KeepAliveHandler.statuses_sent), 3)
+
+    def test_http_get_retries_unavailable(self):
+        KeepAliveHandler.unavailable_responses = 2
+        wikipedia = ProviderFactory.get_provider("wikipedia")
+        response = wikipedia.http_get(self.url, cache_enabled=False)
+        assert_equals(response.status_code, 200)
+        assert_equals(KeepAliveHandler.statuses_sent, [503, 503, 200])
+
+    def test_http_get_times_each_get_but_not_the_wait_between(self):
+        KeepAliveHandler.unavailable_responses = 1
+        KeepAliveHandler.retry_after = "1"
+        wikipedia = ProviderFactory.get_provider("wikipedia")
+        get_latencies = []
+        with provider.update_scope(None, get_latencies=get_latencies):
+            response = wikipedia.http_get(self.url, cache_enabled=False)
+        assert_equals(response.status_code, 200)
+        assert_equals(len(get_latencies), 2)
+        assert max(get_latencies) < 0.5, get_latencies
+
+    def test_http_get_gives_up_when_retry_after_passes_deadline(self):
+        KeepAliveHandler.unavailable_responses = 1
+        KeepAliveHandler.retry_after = "100"
+        wikipedia = ProviderFactory.get_provider("wikipedia")
+        wikipedia.item_deadline = 5
+        response = wikipedia.http_get(self.url, cache_enabled=False)
+        assert_equals(response.status_code, 503)
+        assert_equals(KeepAliveHandler.statuses_sent, [503])
+
+    def test_http_get_multiple(self):
+        wikipedia = ProviderFactory.get_provider("wikipedia")
+        urls = [self.url + "a", self.url + "b", self.url + "a"]
+        responses = wikipedia.http_get_multiple(urls, cache_enabled=False)
+        assert_equals(sorted(responses.keys()), sorted(set(urls)))
+        assert_equals([response.text for response in responses.values()], ["hello", "hello"])
+        assert_equals(len(KeepAliveHandler.statuses_sent), 2)
+
+        assert_equals(wikipedia.http_get_multiple([]), {})
+
+    def test_http_get_multiple_caps_requests_per_host(self):
+        KeepAliveHandler.delay = 0.2
+        wikipedia = ProviderFactory.get_provider("wikipedia")
+        wikipedia.max_requests_per_host = 2
+        urls = [self.url + str(i) for i in range(5)]
+        responses = wikipedia.http_get_multiple(urls, cache_enabled=False)
+        assert_equals(len(responses), 5)
+        assert_equals(KeepAliveHandler.most_in_flight, 2)
+
+    def test_http_get_revalidates_expired_pages(self):
+        memcached = {}
+        class FakeMemcached(object):
+            def get(self, key):
+                return memcached.get(key)
+            def set(self, key, value, time=0):
+                memcached[key] = value
+                return True
+        class DictCache(cache.Cache):
+            _get_memcached_client = contextmanager(lambda self: (yield FakeMemcached()))
+
+        wikipedia = ProviderFactory.get_provider("wikipedia")
+        wikipedia.max_cache_duration = 0  # so every cached page has expired
+        original_cache = provider.Cache
+        provider.Cache = DictCache
+        stats_before = cache.get_cache_stats()["memcached"]
+        try:
+            first = wikipedia.http_get(self.url)
+            cache._local_cache.clear()
+            second = wikipedia.http_get(self.url)
+        finally:
+            provider.Cache = original_cache
+        assert_equals(first.text, "hello")
+        assert_equals(second.text, "hello")
+        assert_equals(second.status_code, 200)
+        assert_equals(KeepAliveHandler.statuses_sent, [200, 304])
+
+        # the 304 is served from the cache, so it is a hit as well as a revalidation
+        stats_after = cache.get_cache_stats()["memcached"]
+        assert_equals(dict((stat, stats_after[stat] - stats_before[stat]) for stat in stats_after),
+            {"hits": 1, "misses": 1, "revalidated": 1})
@@ -1,5 +1,6 @@
 from test.unit_tests.providers import common
 from test.unit_tests.providers.common import ProviderTestCase
+from totalimpact.providers import provider
 from totalimpact.providers.provider import Provider, ProviderContentMalformedError
 from test.utils import http
 
@@ -42,6 +43,29 @@ class TestTopsy(ProviderTestCase):
         assert_equals(metrics_dict, expected)
 
 
+    def test_metrics_probes_aliases_once(self):
+        page = open(SAMPLE_EXTRACT_METRICS_PAGE, "r").read()
+        class FakeResponse(object):
+            status_code = 200
+            def __init__(self, url):
+                self.text = page
+                if "second" in url:
+                    self.text = page.replace("282", "300")
+        calls = []
+        def fake_http_get(url, **kwargs):
+            calls.append(url)
+            return FakeResponse(url)
+        self.provider.http_get = fake_http_get
+
+        aliases = [("url", "http://first.org"), ("url", "http://second.org"), ("url", "http://third.org")]
+        with provider.update_scope("abcd"):
+            metrics_dict = self.provider.metrics(aliases)
+        provider._alias_probes.clear()
+        expected_drilldown = 'http://topsy.com/trackback?url=http%3A//second.org&window=a'
+        assert_equals(metrics_dict["topsy:tweets"], (300, expected_drilldown))
+        assert_equals(metrics_dict["topsy:influential_tweets"], (26, expected_drilldown))
+        assert_equals(len(calls), 3)
+
     def test_provenance_url(self):
         provenance_url = self.provider.provenance_url("tweets", 
             [self.testitem_aliases])
@@ -33,6 +33,13 @@ class TestYoutube(ProviderTestCase):
         print metrics_dict
         assert_equals(metrics_dict["youtube:views"], 113)
 
+    def test_extract_metrics_batch_success(self):
+        f = open(SAMPLE_EXTRACT_METRICS_PAGE, "r")
+        ids = ["http://www.youtube.com/watch?v=d39DL4ed754", "http://www.youtube.com/watch?v=notreturned"]
+        metrics_dict = self.provider._extract_metrics_batch(f.read(), ids=ids)
+        assert_equals(metrics_dict.keys(), ["http://www.youtube.com/watch?v=d39DL4ed754"])
+        assert_equals(metrics_dict["http://www.youtube.com/watch?v=d39DL4ed754"]["youtube:views"], 113)
+
     def test_extract_biblio_success(self):
         f = open(SAMPLE_EXTRACT_BIBLIO_PAGE, "r")
         biblio_dict = self.provider._extract_biblio(f.read(), self.testitem_biblio[1])
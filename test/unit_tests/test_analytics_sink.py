@@ -0,0 +1,120 @@
+import time
+import datetime
+from nose.tools import assert_equals
+from analytics import client as analytics_client
+
+from totalimpact.analytics_sink import AnalyticsSink, make_client
+
+
+class FakeSegment(object):
+    # stands in for analytics.client.request, so the real client batches and counts
+    def __init__(self):
+        self.batches = []
+        self.fail = False
+
+    def request(self, client, url, data):
+        self.batches.append(data["batch"])
+        if self.fail:
+            client._on_failed_flush(data, Exception("segment.io is down"))
+            return False
+        client._on_successful_flush(data, None)
+        return True
+
+    def events(self):
+        return sorted([(action["userId"], action["event"], action["properties"])
+            for batch in self.batches for action in batch])
+
+
+class TestAnalyticsSink():
+
+    def setUp(self):
+        self.segment = FakeSegment()
+        self.old_request = analytics_client.request
+        analytics_client.request = self.segment.request
+        self.client = make_client(10)
+        self.client.secret = "secret"
+
+    def tearDown(self):
+        analytics_client.request = self.old_request
+
+    def wait_for(self, sink, stat, number):
+        for i in range(100):
+            if sink.stats()[stat] >= number:
+                return
+            time.sleep(0.01)
+
+    def test_sends_in_batches_from_background(self):
+        sink = AnalyticsSink(max_queue_size=10, batch_size=2, flush_interval=0.05, sample_rates={}, client=self.client)
+        for i in range(3):
+            assert_equals(sink.track("CORE", "event", {"i": i}), True)
+        self.wait_for(sink, "sent", 3)
+        assert_equals(self.segment.events(), [("CORE", "event", {"i": i}) for i in range(3)])
+        assert_equals([len(batch) for batch in self.segment.batches], [2, 1])
+
+    def test_one_request_per_batch(self):
+        sink = AnalyticsSink(max_queue_size=100, batch_size=10, flush_interval=60, sample_rates={}, client=self.client)
+        sink._ensure_sender = lambda: None
+        for i in range(25):
+            sink.track("CORE", "event", {"i": i})
+        sink.flush()
+        assert_equals([len(batch) for batch in self.segment.batches], [10, 10, 5])
+        assert_equals(sink.stats()["sent"], 25)
+
+    def test_batch_is_no_bigger_than_client_posts(self):
+        sink = AnalyticsSink(max_queue_size=100, batch_size=100, flush_interval=60, sample_rates={}, client=self.client)
+        assert_equals(sink.batch_size, 50)
+
+    def test_drops_when_queue_is_full(self):
+        sink = AnalyticsSink(max_queue_size=2, batch_size=10, flush_interval=60, sample_rates={}, client=self.client)
+        sink._ensure_sender = lambda: None  # so nothing takes events off the queue
+        results = [sink.track("CORE", "event") for i in range(3)]
+        assert_equals(results, [True, True, False])
+        assert_equals(sink.stats()["dropped"], 1)
+
+        sink.flush()
+        assert_equals(len(self.segment.events()), 2)
+        assert_equals(sink.stats()["waiting"], 0)
+
+    def test_samples_by_event_name(self):
+        sink = AnalyticsSink(max_queue_size=10, batch_size=10, flush_interval=60,
+            sample_rates={"noisy": 0, "mostly": 0.999999}, client=self.client)
+        sink._ensure_sender = lambda: None
+        assert_equals(sink.track("CORE", "noisy"), False)
+        assert_equals(sink.stats()["sampled_out"], 1)
+
+        sink.track("CORE", "mostly", {"url": "x"})
+        sink.track("CORE", "other")
+        sink.flush()
+        assert_equals(self.segment.events(), [("CORE", "mostly", {"url": "x", "sample_rate": 0.999999}), ("CORE", "other", {})])
+
+    def test_refused_batch_is_counted_as_failed(self):
+        self.segment.fail = True
+        sink = AnalyticsSink(max_queue_size=10, batch_size=10, flush_interval=60, sample_rates={}, client=self.client)
+        sink._ensure_sender = lambda: None
+        sink.track("CORE", "event")
+        sink.track("CORE", "event")
+        sink.flush()
+        assert_equals(sink.stats()["failed"], 2)
+        assert_equals(sink.stats()["sent"], 0)
+
+    def test_failed_send_is_counted_not_raised(self):
+        self.client.secret = None  # so the client's track raises
+        sink = AnalyticsSink(max_queue_size=10, batch_size=10, flush_interval=60, sample_rates={}, client=self.client)
+        sink._ensure_sender = lambda: None
+        sink.track("CORE", "event")
+        sink.flush()
+        assert_equals(sink.stats()["failed"], 1)
+        assert_equals(self.segment.batches, [])
+
+    def test_sends_time_the_event_was_tracked(self):
+        sink = AnalyticsSink(max_queue_size=10, batch_size=10, flush_interval=60, sample_rates={}, client=self.client)
+        sink._ensure_sender = lambda: None
+        sink.track("CORE", "event")
+        tracked_at = datetime.datetime.utcnow()
+        time.sleep(0.05)
+        sink.flush()
+
+        [[action]] = self.segment.batches
+        # when it was queued, not when it was sent, and with a timezone
+        timestamp = datetime.datetime.strptime(action["timestamp"], "%Y-%m-%dT%H:%M:%S.%f+00:00")
+        assert abs(timestamp - tracked_at) < datetime.timedelta(seconds=0.05)
@@ -1,10 +1,13 @@
-import json, os, Queue, datetime
+import json, os, Queue, datetime, threading, time
 
 from totalimpact import tiredis, backend, default_settings
 from totalimpact import db, app
 from totalimpact import item as item_module
-from totalimpact.providers.provider import Provider, ProviderTimeout, ProviderFactory
-from nose.tools import raises, assert_equals, nottest
+from totalimpact.providers import provider
+from totalimpact.providers.provider import Provider, ProviderTimeout, ProviderFactory, ProviderItemNotFoundError
+from totalimpact.providers.provider import ProviderRateLimitError, ProviderThrottledError
+from sqlalchemy.exc import OperationalError
+from nose.tools import raises, assert_equals, assert_raises, nottest
 from test.utils import slow
 from test import mocks
 
@@ -52,6 +55,8 @@ class TestBackend():
 
     def teardown(self):
         self.r.flushdb()
+        backend.concurrency_limits.clear()
+        backend.circuit_breakers.clear()
 
         teardown_postgres_for_unittests(self.db)
 
@@ -62,7 +67,7 @@ class TestProviderWorker(TestBackend):
     def test_add_to_couch_queue_if_nonzero(self):    
         test_couch_queue = backend.PythonQueue("test_couch_queue")
         provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
-                                        None, None, None, {"a": test_couch_queue}, None, self.r)  
+                                        None, None, {"a": test_couch_queue}, None, self.r)  
         response = provider_worker.add_to_couch_queue_if_nonzero("aaatiid", #start fake tiid with "a" so in first couch queue
                 {"doi":["10.5061/dryad.3td2f"]}, 
                 "aliases", 
@@ -76,7 +81,7 @@ class TestProviderWorker(TestBackend):
     def test_add_to_couch_queue_if_nonzero_given_metrics(self):    
         test_couch_queue = backend.PythonQueue("test_couch_queue")
         provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
-                                        None, None, None, {"a": test_couch_queue}, None, self.r)  
+                                        None, None, {"a": test_couch_queue}, None, self.r)  
         metrics_method_response = {'dryad:package_views': (361, 'http://dx.doi.org/10.5061/dryad.7898'), 
                     'dryad:total_downloads': (176, 'http://dx.doi.org/10.5061/dryad.7898'), 
                     'dryad:most_downloaded_file': (65, 'http://dx.doi.org/10.5061/dryad.7898')}        
@@ -98,7 +103,7 @@ class TestProviderWorker(TestBackend):
     def test_add_to_couch_queue_if_nonzero_given_empty_metrics_response(self):    
         test_couch_queue = backend.PythonQueue("test_couch_queue")
         provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
-                                        None, None, None, {"a": test_couch_queue}, None, self.r)  
+                                        None, None, {"a": test_couch_queue}, None, self.r)  
         metrics_method_response = {}
         response = provider_worker.add_to_couch_queue_if_nonzero("aaatiid", #start fake tiid with "a" so in first couch queue
                 metrics_method_response,
@@ -115,7 +120,7 @@ class TestProviderWorker(TestBackend):
         assert_equals(response, -1)
 
     def test_wrapper(self):     
-        def fake_callback(tiid, new_content, method_name, aliases_providers_run):
+        def fake_callback(tiid, new_content, method_name, aliases_providers_run, update_id):
             pass
 
         response = backend.ProviderWorker.wrapper("123", 
@@ -128,6 +133,209 @@ class TestProviderWorker(TestBackend):
         expected = {'url': ['http://somewhere'], 'doi': ['10.1', '10.123']}
         assert_equals(response, expected)
 
+    def test_run_passes_update_id_on_to_alias_queue(self):
+        test_alias_queue = backend.PythonQueue("test_alias_queue")
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
+                                        test_alias_queue, test_provider_queue, {"a": test_couch_queue}, 
+                                        backend.ProviderWorker.wrapper, self.r)  
+        test_provider_queue.push(("aaatiid", {"doi":["10.123"]}, "aliases", [], "update1"))
+        provider_worker.run()
+
+        (tiid, alias_dict, aliases_providers_run, update_id) = test_alias_queue.pop()
+        assert_equals(aliases_providers_run, ["myfakeprovider"])
+        assert_equals(update_id, "update1")
+
+    def test_run_calls_wrapper_in_worker_thread(self):
+        calls = []
+        def fake_wrapper(tiid, alias_dict, provider, method_name, aliases_providers_run, callback, update_id):
+            calls.append((tiid, method_name, threading.current_thread().name))
+
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
+                                        None, test_provider_queue, {}, fake_wrapper, self.r)  
+        test_provider_queue.push(("aaatiid", {"doi":["10.1"]}, "biblio", [], "update1"))
+        provider_worker.run()
+
+        expected = [("aaatiid", "biblio", threading.current_thread().name)]
+        assert_equals(calls, expected)
+
+    def test_run_serves_message_queued_before_update_ids(self):
+        calls = []
+        def fake_wrapper(tiid, alias_dict, provider, method_name, aliases_providers_run, callback, update_id):
+            calls.append((tiid, method_name, update_id))
+
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
+                                        None, test_provider_queue, {}, fake_wrapper, self.r)  
+        test_provider_queue.push(["aaatiid", {"doi":["10.1"]}, "biblio", []])
+        provider_worker.run()
+
+        assert_equals(calls, [("aaatiid", "biblio", None)])
+        assert_equals(test_provider_queue.queue.qsize(), 0)
+
+    def test_run_nothing_in_queue(self):
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
+                                        None, test_provider_queue, {}, None, self.r)  
+        response = provider_worker.run()
+        assert_equals(response, None)
+
+    def test_run_batches_metrics_messages(self):
+        batches = []
+        def fake_batch_wrapper(provider_messages, provider, callback):
+            batches.append([provider_message[0] for provider_message in provider_messages])
+
+        fake_provider = mocks.ProviderMock("myfakeprovider")
+        fake_provider._extract_metrics_batch = lambda page, status_code=200, ids=[]: {}
+        fake_provider.max_batch_size = 3
+        fake_provider.batch_window = 0
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.ProviderWorker(fake_provider, 
+                                        None, test_provider_queue, {}, None, self.r)  
+        provider_worker.batch_wrapper = fake_batch_wrapper
+        for tiid in ["aaa", "bbb", "ccc", "ddd"]:
+            test_provider_queue.push((tiid, {"doi":["10.1"]}, "metrics", [], "update1"))
+        provider_worker.run()
+        provider_worker.run()
+        assert_equals(batches, [["aaa", "bbb", "ccc"], ["ddd"]])
+
+    def test_batch_wrapper(self):
+        callbacks = []
+        def fake_callback(tiid, new_content, method_name, aliases_providers_run, update_id):
+            callbacks.append((tiid, new_content, method_name))
+
+        provider_messages = [("aaa", {"doi":["10.1"]}, "metrics", [], "update1"), ("bbb", {"doi":["10.2"]}, "metrics", [], "update1")]
+        response = backend.ProviderWorker.batch_wrapper(provider_messages, mocks.ProviderMock("myfakeprovider"), fake_callback)
+        assert_equals(len(response), 2)
+        assert_equals([callback[0] for callback in callbacks], ["aaa", "bbb"])
+        assert_equals(callbacks[0][1], response[0])
+
+    def test_run_keeps_lane(self):
+        test_provider_queue = backend.LanedQueue("test_provider_queue", {
+            "interactive": backend.PythonQueue("test_provider_queue", "interactive"),
+            "bulk": backend.PythonQueue("test_provider_queue:bulk", "bulk")})
+        test_couch_queue = backend.LanedQueue("test_couch_queue", {
+            "interactive": backend.PythonQueue("test_couch_queue", "interactive"),
+            "bulk": backend.PythonQueue("test_couch_queue:bulk", "bulk")})
+        provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
+                                        None, test_provider_queue, {"a": test_couch_queue}, 
+                                        backend.ProviderWorker.wrapper, self.r)  
+        test_provider_queue.push(("aaatiid", {"doi":["10.1"]}, "biblio", [], "update1"), "bulk")
+        provider_worker.run()
+
+        assert_equals(test_couch_queue.lane_queues["interactive"].queue.qsize(), 0)
+        assert_equals(test_couch_queue.lane_queues["bulk"].queue.qsize(), 1)
+
+    def test_run_keeps_lane_of_each_message_in_a_batch(self):
+        def fake_batch_wrapper(provider_messages, provider, callback):
+            for (tiid, alias_dict, method_name, aliases_providers_run, update_id) in provider_messages:
+                callback(tiid, {"myfakeprovider:views": (1, "http://example.com")}, method_name, aliases_providers_run, update_id)
+
+        fake_provider = mocks.ProviderMock("myfakeprovider")
+        fake_provider._extract_metrics_batch = lambda page, status_code=200, ids=[]: {}
+        fake_provider.batch_window = 0
+        test_provider_queue = backend.LanedQueue("test_provider_queue", {
+            "interactive": backend.PythonQueue("test_provider_queue", "interactive"),
+            "bulk": backend.PythonQueue("test_provider_queue:bulk", "bulk")})
+        test_couch_queue = backend.LanedQueue("test_couch_queue", {
+            "interactive": backend.PythonQueue("test_couch_queue", "interactive"),
+            "bulk": backend.PythonQueue("test_couch_queue:bulk", "bulk")})
+        provider_worker = backend.ProviderWorker(fake_provider, 
+                                        None, test_provider_queue, {"a": test_couch_queue, "b": test_couch_queue}, 
+                                        None, self.r)  
+        provider_worker.batch_wrapper = fake_batch_wrapper
+        test_provider_queue.push(("aaatiid", {"doi":["10.1"]}, "metrics", [], "update1"), "interactive")
+        test_provider_queue.push(("bbbtiid", {"doi":["10.2"]}, "metrics", [], "update1"), "bulk")
+        provider_worker.run()
+
+        assert_equals(test_couch_queue.lane_queues["interactive"].pop(timeout=0)[0], "aaatiid")
+        assert_equals(test_couch_queue.lane_queues["bulk"].pop(timeout=0)[0], "bbbtiid")
+
+    def test_run_defers_message_when_circuit_opens(self):
+        fake_provider = mocks.ProviderMock("myfakeprovider")
+        fake_provider.exception_to_raise = ProviderTimeout()
+        fake_provider.circuit_failure_threshold = 1
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.ProviderWorker(fake_provider, 
+                                        None, test_provider_queue, {}, backend.ProviderWorker.wrapper, self.r)  
+        message = ("aaatiid", {"doi":["10.1"]}, "metrics", [], "update1")
+        test_provider_queue.push(message)
+        provider_worker.run()
+
+        assert provider_worker.circuit_breaker.is_open
+        # not marked finished with an empty answer, but back on the queue for later
+        assert_equals(self.r.get_num_providers_currently_updating("aaatiid"), 1)
+        assert_equals(test_provider_queue.pop(), message)
+
+    def test_run_defers_message_when_rate_limit_wait_runs_out(self):
+        fake_provider = mocks.ProviderMock("myfakeprovider")
+        fake_provider.exception_to_raise = ProviderThrottledError()
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.ProviderWorker(fake_provider, 
+                                        None, test_provider_queue, {}, backend.ProviderWorker.wrapper, self.r)  
+        message = ("aaatiid", {"doi":["10.1"]}, "metrics", [], "update1")
+        test_provider_queue.push(message)
+        provider_worker.run()
+
+        assert provider_worker.circuit_breaker.is_closed
+        # its metrics aren't lost, but back on the queue for when the rate limit allows
+        assert_equals(self.r.get_num_providers_currently_updating("aaatiid"), 1)
+        assert_equals(test_provider_queue.pop(), message)
+
+    def test_run_leaves_queue_alone_while_circuit_open(self):
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
+                                        None, test_provider_queue, {}, None, self.r)  
+        provider_worker.circuit_breaker.state = backend.CircuitBreaker.OPEN
+        provider_worker.circuit_breaker.opened_at = time.time() - provider_worker.circuit_breaker.reset_timeout + 0.1
+        message = ("aaatiid", {"doi":["10.1"]}, "biblio", [], "update1")
+        test_provider_queue.push(message)
+        provider_worker.run()
+        assert_equals(test_provider_queue.pop(), message)
+
+    def test_run_sends_one_probe_while_half_open(self):
+        calls = []
+        def fake_wrapper(tiid, alias_dict, provider, method_name, aliases_providers_run, callback, update_id):
+            calls.append(tiid)
+
+        fake_provider = mocks.ProviderMock("myfakeprovider")
+        fake_provider._extract_metrics_batch = lambda page, status_code=200, ids=[]: {}
+        fake_provider.batch_window = 0
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.ProviderWorker(fake_provider, 
+                                        None, test_provider_queue, {}, fake_wrapper, self.r)  
+        provider_worker.batch_wrapper = lambda provider_messages, provider, callback: calls.append(
+            [provider_message[0] for provider_message in provider_messages])
+        provider_worker.circuit_breaker.state = backend.CircuitBreaker.HALF_OPEN
+        test_provider_queue.push(("aaa", {"doi":["10.1"]}, "metrics", [], "update1"))
+        test_provider_queue.push(("bbb", {"doi":["10.1"]}, "metrics", [], "update1"))
+        test_provider_queue.push(("ccc", {"doi":["10.1"]}, "biblio", [], "update1"))
+        provider_worker.run()
+
+        # a batch of one, and the others left for after the probe
+        assert_equals(calls, [["aaa"]])
+        assert_equals(provider_worker.circuit_breaker.probe_in_flight, True)
+        assert_equals(test_provider_queue.queue.qsize(), 2)
+
+    def test_run_waits_for_probe_instead_of_popping(self):
+        test_provider_queue = backend.PythonQueue("test_provider_queue")
+        provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
+                                        None, test_provider_queue, {}, lambda *args: None, self.r)  
+        provider_worker.circuit_breaker.state = backend.CircuitBreaker.HALF_OPEN
+        provider_worker.circuit_breaker.probe_in_flight = True
+        test_provider_queue.push(("aaa", {"doi":["10.1"]}, "metrics", [], "update1"))
+
+        threading.Timer(0.2, provider_worker.circuit_breaker.record).start()
+        start_time = time.time()
+        provider_worker.run()
+
+        # woken by the probe's answer, having left the message where it was
+        assert 0.1 < time.time() - start_time < 0.9
+        assert_equals(test_provider_queue.queue.qsize(), 1)
+        assert provider_worker.circuit_breaker.is_closed
+
 class TestCouchWorker(TestBackend):
     def test_update_item_with_new_aliases(self):
         response = backend.CouchWorker.update_item_with_new_aliases(self.fake_aliases_dict, self.fake_item)
@@ -176,7 +384,7 @@ class TestCouchWorker(TestBackend):
         test_couch_queue = backend.PythonQueue("test_couch_queue")
         test_couch_queue_dict = {self.fake_item["_id"][0]:test_couch_queue}
         provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
-                                        None, None, None, test_couch_queue_dict, None, self.r)  
+                                        None, None, test_couch_queue_dict, None, self.r)  
         response = provider_worker.add_to_couch_queue_if_nonzero(self.fake_item["_id"], 
                 {"doi":["10.5061/dryad.3td2f"]}, 
                 "aliases", 
@@ -207,7 +415,7 @@ class TestCouchWorker(TestBackend):
         test_couch_queue = backend.PythonQueue("test_couch_queue")
         test_couch_queue_dict = {self.fake_item["_id"][0]:test_couch_queue}
         provider_worker = backend.ProviderWorker(mocks.ProviderMock("myfakeprovider"), 
-                                        None, None, None, test_couch_queue_dict, None, self.r) 
+                                        None, None, test_couch_queue_dict, None, self.r) 
         metrics_method_response = {'dryad:package_views': (361, 'http://dx.doi.org/10.5061/dryad.7898'), 
                             'dryad:total_downloads': (176, 'http://dx.doi.org/10.5061/dryad.7898'), 
                             'dryad:most_downloaded_file': (65, 'http://dx.doi.org/10.5061/dryad.7898')}                                         
@@ -232,8 +440,474 @@ class TestCouchWorker(TestBackend):
         assert_equals(response["metrics"]['dryad:package_views']['values']["raw"], expected)
 
 
+    def test_run_saves_batch_of_messages_for_item(self):
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        metrics_method_response = {'dryad:package_views': (361, 'http://dx.doi.org/10.5061/dryad.7898')}
+        test_couch_queue.push((self.fake_item["_id"], {"doi":["10.5061/dryad.3td2f"]}, "aliases", "dryad"))
+        test_couch_queue.push((self.fake_item["_id"], {"title":"A very good paper"}, "biblio", "dryad"))
+        test_couch_queue.push((self.fake_item["_id"], metrics_method_response, "metrics", "dryad"))
+
+        # save basic item beforehand
+        item_obj = item_module.create_objects_from_item_doc(self.fake_item)
+        self.db.session.add(item_obj)
+        self.db.session.commit()
+
+        # run once, which should drain all three messages
+        couch_worker = backend.CouchWorker(test_couch_queue, self.r, self.d)
+        couch_worker.run()
+        assert_equals(test_couch_queue.queue.qsize(), 0)
+
+        response = item_module.Item.from_tiid(self.fake_item["_id"]).as_old_doc()
+        assert_equals(response["aliases"]["doi"], ['10.5061/dryad.3td2f'])
+        assert_equals(response["biblio"], {"title":"A very good paper"})
+        assert_equals(response["metrics"]['dryad:package_views']['values']["raw"], 361)
+
+    def test_run_saves_rest_of_batch_when_one_row_is_a_duplicate(self):
+        # replacing an AOP title adds a second unknown1 title row, which can't be saved
+        aop_item = dict(self.fake_item, _id="2", aliases={"pmid":["222"], "biblio":[{"title":"AOP"}]})
+        for item_doc in [aop_item, self.fake_item]:
+            item_obj = item_module.create_objects_from_item_doc(item_doc)
+            self.db.session.add(item_obj)
+        self.db.session.commit()
+        self.db.session.remove()  # a fresh session, as after the worker's previous batch
+
+        test_couch_queue = backend.PythonQueue("test_couch_queue")
+        test_couch_queue.push((aop_item["_id"], {"title":"A very good paper"}, "biblio", "crossref"))
+        test_couch_queue.push((self.fake_item["_id"], {"doi":["10.5061/dryad.3td2f"]}, "aliases", "dryad"))
+
+        couch_worker = backend.CouchWorker(test_couch_queue, self.r, self.d)
+        couch_worker.run()
+        assert_equals(test_couch_queue.queue.qsize(), 0)
+
+        response = item_module.Item.from_tiid(self.fake_item["_id"]).as_old_doc()
+        assert_equals(response["aliases"]["doi"], ['10.5061/dryad.3td2f'])
+        response = item_module.Item.from_tiid(aop_item["_id"]).as_old_doc()
+        assert_equals(response["biblio"], {"title":"AOP"})
+
+    def test_run_leaves_batch_for_redelivery_on_a_database_error(self):
+        test_couch_queue = backend.RedisQueue("test_couch_queue", self.r)
+        message = [self.fake_item["_id"], {"doi":["10.5061/dryad.3td2f"]}, "metrics", "dryad"]
+        test_couch_queue.push(message)
+        self.r.set_provider_started(self.fake_item["_id"], "dryad")
+        couch_worker = backend.CouchWorker(test_couch_queue, self.r, self.d)
+
+        def broken_save(couch_messages):
+            raise OperationalError("SELECT", {}, Exception("server closed the connection unexpectedly"))
+        couch_worker.save_couch_messages = broken_save
+        couch_worker.run()  # logs instead of raising, so the worker thread lives on
+
+        # not acked or marked finished, so it is redelivered once its claim expires
+        assert_equals(self.r.lrange("test_couch_queue:processing", 0, -1), [json.dumps(message)])
+        assert_equals(self.r.get_num_providers_currently_updating(self.fake_item["_id"]), 1)
+
+        # and the next batch's ack doesn't ack it either
+        couch_worker.save_couch_messages = lambda couch_messages: None
+        test_couch_queue.push(["bbb", {}, "biblio", "dryad"])
+        couch_worker.run()
+        assert_equals(self.r.lrange("test_couch_queue:processing", 0, -1), [json.dumps(message)])
+
+    def test_run_in_loop_keeps_going_after_an_exception(self):
+        class StopLooping(BaseException):
+            pass
+        test_couch_queue = backend.RedisQueue("test_couch_queue", self.r)
+        message = [self.fake_item["_id"], {}, "biblio", "dryad"]
+        test_couch_queue.push(message)
+        couch_worker = backend.CouchWorker(test_couch_queue, self.r, self.d)
+        couch_worker.error_backoff = 0
+
+        saves = []
+        def save_couch_messages(couch_messages):
+            saves.append(couch_messages)
+            if len(saves) == 1:
+                test_couch_queue.push(["bbb", {}, "biblio", "dryad"])
+                raise ValueError("unexpected content")
+        couch_worker.save_couch_messages = save_couch_messages
+        runs = []
+        real_run = couch_worker.run
+        def run():
+            runs.append(1)
+            if len(runs) > 2:
+                raise StopLooping()
+            real_run()
+        couch_worker.run = run
+
+        assert_raises(StopLooping, couch_worker.run_in_loop)
+        assert_equals(len(saves), 2)  # the loop went on to the next batch
+        # and left the batch that raised to be redelivered, not acked with the next one
+        assert_equals(self.r.lrange("test_couch_queue:processing", 0, -1), [json.dumps(message)])
+
+
+class TestPythonQueue():
+    def test_pop_batch(self):
+        test_queue = backend.PythonQueue("test_queue")
+        for i in range(5):
+            test_queue.push(("tiid"+str(i), {}, "metrics", "dryad"))
+        response = test_queue.pop_batch(3)
+        assert_equals([message[0] for message in response], ["tiid0", "tiid1", "tiid2"])
+        response = test_queue.pop_batch(3)
+        assert_equals([message[0] for message in response], ["tiid3", "tiid4"])
+
+
+class TestLanedQueue():
+    def setUp(self):
+        self.queue = backend.LanedQueue("test_queue", {
+            "interactive": backend.PythonQueue("test_queue", "interactive"),
+            "bulk": backend.PythonQueue("test_queue:bulk", "bulk")},
+            weights={"interactive": 4, "bulk": 1})
+
+    def test_interactive_served_ahead_of_bulk(self):
+        for i in range(10):
+            self.queue.push(("bulktiid"+str(i), {}, []), "bulk")
+        for i in range(4):
+            self.queue.push(("tiid"+str(i), {}, []))
+        first_five = [self.queue.pop()[0] for i in range(5)]
+        assert_equals(len([tiid for tiid in first_five if tiid.startswith("tiid")]), 4)
+        assert_equals(len([tiid for tiid in first_five if tiid.startswith("bulk")]), 1)
+
+    def test_bulk_served_when_no_interactive(self):
+        self.queue.push(("bulktiid", {}, []), "bulk")
+        response = self.queue.pop(timeout=0)
+        assert_equals(response[0], "bulktiid")
+        assert_equals(self.queue.current_lane(), "bulk")
+
+    def test_idle_lane_does_not_bank_credit(self):
+        for i in range(20):
+            self.queue.push(("bulktiid"+str(i), {}, []), "bulk")
+        for i in range(10):
+            self.queue.pop(timeout=0)
+        for i in range(10):
+            self.queue.push(("tiid"+str(i), {}, []))
+        next_ten = [self.queue.pop()[0] for i in range(10)]
+        num_bulk = len([tiid for tiid in next_ten if tiid.startswith("bulk")])
+        assert 1 <= num_bulk <= 3, num_bulk
+
+    def test_pop_nothing(self):
+        response = self.queue.pop(timeout=0)
+        assert_equals(response, None)
+
+
+class TestRedisQueue():
+    def setUp(self):
+        self.r = tiredis.from_url("redis://localhost:6379", db=8)
+        self.r.flushdb()
+        self.queue = backend.RedisQueue("test-reliable-queue", self.r)
+
+    def teardown(self):
+        self.r.flushdb()
+
+    def test_pop_keeps_message_until_ack(self):
+        self.queue.push(["aaatiid", {"doi":["10.1"]}, "biblio", []])
+        response = self.queue.pop()
+        assert_equals(response, ["aaatiid", {"doi":["10.1"]}, "biblio", []])
+        assert_equals(self.r.llen(self.queue.processing_name), 1)
+
+        self.queue.ack()
+        assert_equals(self.r.llen(self.queue.processing_name), 0)
+        assert_equals(self.r.hgetall(self.queue.claims_name), {})
+
+    def test_pop_batch_acks_together(self):
+        for i in range(3):
+            self.queue.push(["tiid"+str(i), {}, "metrics", "dryad"])
+        response = self.queue.pop_batch(5)
+        assert_equals([message[0] for message in response], ["tiid0", "tiid1", "tiid2"])
+        assert_equals(self.r.llen(self.queue.processing_name), 3)
+        self.queue.ack()
+        assert_equals(self.r.llen(self.queue.processing_name), 0)
+
+    def test_requeue_expired(self):
+        self.queue.push(["aaatiid", {}, "metrics", "dryad"])
+        response = self.queue.pop()  # claimed but never acked, as if the worker died
+
+        self.queue.visibility_timeout = 0
+        time.sleep(0.01)
+        self.queue.requeue_expired()
+        assert_equals(self.r.llen(self.queue.processing_name), 0)
+
+        response = self.queue.pop()
+        assert_equals(response, ["aaatiid", {}, "metrics", "dryad"])
+
+
+class TestFedQueue():
+    def setUp(self):
+        self.r = tiredis.from_url("redis://localhost:6379", db=8)
+        self.r.flushdb()
+
+    def teardown(self):
+        self.r.flushdb()
+
+    def fed_queue(self, queue_name):
+        # a queue name per test, since popper threads outlive their test
+        self.shared_queue = backend.laned_redis_queue(queue_name, self.r)
+        return backend.FedQueue(self.shared_queue, 2)
+
+    def test_popper_feeds_pool_threads(self):
+        self.queue = self.fed_queue("test-fed-queue")
+        self.queue.push(["aaatiid", {}, "metrics", "dryad"], "bulk")
+        self.queue.start_popper("test_popper")
+
+        response = self.queue.pop(timeout=5)
+        assert_equals(response, ["aaatiid", {}, "metrics", "dryad"])
+        assert_equals(self.queue.current_lane(), "bulk")
+
+        # popped by the popper thread, acked by this one
+        processing_name = self.shared_queue.lane_queues["bulk"].processing_name
+        assert_equals(self.r.llen(processing_name), 1)
+        self.queue.ack()
+        assert_equals(self.r.llen(processing_name), 0)
+
+    def test_popper_stops_claiming_when_feed_is_full(self):
+        self.queue = self.fed_queue("test-full-fed-queue")
+        for i in range(5):
+            self.queue.push(["tiid"+str(i), {}, "metrics", "dryad"])
+        self.queue.start_popper("test_popper")
+        time.sleep(0.5)
+        # two in the local queue, one waiting to go in, the rest left in redis for other processes
+        assert_equals(self.r.llen("test-full-fed-queue"), 2)
+
+
+class TestAdaptiveConcurrencyLimit():
+    def test_additive_increase(self):
+        limit = backend.AdaptiveConcurrencyLimit("myfakeprovider", 10)
+        limit.limit = 4.0
+        for i in range(4):
+            limit.record(0.1)
+        assert_equals(limit.current, 4)
+        limit.record(0.1)
+        assert_equals(limit.current, 5)
+
+    def test_increase_capped_at_max(self):
+        limit = backend.AdaptiveConcurrencyLimit("myfakeprovider", 3)
+        for i in range(20):
+            limit.record(0.1)
+        assert_equals(limit.current, 3)
+
+    def test_multiplicative_decrease_on_timeout(self):
+        limit = backend.AdaptiveConcurrencyLimit("myfakeprovider", 20)
+        limit.record(0.1, ProviderTimeout())
+        assert_equals(limit.current, 10)
+        # more failures in the same window don't keep cutting
+        limit.record(0.1, ProviderTimeout())
+        assert_equals(limit.current, 10)
+        assert_equals(limit.as_dict()["num_congested"], 2)
+
+    def test_decrease_on_rate_limit_from_provider_not_our_own(self):
+        limit = backend.AdaptiveConcurrencyLimit("myfakeprovider", 20)
+        limit.record(0.1, ProviderThrottledError())
+        assert_equals(limit.current, 20)
+        limit.record(0.1, ProviderRateLimitError())
+        assert_equals(limit.current, 10)
+
+    def test_decrease_on_slow_call(self):
+        limit = backend.AdaptiveConcurrencyLimit("myfakeprovider", 20, latency_target=1.0)
+        limit.record(2.0)
+        assert_equals(limit.current, 10)
+
+    def test_never_below_min(self):
+        limit = backend.AdaptiveConcurrencyLimit("myfakeprovider", 2, decrease_cooldown=0)
+        for i in range(5):
+            limit.record(0.1, ProviderTimeout())
+        assert_equals(limit.current, 1)
+
+    def test_wrapper_records_call(self):
+        def fake_callback(tiid, new_content, method_name, aliases_providers_run, update_id):
+            pass
+        limit = backend.AdaptiveConcurrencyLimit("myfakeprovider", 20)
+        backend.concurrency_limits["myfakeprovider"] = limit
+        fake_provider = mocks.ProviderMock("myfakeprovider")
+        fake_provider.exception_to_raise = ProviderTimeout()
+        backend.ProviderWorker.wrapper("123", {'doi': ['10.123']}, fake_provider, "metrics", [], fake_callback)
+        del backend.concurrency_limits["myfakeprovider"]
+        assert_equals(limit.as_dict()["num_calls"], 1)
+        assert_equals(limit.current, 10)
+
+    def test_wrapper_times_gets_not_waits(self):
+        def fake_callback(tiid, new_content, method_name, aliases_providers_run, update_id):
+            pass
+        class WaitingProvider(mocks.ProviderMock):
+            get_latency = 0.01
+            def metrics(self, aliases, url=None, cache_enabled=True):
+                time.sleep(0.2)  # as if waiting for our own rate limit, or to retry
+                provider._record_get_latency(self.get_latency)
+                return self.metrics_returns
+        limit = backend.AdaptiveConcurrencyLimit("myfakeprovider", 20, latency_target=0.1)
+        backend.concurrency_limits["myfakeprovider"] = limit
+        fake_provider = WaitingProvider("myfakeprovider")
+        try:
+            backend.ProviderWorker.wrapper("123", {'doi': ['10.123']}, fake_provider, "metrics", [], fake_callback)
+            assert_equals(limit.current, 20)
+            assert_equals(limit.as_dict()["average_latency"], 0.01)
+
+            fake_provider.get_latency = 0.5
+            backend.ProviderWorker.wrapper("123", {'doi': ['10.123']}, fake_provider, "metrics", [], fake_callback)
+            assert_equals(limit.current, 10)
+        finally:
+            del backend.concurrency_limits["myfakeprovider"]
+
+
+class TestProviderSlots():
+    def setUp(self):
+        self.r = tiredis.from_url("redis://localhost:6379", db=8)
+        self.r.flushdb()
+        self.slots = backend.ProviderSlots("myfakeprovider", 
+            backend.AdaptiveConcurrencyLimit("myfakeprovider", 1), self.r)
+
+    def teardown(self):
+        self.r.flushdb()
+
+    def acquire_in_thread(self):
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(self.slots.acquire()))
+        thread.daemon = True
+        thread.start()
+        return (thread, acquired)
+
+    def test_waits_locally_for_a_slot(self):
+        first = self.slots.acquire()
+        (thread, acquired) = self.acquire_in_thread()
+        time.sleep(0.2)
+        assert_equals(acquired, [])
+        # the waiting thread hasn't gone to redis
+        assert_equals(self.r.get_num_provider_slots_in_use("myfakeprovider"), 1)
+
+        self.slots.release(first)
+        thread.join(2)
+        assert_equals(len(acquired), 1)
+
+    def test_waits_for_release_by_another_process(self):
+        other_process_slot = self.r.acquire_provider_slot("myfakeprovider", 1)
+        (thread, acquired) = self.acquire_in_thread()
+        time.sleep(0.2)
+        assert_equals(acquired, [])
+
+        self.r.release_provider_slot("myfakeprovider", other_process_slot)
+        thread.join(2)
+        assert_equals(len(acquired), 1)
+
+
+class TestCircuitBreaker():
+    def test_opens_after_consecutive_failures(self):
+        breaker = backend.CircuitBreaker("myfakeprovider", failure_threshold=3)
+        breaker.record(ProviderTimeout())
+        breaker.record(ProviderTimeout())
+        assert breaker.allow_request()
+        breaker.record(ProviderTimeout())
+        assert breaker.is_open
+        assert not breaker.allow_request()
+        assert breaker.seconds_until_retry() > 0
+
+    def test_success_resets_failures(self):
+        breaker = backend.CircuitBreaker("myfakeprovider", failure_threshold=2)
+        breaker.record(ProviderTimeout())
+        breaker.record()
+        breaker.record(ProviderTimeout())
+        assert not breaker.is_open
+
+    def test_item_errors_dont_count(self):
+        breaker = backend.CircuitBreaker("myfakeprovider", failure_threshold=1)
+        breaker.record(ProviderItemNotFoundError())
+        assert not breaker.is_open
+
+    def test_our_own_rate_limit_doesnt_count(self):
+        breaker = backend.CircuitBreaker("myfakeprovider", failure_threshold=1, reset_timeout=0)
+        breaker.record(ProviderThrottledError())
+        assert not breaker.is_open
+
+        # a throttled probe leaves the circuit half open, for the next probe
+        breaker.record(ProviderTimeout())
+        assert breaker.allow_request()
+        breaker.record(ProviderThrottledError())
+        assert_equals(breaker.state, backend.CircuitBreaker.HALF_OPEN)
+        assert breaker.allow_request()
+
+    def test_half_open_sends_one_probe(self):
+        breaker = backend.CircuitBreaker("myfakeprovider", failure_threshold=1, reset_timeout=0)
+        breaker.record(ProviderTimeout())
+        assert breaker.allow_request()
+        assert_equals(breaker.state, backend.CircuitBreaker.HALF_OPEN)
+        assert not breaker.allow_request()
+
+        # probe works, so circuit closes
+        breaker.record()
+        assert_equals(breaker.state, backend.CircuitBreaker.CLOSED)
+        assert breaker.allow_request()
+
+    def test_failed_probe_reopens(self):
+        breaker = backend.CircuitBreaker("myfakeprovider", failure_threshold=5, reset_timeout=60)
+        breaker.state = backend.CircuitBreaker.HALF_OPEN
+        assert breaker.allow_request()
+        breaker.record(ProviderTimeout())
+        assert breaker.is_open
+        assert not breaker.allow_request()
+
+
+class TestMain():
+    def test_couch_partition_keys_cover_alphabet_once(self):
+        all_keys = []
+        for partition in range(3):
+            all_keys += backend.couch_partition_keys(partition, 3)
+        assert_equals(sorted(all_keys), sorted(backend.TIID_ALPHABET))
+        assert_equals(backend.couch_partition_keys(0, 1), list(backend.TIID_ALPHABET))
+
+    @raises(RuntimeError)
+    def test_main_refuses_gevent_engine_when_not_patched(self):
+        old_engine = backend.ENGINE
+        backend.ENGINE = "gevent"
+        try:
+            backend.main(stages=[])
+        finally:
+            backend.ENGINE = old_engine
+
+
 class TestBackendClass(TestBackend):
 
+    def test_run_collapses_duplicate_provider_runs(self):
+        webpage_queue = backend.PythonQueue("webpage_queue")
+        self.b.provider_queues = {"webpage": webpage_queue}
+        alias_message = ["aaatiid", {"unknownnamespace":["111"]}, [], "update1"]
+        self.b.alias_queue.push(alias_message)
+        self.b.alias_queue.push(alias_message)
+        self.b.run()
+        self.b.run()
+        assert_equals(webpage_queue.queue.qsize(), 1)
+
+        # once the provider has run, a new request queues it again
+        provider_worker = backend.ProviderWorker(mocks.ProviderMock("webpage"), 
+                                        None, webpage_queue, {}, lambda *args: None, self.r)  
+        provider_worker.run()
+        self.b.alias_queue.push(alias_message)
+        self.b.run()
+        assert_equals(webpage_queue.queue.qsize(), 1)
+
+    def test_run_lets_interactive_request_through_a_bulk_run(self):
+        webpage_queue = backend.LanedQueue("webpage_queue", {
+            "interactive": backend.PythonQueue("webpage_queue", "interactive"),
+            "bulk": backend.PythonQueue("webpage_queue:bulk", "bulk")})
+        self.b.provider_queues = {"webpage": webpage_queue}
+        self.b.alias_queue = backend.LanedQueue("alias-unittest", {
+            "interactive": backend.PythonQueue("alias-unittest", "interactive"),
+            "bulk": backend.PythonQueue("alias-unittest:bulk", "bulk")})
+        alias_message = ["aaatiid", {"unknownnamespace":["111"]}, [], "update1"]
+        self.b.alias_queue.push(alias_message, "bulk")
+        self.b.run()
+        self.b.alias_queue.push(alias_message, "interactive")
+        self.b.run()
+        self.b.alias_queue.push(alias_message, "interactive")
+        self.b.run()
+
+        # queued interactive once, not left behind the bulk run or queued twice
+        assert_equals(webpage_queue.lane_queues["bulk"].queue.qsize(), 1)
+        assert_equals(webpage_queue.lane_queues["interactive"].queue.qsize(), 1)
+
+    def test_run_serves_alias_message_queued_before_update_ids(self):
+        webpage_queue = backend.PythonQueue("webpage_queue")
+        self.b.provider_queues = {"webpage": webpage_queue}
+        self.b.alias_queue.push(["aaatiid", {"unknownnamespace":["111"]}, []])
+        self.b.run()
+
+        (tiid, alias_dict, method_name, aliases_providers_run, update_id) = webpage_queue.pop()
+        assert_equals(tiid, "aaatiid")
+        assert update_id
+
     def test_decide_who_to_call_next_unknown(self):
         aliases_dict = {"unknownnamespace":["111"]}
         prev_aliases = []
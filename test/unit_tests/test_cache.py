@@ -0,0 +1,109 @@
+import time
+from contextlib import contextmanager
+from nose.tools import assert_equals
+
+from totalimpact import cache
+from totalimpact.cache import LocalCache, Cache
+
+
+class FakeMemcached(object):
+    def __init__(self):
+        self.store = {}
+        self.times = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def get_multi(self, keys):
+        return dict([(key, self.store[key]) for key in keys if key in self.store])
+
+    def set(self, key, value, time=0):
+        self.store[key] = value
+        self.times[key] = time
+        return True
+
+    def set_multi(self, mapping, time=0):
+        self.store.update(mapping)
+        return []
+
+
+class TestLocalCache():
+
+    def setUp(self):
+        self.cache = LocalCache(max_entries=2, max_age=60)
+
+    def test_get_and_set(self):
+        assert_equals(self.cache.get("a"), None)
+        self.cache.set("a", {"status_code": 200})
+        assert_equals(self.cache.get("a"), {"status_code": 200})
+        assert_equals(self.cache.stats(), {"hits": 1, "misses": 1, "evictions": 0, "entries": 1})
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")  # so b is now the oldest
+        self.cache.set("c", 3)
+        assert_equals(self.cache.get("b"), None)
+        assert_equals(self.cache.get("a"), 1)
+        assert_equals(self.cache.get("c"), 3)
+        assert_equals(self.cache.stats()["evictions"], 1)
+
+    def test_entries_expire(self):
+        self.cache.set("a", 1, max_age=0.01)
+        time.sleep(0.02)
+        assert_equals(self.cache.get("a"), None)
+        assert_equals(self.cache.stats()["entries"], 0)
+
+
+class TestCache():
+
+    def setUp(self):
+        self.mc = FakeMemcached()
+        self.cache = Cache()
+        self.cache._get_memcached_client = contextmanager(lambda: (yield self.mc))
+        cache._local_cache.clear()
+
+    def teardown(self):
+        cache._local_cache.clear()
+
+    def test_hash_key_ignores_dict_order(self):
+        key1 = {"url": "http://example.com", "Accept": "text/xml", "allow_redirects": True}
+        key2 = {"allow_redirects": True, "Accept": "text/xml", "url": "http://example.com"}
+        assert_equals(self.cache._build_hash_key(key1), self.cache._build_hash_key(key2))
+
+    def test_stores_compressed(self):
+        data = {"status_code": 200, "url": "http://example.com", "text": u"abc" * 10000}
+        self.cache.set_cache_entry({"url": "http://example.com"}, data)
+        stored = self.mc.store.values()[0]
+        assert len(stored) < 1000
+        cache._local_cache.clear()
+        assert_equals(self.cache.get_cache_entry({"url": "http://example.com"})["text"], data["text"])
+
+    def test_stores_large_entries_in_chunks(self):
+        data = {"status_code": 200, "url": "http://example.com", "text": cache.os.urandom(3*1000*1000).encode("hex")}
+        self.cache.set_cache_entry({"url": "http://example.com"}, data)
+        assert len(self.mc.store) > 2
+        cache._local_cache.clear()
+        assert_equals(self.cache.get_cache_entry({"url": "http://example.com"})["text"], data["text"])
+
+    def test_missing_chunk_is_a_miss(self):
+        data = {"status_code": 200, "url": "http://example.com", "text": cache.os.urandom(3*1000*1000).encode("hex")}
+        self.cache.set_cache_entry({"url": "http://example.com"}, data)
+        chunk_key = [key for key in self.mc.store if key.endswith(":1")][0]
+        del self.mc.store[chunk_key]
+        cache._local_cache.clear()
+        assert_equals(self.cache.get_cache_entry({"url": "http://example.com"}), None)
+
+    def test_is_fresh(self):
+        self.cache.max_cache_age = 60
+        assert self.cache.is_fresh({"cached_at": time.time()})
+        assert not self.cache.is_fresh({"cached_at": time.time() - 61})
+        assert self.cache.is_fresh({"status_code": 200})
+
+    def test_keeps_entries_with_validators_for_revalidation(self):
+        self.cache.set_cache_entry({"url": "http://a.com"}, {"status_code": 200, "url": "http://a.com", "text": "a"})
+        self.cache.set_cache_entry({"url": "http://b.com"}, {"status_code": 200, "url": "http://b.com", "text": "b", "etag": '"v1"'})
+        key_a = self.cache._build_hash_key({"url": "http://a.com"})
+        key_b = self.cache._build_hash_key({"url": "http://b.com"})
+        assert_equals(self.mc.times[key_a], self.cache.max_cache_age)
+        assert self.mc.times[key_b] > self.cache.max_cache_age
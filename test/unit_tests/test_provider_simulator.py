@@ -0,0 +1,68 @@
+import os
+import threading
+import requests
+from nose.tools import assert_equals, assert_true
+
+from totalimpact import app
+from totalimpact.providers.provider import Provider
+from totalimpact.provider_simulator import ProviderSimulator, RecordedPages, Faults, SAMPLE_PAGES_DIR
+
+DRYAD_METRICS_URL = "http://dx.doi.org/10.5061/dryad.7898"
+
+
+class TestRecordedPages():
+
+    def setUp(self):
+        self.recorded_pages = RecordedPages()
+
+    def test_get_page_by_url_template(self):
+        expected = open(os.path.join(SAMPLE_PAGES_DIR, "topsy", "metrics_site")).read()
+        url = "http://otter.topsy.com/search.json?q=site:example.com&window=a&page=1&perpage=100&apikey=" + os.environ["TOPSY_KEY"]
+        assert_equals(self.recorded_pages.get_page("topsy", url), expected)
+
+    def test_get_page_unknown_url(self):
+        assert_equals(self.recorded_pages.get_page("topsy", "http://example.com/nothing"), None)
+
+
+class TestProviderSimulator():
+
+    def setUp(self):
+        self.faults = Faults(latency_median=0)
+        self.simulator = ProviderSimulator(("localhost", 0), self.faults)
+        self.simulator_url = "http://localhost:%i" % self.simulator.server_address[1]
+        thread = threading.Thread(target=self.simulator.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.old_simulator_config = app.config["PROVIDER_SIMULATOR"]
+
+    def tearDown(self):
+        app.config["PROVIDER_SIMULATOR"] = self.old_simulator_config
+        self.simulator.shutdown()
+        self.simulator.server_close()
+
+    def test_serves_recorded_page(self):
+        expected = open(os.path.join(SAMPLE_PAGES_DIR, "dryad", "metrics")).read()
+        r = requests.get(self.simulator_url + "/dryad", params={"url": DRYAD_METRICS_URL})
+        assert_equals(r.status_code, 200)
+        assert_equals(r.content, expected)
+        assert_equals(self.simulator.counts, {"dryad:ok": 1})
+
+    def test_injects_faults(self):
+        self.faults.rate_limit_rate = 1
+        self.faults.retry_after = 7
+        r = requests.get(self.simulator_url + "/dryad", params={"url": DRYAD_METRICS_URL})
+        assert_equals(r.status_code, 429)
+        assert_equals(r.headers["Retry-After"], "7")
+
+        self.faults.rate_limit_rate = 0
+        self.faults.error_rate = 1
+        r = requests.get(self.simulator_url + "/dryad", params={"url": DRYAD_METRICS_URL})
+        assert_true(r.status_code in [500, 503])
+
+    def test_http_get_routes_to_simulator(self):
+        app.config["PROVIDER_SIMULATOR"] = self.simulator_url
+        provider = Provider()
+        provider.provider_name = "dryad"
+        r = provider.http_get(DRYAD_METRICS_URL, cache_enabled=False)
+        assert_equals(r.status_code, 200)
+        assert_equals(self.simulator.counts, {"dryad:ok": 1})
@@ -0,0 +1,52 @@
+import os
+from nose.tools import assert_equals
+
+from totalimpact import tiredis, ratelimit
+from totalimpact.ratelimit import RateLimiter
+
+
+class TestRateLimiter():
+
+    def setUp(self):
+        # we're putting unittests for redis in their own db (number 8) so they can be deleted with abandon
+        self.r = tiredis.from_url("redis://localhost:6379", db=8)
+        self.r.flushdb()
+        self.rate_limiter = RateLimiter(self.r)
+
+    def teardown(self):
+        self.r.flushdb()
+
+    def test_take_tokens_allows_burst_then_waits(self):
+        for i in range(3):
+            (allowed, wait) = self.rate_limiter.take_tokens("test_bucket", 1, 3)
+            assert_equals(allowed, True)
+        (allowed, wait) = self.rate_limiter.take_tokens("test_bucket", 1, 3)
+        assert_equals(allowed, False)
+        assert 0 < wait <= 1
+
+    def test_buckets_are_separate(self):
+        self.rate_limiter.take_tokens("test_bucket", 1, 1)
+        (allowed, wait) = self.rate_limiter.take_tokens("other_bucket", 1, 1)
+        assert_equals(allowed, True)
+
+    def test_wait_for_tokens_gives_up_after_max_wait(self):
+        self.rate_limiter.take_tokens("test_bucket", 0.01, 1)
+        response = self.rate_limiter.wait_for_tokens("test_bucket", 0.01, 1, max_wait=1)
+        assert_equals(response, False)
+
+    def test_wait_for_tokens_waits_for_refill(self):
+        self.rate_limiter.take_tokens("test_bucket", 20, 1)
+        response = self.rate_limiter.wait_for_tokens("test_bucket", 20, 1, max_wait=1)
+        assert_equals(response, True)
+
+    def test_take_tokens_fails_open_without_redis_url(self):
+        old_url = os.environ.pop("REDISTOGO_URL", None)
+        old_client = ratelimit._redis_client
+        ratelimit._redis_client = None
+        try:
+            response = RateLimiter().take_tokens("test_bucket", 1, 1)
+        finally:
+            ratelimit._redis_client = old_client
+            if old_url is not None:
+                os.environ["REDISTOGO_URL"] = old_url
+        assert_equals(response, (True, 0))
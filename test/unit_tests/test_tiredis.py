@@ -45,6 +45,65 @@ class TestTiRedis():
         assert_equals(self.r.get_num_providers_currently_updating("abcd"), 0)
 
 
+    def test_provider_slots(self):
+        first = self.r.acquire_provider_slot("wikipedia", 2)
+        second = self.r.acquire_provider_slot("wikipedia", 2)
+        assert_equals(self.r.acquire_provider_slot("wikipedia", 2), None)
+        assert_equals(self.r.get_num_provider_slots_in_use("wikipedia"), 2)
+
+        self.r.release_provider_slot("wikipedia", first)
+        assert_equals(self.r.get_num_provider_slots_in_use("wikipedia"), 1)
+        assert(self.r.acquire_provider_slot("wikipedia", 2))
+
+    def test_wait_for_provider_slot_release(self):
+        slot = self.r.acquire_provider_slot("wikipedia", 1)
+        self.r.release_provider_slot("wikipedia", slot)
+        assert_equals(self.r.wait_for_provider_slot_release("wikipedia", 1), True)
+        # nothing released since
+        assert_equals(self.r.wait_for_provider_slot_release("wikipedia", 1), False)
+
+    def test_claim_provider_run(self):
+        assert self.r.claim_provider_run("tiid1", "metrics", "wikipedia")
+        assert not self.r.claim_provider_run("tiid1", "metrics", "wikipedia")
+        assert self.r.claim_provider_run("tiid1", "biblio", "wikipedia")
+
+        self.r.release_provider_run("tiid1", "metrics", "wikipedia")
+        assert self.r.claim_provider_run("tiid1", "metrics", "wikipedia")
+
+    def test_claim_provider_run_interactive_promotes_bulk_claim(self):
+        assert self.r.claim_provider_run("tiid1", "metrics", "wikipedia", tiredis.BULK)
+        assert not self.r.claim_provider_run("tiid1", "metrics", "wikipedia", tiredis.BULK)
+        # an interactive request goes through once, then attaches like any other
+        assert self.r.claim_provider_run("tiid1", "metrics", "wikipedia", tiredis.INTERACTIVE)
+        assert not self.r.claim_provider_run("tiid1", "metrics", "wikipedia", tiredis.INTERACTIVE)
+        assert not self.r.claim_provider_run("tiid1", "metrics", "wikipedia", tiredis.BULK)
+        assert self.r.ttl("provider_run:tiid1:metrics:wikipedia") > 0
+
+    def test_add_to_alias_queue_lanes(self):
+        self.r.add_to_alias_queue("tiid1", {"doi":["10.1"]})
+        self.r.add_to_alias_queue("tiid2", {"doi":["10.2"]}, lane=tiredis.BULK)
+        assert_equals(json.loads(self.r.rpop("aliasqueue"))[0], "tiid1")
+        assert_equals(json.loads(self.r.rpop("aliasqueue:bulk"))[0], "tiid2")
+
+    def test_add_to_alias_queue_starts_new_update_run(self):
+        self.r.add_to_alias_queue("tiid1", {"doi":["10.1"]})
+        self.r.add_to_alias_queue("tiid1", {"doi":["10.1"]})
+        first_update_id = json.loads(self.r.rpop("aliasqueue"))[3]
+        second_update_id = json.loads(self.r.rpop("aliasqueue"))[3]
+        assert first_update_id
+        assert first_update_id != second_update_id
+
+    def test_provider_concurrency_stats(self):
+        self.r.set_provider_concurrency_stats("wikipedia", {"limit": 3})
+        self.r.set_provider_concurrency_stats("topsy", {"limit": 10})
+        response = self.r.get_provider_concurrency_stats()
+        assert_equals(response, {"wikipedia": {"limit": 3}, "topsy": {"limit": 10}})
+
+    def test_cache_stats(self):
+        self.r.set_cache_stats("1234", {"local": {"hits": 3}})
+        response = self.r.get_cache_stats()
+        assert_equals(response, {"1234": {"local": {"hits": 3}}})
+
     def test_memberitems_status(self):
         self.r.set_memberitems_status("abcd", 11)
         response = self.r.get_memberitems_status("abcd")
@@ -0,0 +1,160 @@
+import os
+import time
+import datetime
+import random
+import atexit
+import threading
+import logging
+import Queue
+import iso8601
+from analytics.client import Client
+from analytics.stats import Statistics
+
+from totalimpact import default_settings
+
+# set up logging
+logger = logging.getLogger("ti.analytics_sink")
+
+
+def make_client(batch_size):
+    """ A segment.io client that only posts when the sink flushes it, on the sink's thread.
+        analytics.init's shared client flushes on its own threads, in batches of its own size. """
+    client = Client(os.getenv("SEGMENTIO_PYTHON_KEY"),
+        async=False,
+        flush_at=batch_size+1,
+        flush_after=datetime.timedelta(days=1),
+        stats=Statistics())
+    # otherwise its first track flushes straight away
+    client.last_flushed = datetime.datetime.now()
+    return client
+
+
+class AnalyticsSink(object):
+    """ Buffers analytics events and sends them to segment.io in batches from a
+        background thread, so tracking never blocks or fails the caller.
+        Events are dropped when the queue is full, and sampled by event name. """
+
+    def __init__(self,
+            max_queue_size=default_settings.ANALYTICS_QUEUE_SIZE,
+            batch_size=default_settings.ANALYTICS_BATCH_SIZE,
+            flush_interval=default_settings.ANALYTICS_FLUSH_INTERVAL,
+            sample_rates=default_settings.ANALYTICS_SAMPLE_RATES,
+            client=None):
+        if client is None:
+            client = make_client(batch_size)
+        self.max_queue_size = max_queue_size
+        # the client posts at most max_flush_size events in one request
+        self.batch_size = min(batch_size, client.max_flush_size)
+        self.flush_interval = flush_interval
+        self.sample_rates = sample_rates  # event name: fraction kept; others are all kept
+        self.client = client
+        self.send_lock = threading.Lock()  # flush at exit can race the sender for the client's queue
+        self.queue = Queue.Queue(max_queue_size)
+        self.sender = None
+        self.sender_pid = None
+        self.sender_lock = threading.Lock()
+        self.counts = {"queued": 0, "dropped": 0, "sampled_out": 0, "sent": 0, "failed": 0}
+        self.counts_lock = threading.Lock()
+
+    def _count(self, stat, number=1):
+        with self.counts_lock:
+            self.counts[stat] += number
+
+    def stats(self):
+        with self.counts_lock:
+            return dict(self.counts, waiting=self.queue.qsize())
+
+    def track(self, user_id, event, properties={}, context={}):
+        """ Takes the same args as analytics.track, and returns whether the event was queued """
+        sample_rate = self.sample_rates.get(event, 1)
+        if sample_rate < 1:
+            if random.random() >= sample_rate:
+                self._count("sampled_out")
+                return False
+            # so counts can be scaled back up
+            properties = dict(properties, sample_rate=sample_rate)
+
+        # sent later, so say when it happened rather than let segment.io use the send time
+        timestamp = datetime.datetime.now(iso8601.iso8601.UTC)
+        self._ensure_sender()
+        try:
+            self.queue.put_nowait((user_id, event, properties, context, timestamp))
+        except Queue.Full:
+            self._count("dropped")
+            return False
+        self._count("queued")
+        return True
+
+    def _ensure_sender(self):
+        # started on first use, and again in a process forked after that
+        if self.sender_pid == os.getpid() and self.sender.is_alive():
+            return
+        with self.sender_lock:
+            if self.sender_pid == os.getpid() and self.sender.is_alive():
+                return
+            self.sender = threading.Thread(target=self._send_forever, name="analytics_sink")
+            self.sender.daemon = True
+            self.sender.start()
+            self.sender_pid = os.getpid()
+
+    def _next_batch(self, timeout):
+        """ Waits up to timeout seconds for a batch_size batch, and returns what it got """
+        batch = []
+        give_up_at = time.time() + timeout
+        while len(batch) < self.batch_size:
+            wait = give_up_at - time.time()
+            try:
+                if wait > 0:
+                    batch.append(self.queue.get(timeout=wait))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _send_forever(self):
+        while True:
+            batch = self._next_batch(self.flush_interval)
+            if batch:
+                self.send(batch)
+
+    def send(self, batch):
+        with self.send_lock:
+            failed_before = self.client.stats.failed
+            try:
+                for (user_id, event, properties, context, timestamp) in batch:
+                    self.client.track(user_id, event, properties, context, timestamp=timestamp)
+                self.client.flush(async=False)
+            except Exception, e:
+                # a lost batch isn't worth failing over
+                logger.warning(u"couldn't send {number} analytics events: {error}".format(
+                    number=len(batch), error=repr(e)))
+                self._count("failed", len(batch))
+                self.client.queue.clear()  # so they aren't posted with the next batch
+                return
+            # the client doesn't raise when segment.io refuses a batch, but it does count it
+            failed = self.client.stats.failed - failed_before
+            if failed:
+                logger.warning(u"segment.io didn't take {number} analytics events".format(
+                    number=failed))
+                self._count("failed", failed)
+            self._count("sent", len(batch) - failed)
+
+    def flush(self):
+        """ Sends everything still queued, on the calling thread """
+        while True:
+            batch = self._next_batch(0)
+            if not batch:
+                return
+            self.send(batch)
+
+
+# shared by everything in the process
+_sink = AnalyticsSink()
+atexit.register(_sink.flush)
+
+def track(user_id, event, properties={}, context={}):
+    return _sink.track(user_id, event, properties, context)
+
+def get_stats():
+    return _sink.stats()
@@ -1,5 +1,6 @@
 import datetime, shortuuid, os
 import analytics
+from totalimpact import analytics_sink
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import FlushError
 from sqlalchemy import and_
@@ -186,7 +187,7 @@ def register_item(alias, api_key, myredis, mydao):
     tiid = item.get_tiid_by_alias(namespace, nid, mydao)
     if not tiid:
         if is_over_quota(api_key):
-            analytics.track("CORE", "Raised Exception", {
+            analytics_sink.track("CORE", "Raised Exception", {
                 "exception class": "ApiLimitExceededException",
                 "api_key": api_key
                 })
@@ -195,7 +196,7 @@ def register_item(alias, api_key, myredis, mydao):
             tiid = item.create_item(namespace, nid, myredis, mydao)
             analytics.identify(api_key, {"name": api_key, 
                                         "api_user": True})
-            analytics.track(api_key, "Created item because of registration", {
+            analytics_sink.track(api_key, "Created item because of registration", {
                 "tiid": tiid,
                 "namespace": namespace,
                 "nid": nid,
@@ -1,59 +1,224 @@
 #!/usr/bin/env python
 
-import os, time, json, logging, threading, Queue, copy, sys, datetime
-from collections import defaultdict
+import os
+
+def use_gevent_engine():
+    """ Runs the worker pools as greenlets, with cooperative provider, redis and postgres I/O.
+
+    Idle greenlets cost a few KB, so providers can be given pools of hundreds or
+    thousands of workers.  Has to run before anything else imports socket or threading,
+    so it is run from the __main__ block below, which run_backend.py runs too.
+    """
+    global gevent_engine_in_use
+    from gevent import monkey
+    monkey.patch_all()
+    gevent_engine_in_use = True
+
+    import psycopg2
+    from psycopg2 import extensions
+    from gevent.socket import wait_read, wait_write
+
+    # lets other greenlets run while waiting on postgres, as in psycogreen
+    def gevent_wait_callback(conn, timeout=None):
+        while True:
+            state = conn.poll()
+            if state == extensions.POLL_OK:
+                break
+            elif state == extensions.POLL_READ:
+                wait_read(conn.fileno(), timeout=timeout)
+            elif state == extensions.POLL_WRITE:
+                wait_write(conn.fileno(), timeout=timeout)
+            else:
+                raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+
+    extensions.set_wait_callback(gevent_wait_callback)
+
+# BACKEND_ENGINE is "threads" (the default) or "gevent"
+ENGINE = os.getenv("BACKEND_ENGINE", "threads")
+gevent_engine_in_use = False
+if (__name__ == "__main__") and (ENGINE == "gevent"):
+    use_gevent_engine()
+
+import time, json, logging, threading, Queue, copy, sys, datetime, argparse, uuid
+from collections import OrderedDict
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm.exc import FlushError
 
 from totalimpact import tiredis, default_settings, db
+from totalimpact.cache import get_cache_stats
 from totalimpact import item as item_module
 from totalimpact.providers.provider import ProviderFactory, ProviderError
+from totalimpact.providers.provider import ProviderTimeout, ProviderServerError, ProviderRateLimitError, ProviderThrottledError
+from totalimpact.providers.provider import ProviderHttpError, get_http_session_stats, update_scope
 
 logger = logging.getLogger('ti.backend')
 logger.setLevel(logging.DEBUG)
 
-thread_count = defaultdict(dict)
+# errors that mean the provider is struggling, so we should back off.
+# ProviderThrottledError is our own rate limit, so it isn't one of them
+CONGESTION_ERRORS = (ProviderTimeout, ProviderServerError, ProviderRateLimitError)
+
+# errors that mean the provider is down, so we should stop calling it for a while
+CIRCUIT_ERRORS = (ProviderTimeout, ProviderServerError, ProviderRateLimitError, ProviderHttpError)
+
+# adaptive concurrency limits for the providers running in this process, by provider name
+concurrency_limits = {}
+
+# circuit breakers for the providers running in this process, by provider name
+circuit_breakers = {}
+
+# messages queued before update runs had ids, by a process that hasn't been redeployed yet,
+# are one field short; they still get served, just without sharing fetched pages
+def with_update_id(provider_message):
+    if len(provider_message) == 4:
+        return tuple(provider_message) + (None,)
+    return provider_message
+
+def alias_message_with_update_id(alias_message):
+    if len(alias_message) == 3:
+        return list(alias_message) + [uuid.uuid4().hex]
+    return alias_message
+
+class CircuitOpenError(Exception):
+    """ Raised by ProviderWorker.wrapper when a call fails and leaves the circuit open """
+    pass
 
 class RedisQueue(object):
-    def __init__(self, queue_name, myredis):
+    """ Reliable queue in a redis list.
+
+    Popped messages are moved to a processing list and stay there, claimed,
+    until the popping thread calls ack().  Claims older than visibility_timeout
+    are assumed to belong to a dead worker and are pushed back on the queue.
+    """
+
+    def __init__(self, queue_name, myredis, visibility_timeout=60*10, lane=tiredis.INTERACTIVE):
         self.queue_name = queue_name
         self.myredis = myredis
+        self.lane = lane
         self.name = queue_name + "_queue"
-
-    def push(self, message):
+        self.processing_name = queue_name + ":processing"
+        self.claims_name = queue_name + ":claims"
+        self.visibility_timeout = visibility_timeout
+        self.requeue_check_interval = min(60, visibility_timeout)
+        self.next_requeue_check = 0
+        self.local = threading.local()  # messages this thread has popped but not acked
+
+    def push(self, message, lane=None):
+        # a single lane, so lane is ignored
         message_json = json.dumps(message)
         logger.info(u"{:20}: /biblio_print >>>PUSHING to redis {message_json}".format(
             self.name, message_json=message_json))        
         self.myredis.lpush(self.queue_name, message_json)
 
-    def pop(self):
-        #blocking pop
+    def _unacked(self):
+        if not hasattr(self.local, "unacked"):
+            self.local.unacked = []
+        return self.local.unacked
+
+    def _claim(self, message_json):
         message = None
-        received = self.myredis.brpop([self.queue_name], timeout=5) #maybe timeout not necessary
-        if received:
-            queue, message_json = received
-            try:
-                logger.debug(u"{:20}: <<<POPPED from redis: starts {message_json}".format(
-                    self.name, message_json=message_json[0:50]))        
-                message = json.loads(message_json) 
-            except (TypeError, KeyError):
-                logger.info(u"{:20}: ERROR processing redis message {message_json}".format(
-                    self.name, message_json=message_json))
+        try:
+            logger.debug(u"{:20}: <<<POPPED from redis: starts {message_json}".format(
+                self.name, message_json=message_json[0:50]))        
+            message = json.loads(message_json) 
+        except (TypeError, KeyError, ValueError):
+            logger.info(u"{:20}: ERROR processing redis message {message_json}".format(
+                self.name, message_json=message_json))
+            # don't redeliver something we can't read
+            self.myredis.lrem(self.processing_name, message_json, 1)
+            return None
+        self.myredis.hset(self.claims_name, message_json, time.time())
         return message
 
+    def pop_with_receipt(self, timeout=5):
+        # returns (message, lane, receipt), for acking the message from any thread with ack_receipts
+        # blocks for up to timeout seconds; doesn't block if timeout is 0
+        if time.time() > self.next_requeue_check:
+            self.requeue_expired()
+        message = None
+        if timeout:
+            message_json = self.myredis.brpoplpush(self.queue_name, self.processing_name, timeout=timeout)
+        else:
+            message_json = self.myredis.rpoplpush(self.queue_name, self.processing_name)
+        if message_json:
+            message = self._claim(message_json)
+        if not message:
+            return (None, self.lane, None)
+        return (message, self.lane, message_json)
+
+    def pop(self, timeout=5):
+        (message, lane, receipt) = self.pop_with_receipt(timeout)
+        if message:
+            self._unacked().append(receipt)
+        return message
+
+    def pop_batch(self, max_messages):
+        # blocks for the first message, then takes whatever else is already waiting
+        messages = []
+        message = self.pop()
+        while message:
+            messages.append(message)
+            if len(messages) >= max_messages:
+                break
+            message = self.pop(timeout=0)
+        return messages
+
+    def current_lane(self):
+        return self.lane
+
+    def ack(self):
+        # acknowledges everything this thread has popped since its last ack
+        self.ack_receipts(self._unacked())
+        self.local.unacked = []
+
+    def leave_unacked(self):
+        # gives up on everything this thread has popped since its last ack, without acking it,
+        # so requeue_expired redelivers it once its claim expires
+        self.local.unacked = []
+
+    def ack_receipts(self, receipts):
+        if not receipts:
+            return
+        pipe = self.myredis.pipeline()
+        for message_json in receipts:
+            pipe.lrem(self.processing_name, message_json, 1)
+            pipe.hdel(self.claims_name, message_json)
+        pipe.execute()
+
+    def requeue_expired(self):
+        now = time.time()
+        self.next_requeue_check = now + self.requeue_check_interval
+        claims = self.myredis.hgetall(self.claims_name)
+        for message_json in self.myredis.lrange(self.processing_name, 0, -1):
+            claimed_at = claims.get(message_json)
+            if claimed_at is None:
+                # popped by a worker that died before it could record the claim
+                self.myredis.hsetnx(self.claims_name, message_json, now)
+            elif (now - float(claimed_at)) > self.visibility_timeout:
+                if self.myredis.lrem(self.processing_name, message_json, 1):
+                    # rpush so it is the next message popped
+                    self.myredis.rpush(self.queue_name, message_json)
+                    self.myredis.hdel(self.claims_name, message_json)
+                    logger.warning(u"{:20}: REQUEUED unacked message {message_json}".format(
+                        self.name, message_json=message_json[0:50]))
+
 
 class PythonQueue(object):
-    def __init__(self, queue_name):
+    def __init__(self, queue_name, lane=tiredis.INTERACTIVE):
         self.queue_name = queue_name
+        self.lane = lane
         self.queue = Queue.Queue()
 
-    def push(self, message):
+    def push(self, message, lane=None):
+        # a single lane, so lane is ignored
         self.queue.put(copy.deepcopy(message))
         #logger.info(u"{:20}: >>>PUSHED".format(
         #        self.queue_name))
 
-    def pop(self):
+    def pop(self, timeout=5):
         try:
-            # blocking pop
-            message = copy.deepcopy(self.queue.get(block=True, timeout=5)) #maybe timeout isn't necessary
+            # blocks for up to timeout seconds; doesn't block if timeout is 0
+            message = copy.deepcopy(self.queue.get(block=bool(timeout), timeout=timeout or None))
             self.queue.task_done()
             #logger.info(u"{:20}: <<<POPPED".format(
             #    self.queue_name))
@@ -61,11 +226,426 @@ class PythonQueue(object):
             message = None
         return message
 
+    def pop_with_receipt(self, timeout=5):
+        # in-process queue, so no receipt to ack
+        return (self.pop(timeout), self.lane, None)
+
+    def pop_batch(self, max_messages):
+        # blocks for the first message, then takes whatever else is already waiting
+        messages = []
+        message = self.pop()
+        while message:
+            messages.append(message)
+            if len(messages) >= max_messages:
+                break
+            try:
+                message = copy.deepcopy(self.queue.get_nowait())
+                self.queue.task_done()
+            except Queue.Empty:
+                message = None
+        return messages
+
+    def ack(self):
+        # in-process queue, nothing to redeliver
+        pass
+
+    def leave_unacked(self):
+        pass
+
+    def ack_receipts(self, receipts):
+        pass
+
+    def current_lane(self):
+        return self.lane
+
+
+class LanedQueue(object):
+    """ A queue with a lane per priority class, served with weighted fairness.
+
+    Of every sum(weights) pops, a lane with work waiting gets about its weight,
+    so interactive work doesn't wait behind bulk refreshes and bulk work still
+    moves.
+    """
+
+    def __init__(self, queue_name, lane_queues, weights=default_settings.PRIORITY_LANE_WEIGHTS):
+        self.queue_name = queue_name
+        self.lane_queues = lane_queues  # lane name: queue
+        self.weights = weights
+        # highest weight first, for ties and for blocking when everything is empty
+        self.lanes = sorted(lane_queues, key=lambda lane: weights.get(lane, 1), reverse=True)
+        self.credits = dict((lane, 0) for lane in self.lanes)
+        self.lock = threading.Lock()
+        self.local = threading.local()  # lane of the message this thread last popped, and what it hasn't acked
+
+    def push(self, message, lane=tiredis.INTERACTIVE):
+        self.lane_queues[lane].push(message)
+
+    def _lanes_in_turn(self):
+        # smooth weighted round robin: every lane earns its weight, the richest goes first
+        with self.lock:
+            for lane in self.lanes:
+                self.credits[lane] += self.weights.get(lane, 1)
+            return sorted(self.lanes, key=lambda lane: self.credits[lane], reverse=True)
+
+    def _served(self, lane):
+        with self.lock:
+            total_weight = sum([self.weights.get(each_lane, 1) for each_lane in self.lanes])
+            self.credits[lane] -= total_weight
+
+    def _empty(self, lane):
+        # start the schedule over, so an idle lane doesn't bank credit or leave the others in debt
+        with self.lock:
+            for each_lane in self.lanes:
+                self.credits[each_lane] = 0
+
+    def _unacked(self):
+        if not hasattr(self.local, "unacked"):
+            self.local.unacked = []
+        return self.local.unacked
+
+    def pop_with_receipt(self, timeout=5):
+        # returns (message, lane, receipt), for acking the message from any thread with ack_receipts
+        for lane in self._lanes_in_turn():
+            (message, lane, receipt) = self.lane_queues[lane].pop_with_receipt(timeout=0)
+            if message:
+                self._served(lane)
+                return (message, lane, (lane, receipt))
+            self._empty(lane)
+
+        if timeout:
+            # nothing waiting anywhere, so wait on the top lane, but not so long that the others stall
+            lane = self.lanes[0]
+            (message, lane, receipt) = self.lane_queues[lane].pop_with_receipt(timeout=min(timeout, 1))
+            if message:
+                return (message, lane, (lane, receipt))
+        return (None, None, None)
+
+    def pop(self, timeout=5):
+        (message, lane, receipt) = self.pop_with_receipt(timeout)
+        if message:
+            self.local.lane = lane
+            self._unacked().append(receipt)
+        return message
+
+    def pop_batch(self, max_messages):
+        # blocks for the first message, then takes whatever else is already waiting
+        messages = []
+        message = self.pop()
+        while message:
+            messages.append(message)
+            if len(messages) >= max_messages:
+                break
+            message = self.pop(timeout=0)
+        return messages
+
+    def ack(self):
+        self.ack_receipts(self._unacked())
+        self.local.unacked = []
+
+    def leave_unacked(self):
+        self.local.unacked = []
+
+    def ack_receipts(self, receipts):
+        for lane in self.lanes:
+            self.lane_queues[lane].ack_receipts(
+                [lane_receipt for (receipt_lane, lane_receipt) in receipts if receipt_lane == lane])
+
+    def current_lane(self):
+        return getattr(self.local, "lane", tiredis.INTERACTIVE)
+
+
+class FedQueue(object):
+    """ Local front for a shared queue, filled by a single popper thread.
+
+    A provider's pool threads take their messages from here, so only the popper
+    holds a redis connection blocked on the provider queue.  The local queue is
+    bounded, so the popper claims no more than the pool is about to work on
+    and the rest stay in redis for other backend processes.
+    """
+
+    def __init__(self, shared_queue, max_size):
+        self.shared_queue = shared_queue
+        self.queue_name = shared_queue.queue_name
+        self.local_queue = Queue.Queue(max_size)
+        self.local = threading.local()  # lane of the message this thread last popped, and what it hasn't acked
+
+    def start_popper(self, name):
+        t = threading.Thread(target=self.pop_forever, name=name)
+        t.daemon = True
+        t.start()
+
+    def pop_forever(self):
+        while True:
+            try:
+                (message, lane, receipt) = self.shared_queue.pop_with_receipt()
+            except Exception:
+                # keep the popper alive through a redis blip; unacked messages are redelivered
+                logger.exception(u"{:20}: couldn't pop from the shared queue".format(self.queue_name))
+                time.sleep(1)
+                continue
+            if message:
+                # waits here while the pool is busy
+                self.local_queue.put((message, lane, receipt))
+
+    def push(self, message, lane=tiredis.INTERACTIVE):
+        self.shared_queue.push(message, lane)
+
+    def _unacked(self):
+        if not hasattr(self.local, "unacked"):
+            self.local.unacked = []
+        return self.local.unacked
+
+    def pop(self, timeout=5):
+        # blocks for up to timeout seconds; doesn't block if timeout is 0
+        try:
+            (message, lane, receipt) = self.local_queue.get(block=bool(timeout), timeout=timeout or None)
+        except Queue.Empty:
+            return None
+        self.local.lane = lane
+        self._unacked().append(receipt)
+        return message
+
+    def ack(self):
+        self.shared_queue.ack_receipts(self._unacked())
+        self.local.unacked = []
+
+    def leave_unacked(self):
+        self.local.unacked = []
+
+    def current_lane(self):
+        return getattr(self.local, "lane", tiredis.INTERACTIVE)
+
+
+def laned_redis_queue(queue_name, myredis):
+    lane_queues = {}
+    for lane in tiredis.PRIORITY_LANES:
+        lane_queues[lane] = RedisQueue(tiredis.lane_queue_name(queue_name, lane), myredis, lane=lane)
+    return LanedQueue(queue_name, lane_queues)
+
+
+class AdaptiveConcurrencyLimit(object):
+    """ Additive-increase, multiplicative-decrease limit on a provider's concurrent calls.
+
+    Each clean call adds 1/limit, so the limit grows by about one per round of calls.
+    A timeout, server error, rate limit error or GET slower than latency_target
+    cuts the limit by decrease_factor, at most once per decrease_cooldown seconds
+    so one burst of failures only counts once.
+    """
+
+    def __init__(self, provider_name, max_limit, min_limit=1, latency_target=5.0,
+            decrease_factor=0.5, decrease_cooldown=5.0):
+        self.provider_name = provider_name
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.limit = float(max_limit)
+        self.last_decrease = 0
+        self.num_calls = 0
+        self.num_congested = 0
+        self.average_latency = None
+        self.lock = threading.Lock()
+
+    @property
+    def current(self):
+        return max(self.min_limit, int(self.limit))
+
+    def record(self, latency, error=None):
+        # latency is None for a call that sent no GETs, such as one answered from the cache
+        with self.lock:
+            self.num_calls += 1
+            if latency is None:
+                pass
+            elif self.average_latency is None:
+                self.average_latency = latency
+            else:
+                self.average_latency = 0.9*self.average_latency + 0.1*latency
+
+            if isinstance(error, CONGESTION_ERRORS) or (latency is not None and latency > self.latency_target):
+                self.num_congested += 1
+                now = time.time()
+                if (now - self.last_decrease) > self.decrease_cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+                    logger.info(u"{provider} congested, concurrency limit down to {limit}".format(
+                        provider=self.provider_name.upper(), limit=self.current))
+            elif not error:
+                self.limit = min(self.max_limit, self.limit + 1.0/self.limit)
+
+    def as_dict(self):
+        return {
+            "limit": self.current,
+            "max_limit": self.max_limit,
+            "num_calls": self.num_calls,
+            "num_congested": self.num_congested,
+            "average_latency": self.average_latency
+        }
+
+
+class ProviderSlots(object):
+    """ Holds a provider's concurrent calls, across all backend processes, to its adaptive limit.
+
+    Threads first wait on a local condition for one of the limit's slots, so
+    only as many threads as could run go to redis.  When other processes hold
+    the redis slots, a thread blocks until one of them is released instead of polling.
+    """
+
+    def __init__(self, provider_name, concurrency_limit, myredis, release_wait=5):
+        self.provider_name = provider_name
+        self.concurrency_limit = concurrency_limit
+        self.myredis = myredis
+        self.release_wait = release_wait  # seconds, so slots of dead processes are retried once expired
+        self.num_in_use = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.num_in_use >= self.concurrency_limit.current:
+                self.condition.wait()
+            self.num_in_use += 1
+        try:
+            slot = self.myredis.acquire_provider_slot(self.provider_name, self.concurrency_limit.current)
+            while not slot:
+                self.myredis.wait_for_provider_slot_release(self.provider_name, self.release_wait)
+                slot = self.myredis.acquire_provider_slot(self.provider_name, self.concurrency_limit.current)
+        except Exception:
+            self._release_local()
+            raise
+        return slot
+
+    def release(self, slot):
+        try:
+            self.myredis.release_provider_slot(self.provider_name, slot)
+        finally:
+            self._release_local()
+
+    def _release_local(self):
+        with self.condition:
+            self.num_in_use -= 1
+            # the limit may have grown, so let every waiter check again
+            self.condition.notify_all()
+
+
+class CircuitBreaker(object):
+    """ Stops calls to a provider after failure_threshold consecutive failures.
+
+    While open, calls are refused for reset_timeout seconds.  Then the circuit is
+    half-open: one probe call is let through, and closes the circuit if it works
+    or opens it again if it fails.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, provider_name, failure_threshold=5, reset_timeout=60):
+        self.provider_name = provider_name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.num_consecutive_failures = 0
+        self.opened_at = 0
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+        self.probe_done = threading.Condition(self.lock)
+
+    def seconds_until_retry(self):
+        # 0 unless the circuit is open and the reset timeout hasn't passed
+        if self.state != self.OPEN:
+            return 0
+        return max(0, self.opened_at + self.reset_timeout - time.time())
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if self.seconds_until_retry() > 0:
+                    return False
+                self.state = self.HALF_OPEN
+                self.probe_in_flight = False
+            # half open: only one probe at a time
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+            logger.info(u"{provider} circuit half open, sending probe".format(
+                provider=self.provider_name.upper()))
+            return True
+
+    def record(self, error=None):
+        if isinstance(error, ProviderThrottledError):
+            # never reached the provider, so says nothing about whether it is up
+            self.release_probe()
+            return
+        with self.lock:
+            if isinstance(error, CIRCUIT_ERRORS):
+                self.num_consecutive_failures += 1
+                if (self.state == self.HALF_OPEN) or (self.num_consecutive_failures >= self.failure_threshold):
+                    if self.state != self.OPEN:
+                        logger.warning(u"{provider} circuit OPEN after {num} consecutive failures".format(
+                            provider=self.provider_name.upper(), num=self.num_consecutive_failures))
+                    self.state = self.OPEN
+                    self.opened_at = time.time()
+                    self.probe_in_flight = False
+                    self.probe_done.notify_all()
+            else:
+                # any answer from the provider, even a not-found, means it is up
+                if self.state != self.CLOSED:
+                    logger.info(u"{provider} circuit closed".format(
+                        provider=self.provider_name.upper()))
+                self.state = self.CLOSED
+                self.num_consecutive_failures = 0
+                self.probe_in_flight = False
+                self.probe_done.notify_all()
+
+    def release_probe(self):
+        # the probe ended without telling us anything about the provider
+        with self.lock:
+            self.probe_in_flight = False
+            self.probe_done.notify_all()
+
+    def wait_for_probe(self, timeout):
+        # blocks while a half-open probe is in flight, for up to timeout seconds
+        with self.lock:
+            if self.probe_in_flight:
+                self.probe_done.wait(timeout)
+
+    @property
+    def is_open(self):
+        return self.state == self.OPEN
+
+    @property
+    def is_closed(self):
+        return self.state == self.CLOSED
+
+    def as_dict(self):
+        return {
+            "state": self.state,
+            "num_consecutive_failures": self.num_consecutive_failures,
+            "seconds_until_retry": self.seconds_until_retry()
+        }
+
 
 class Worker(object):
+    # seconds to back off after run() raises, doubling while it keeps raising
+    error_backoff = 1
+    max_error_backoff = 60
+
     def run_in_loop(self):
+        backoff = self.error_backoff
         while True:
-            self.run()
+            try:
+                self.run()
+            except Exception:
+                # keep this thread alive, and leave what it popped to be redelivered
+                # rather than acked along with the next thing it pops
+                logger.exception(u"{:20}: unexpected exception in {thread_name}, backing off {backoff}s".format(
+                    self.name, thread_name=threading.current_thread().name, backoff=backoff))
+                self.leave_unacked()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_error_backoff)
+            else:
+                backoff = self.error_backoff
 
     def spawn_and_loop(self):
         t = threading.Thread(target=self.run_in_loop, name=self.name+"_thread")
@@ -73,19 +653,47 @@ class Worker(object):
         t.start()    
 
 class ProviderWorker(Worker):
-    def __init__(self, provider, polling_interval, alias_queue, provider_queue, couch_queues, wrapper, myredis):
+    def __init__(self, provider, alias_queue, provider_queue, couch_queues, wrapper, myredis):
         self.provider = provider
         self.provider_name = provider.provider_name
-        self.polling_interval = polling_interval 
         self.provider_queue = provider_queue
         self.alias_queue = alias_queue
         self.couch_queues = couch_queues
         self.wrapper = wrapper
         self.myredis = myredis
+        self.wait_interval = 0.1
+        self.stats_interval = 5  # seconds between publishing concurrency stats
+        self.next_stats_publish = 0
         self.name = self.provider_name+"_worker"
+        self.concurrency_limit = concurrency_limits.setdefault(self.provider_name, 
+            AdaptiveConcurrencyLimit(self.provider_name, 
+                provider.max_simultaneous_requests, 
+                latency_target=provider.latency_target))
+        self.circuit_breaker = circuit_breakers.setdefault(self.provider_name,
+            CircuitBreaker(self.provider_name, 
+                failure_threshold=provider.circuit_failure_threshold, 
+                reset_timeout=provider.circuit_reset_timeout))
+        # the pool caps this process; the slots cap all backend processes together,
+        # at whatever the adaptive limit currently allows
+        self.slots = ProviderSlots(self.provider_name, self.concurrency_limit, myredis)
+        self.local = threading.local()  # lanes of the messages this thread is working on
+
+    def lane_for(self, tiid, method_name):
+        # results go on in the same priority lane their message came from
+        lanes = getattr(self.local, "lanes", {})
+        return lanes.get((tiid, method_name), tiredis.INTERACTIVE)
+
+    def pop_message(self, timeout=5):
+        # a batch can mix lanes, so the lane is kept for each message
+        provider_message = self.provider_queue.pop(timeout=timeout)
+        if provider_message:
+            provider_message = with_update_id(provider_message)
+            (tiid, alias_dict, method_name, aliases_providers_run, update_id) = provider_message
+            self.local.lanes[(tiid, method_name)] = self.provider_queue.current_lane()
+        return provider_message
 
-    # last variable is an artifact so it has same call signature as other callbacks
-    def add_to_couch_queue_if_nonzero(self, tiid, new_content, method_name, dummy=None):
+    # last variables are an artifact so it has same call signature as other callbacks
+    def add_to_couch_queue_if_nonzero(self, tiid, new_content, method_name, dummy=None, dummy_update_id=None):
         logger.info(u"In add_to_couch_queue_if_nonzero with {tiid}, {method_name}, {provider_name}".format(
            method_name=method_name, tiid=tiid, provider_name=self.provider_name))
 
@@ -101,24 +709,24 @@ class ProviderWorker(Worker):
             couch_message = (tiid, new_content, method_name, self.provider_name)
             couch_queue_index = tiid[0] #index them by the first letter in the tiid
             selected_couch_queue = self.couch_queues[couch_queue_index] 
-            selected_couch_queue.push(couch_message)
+            selected_couch_queue.push(couch_message, self.lane_for(tiid, method_name))
 
 
-    def add_to_alias_and_couch_queues(self, tiid, alias_dict, method_name, aliases_providers_run):
+    def add_to_alias_and_couch_queues(self, tiid, alias_dict, method_name, aliases_providers_run, update_id):
         logger.info(u"Adding to alias queue {alias_dict} {method_name} from {tiid} for {provider_name}".format(
             alias_dict=alias_dict, 
             method_name=method_name, 
             tiid=tiid, 
             provider_name=self.provider_name))     
         self.add_to_couch_queue_if_nonzero(tiid, alias_dict, method_name)
-        alias_message = [tiid, alias_dict, aliases_providers_run]
+        alias_message = [tiid, alias_dict, aliases_providers_run, update_id]
         logger.info(u"NOW PUSHING to alias_queue from {method_name} from {tiid} for {provider_name}".format(
             method_name=method_name, tiid=tiid, provider_name=self.provider_name))     
-        self.alias_queue.push(alias_message)
+        self.alias_queue.push(alias_message, self.lane_for(tiid, method_name))
 
 
     @classmethod
-    def wrapper(cls, tiid, input_aliases_dict, provider, method_name, aliases_providers_run, callback):
+    def wrapper(cls, tiid, input_aliases_dict, provider, method_name, aliases_providers_run, callback, update_id=None):
         #logger.info(u"{:20}: **Starting {tiid} {provider_name} {method_name} with {aliases}".format(
         #    "wrapper", tiid=tiid, provider_name=provider.provider_name, method_name=method_name, aliases=aliases))
 
@@ -128,13 +736,23 @@ class ProviderWorker(Worker):
         input_alias_tuples = item_module.alias_tuples_from_dict(input_aliases_dict)
         method = getattr(provider, method_name)
 
+        start_time = time.time()
+        get_latencies = []
+        error = None
         try:
-            method_response = method(input_alias_tuples)
-        except ProviderError:
+            with update_scope(update_id, start_time + provider.item_deadline, get_latencies):
+                method_response = method(input_alias_tuples)
+        except ProviderError, e:
             method_response = None
+            error = e
             logger.info(u"{:20}: **ProviderError {tiid} {method_name} {provider_name} ".format(
                 worker_name, tiid=tiid, provider_name=provider_name.upper(), method_name=method_name.upper()))
 
+        cls.record_call(provider_name, get_latencies, error)
+        if isinstance(error, ProviderThrottledError):
+            # our own rate limit kept us waiting too long; let the caller defer this rather than lose it
+            raise error
+
         if method_name == "aliases":
             # update aliases to include the old ones too
             aliases_providers_run += [provider_name]
@@ -151,89 +769,233 @@ class ProviderWorker(Worker):
             worker_name, tiid=tiid, method_name=method_name.upper(), 
             provider_name=provider_name.upper(), response=response))
 
-        callback(tiid, response, method_name, aliases_providers_run)
-
-        try:
-            del thread_count[provider_name][tiid+method_name]
-        except KeyError:  # thread isn't there when we call wrapper in unit tests
-            pass
+        callback(tiid, response, method_name, aliases_providers_run, update_id)
 
         return response
 
-    def run(self):
-        num_active_threads_for_this_provider = len(thread_count[self.provider.provider_name])
+    @classmethod
+    def batch_wrapper(cls, provider_messages, provider, callback):
+        # gets metrics for many metrics messages in one provider call
+        provider_name = provider.provider_name
+        worker_name = provider_name+"_worker"
 
-        if num_active_threads_for_this_provider >= self.provider.max_simultaneous_requests:
-            logger.info(u"{provider} has {num_provider} threads, so not spawning another yet".format(
-                num_provider=num_active_threads_for_this_provider, provider=self.provider.provider_name.upper()))
-            time.sleep(self.polling_interval) # let the provider catch up
-            return
+        list_of_alias_tuples = [item_module.alias_tuples_from_dict(input_aliases_dict) 
+            for (tiid, input_aliases_dict, method_name, aliases_providers_run, update_id) in provider_messages]
 
-        provider_message = self.provider_queue.pop()
-        if provider_message:
-            #logger.info(u"POPPED from queue for {provider}".format(
-            #    provider=self.provider_name))
-            (tiid, alias_dict, method_name, aliases_providers_run) = provider_message
+        get_latencies = []
+        error = None
+        try:
+            with update_scope(None, get_latencies=get_latencies):
+                responses = provider.metrics_batch(list_of_alias_tuples)
+        except ProviderError, e:
+            responses = [None for provider_message in provider_messages]
+            error = e
+            logger.info(u"{:20}: **ProviderError on batch of {num} METRICS {provider_name} ".format(
+                worker_name, num=len(provider_messages), provider_name=provider_name.upper()))
 
-            if (method_name == "metrics") and self.provider.provides_metrics:
-                self.myredis.set_provider_started(tiid, self.provider.provider_name)
+        cls.record_call(provider_name, get_latencies, error)
+        if isinstance(error, ProviderThrottledError):
+            raise error
 
-            if method_name == "aliases":
-                callback = self.add_to_alias_and_couch_queues
-                logger.info(u"BEFORE STARTING thread for {tiid} with callback ADD_TO_ALIAS_AND_COUCH_QUEUES, {method_name} {provider}".format(
-                   method_name=method_name.upper(), tiid=tiid, num=len(thread_count[self.provider.provider_name].keys()),
-                   provider=self.provider.provider_name.upper()))
-            else:
-                callback = self.add_to_couch_queue_if_nonzero
-                logger.info(u"BEFORE STARTING thread for {tiid} with callback ADD_TO_COUCH_QUEUE, {method_name} {provider}".format(
-                   method_name=method_name.upper(), tiid=tiid, num=len(thread_count[self.provider.provider_name].keys()),
-                   provider=self.provider.provider_name.upper()))
+        logger.info(u"{:20}: RETURNED batch of {num} METRICS {provider_name}".format(
+            worker_name, num=len(provider_messages), provider_name=provider_name.upper()))
 
-            #logger.info(u"BEFORE STARTING thread for {tiid} {method_name} {provider}".format(
-            #    method_name=method_name.upper(), tiid=tiid, num=len(thread_count[self.provider.provider_name].keys()),
-            #    provider=self.provider.provider_name.upper()))
+        for (provider_message, response) in zip(provider_messages, responses):
+            (tiid, input_aliases_dict, method_name, aliases_providers_run, update_id) = provider_message
+            callback(tiid, response, method_name, aliases_providers_run, update_id)
 
-            thread_count[self.provider.provider_name][tiid+method_name] = 1
+        return responses
 
-            logger.info(u"{num_total} total threads, {num_provider} threads for {provider}".format(
-                num_provider=num_active_threads_for_this_provider,
-                num_total=threading.active_count(),
-                provider=self.provider.provider_name.upper()))
+    @classmethod
+    def record_call(cls, provider_name, get_latencies, error):
+        if provider_name in concurrency_limits:
+            # the slowest GET, so time spent waiting on our own rate limit or between retries isn't congestion
+            latency = max(get_latencies) if get_latencies else None
+            concurrency_limits[provider_name].record(latency, error)
+
+        if provider_name in circuit_breakers:
+            circuit_breakers[provider_name].record(error)
+            if circuit_breakers[provider_name].is_open:
+                # the provider is down, so don't record an empty answer; let the caller defer this
+                raise CircuitOpenError(u"{provider_name} circuit open".format(provider_name=provider_name))
 
-            t = threading.Thread(target=ProviderWorker.wrapper, 
-                args=(tiid, alias_dict, self.provider, method_name, aliases_providers_run, callback), 
-                name=self.provider_name+"-"+method_name.upper()+"-"+tiid[0:4])
+    def spawn_and_loop(self):
+        # one thread pops the provider queue and hands messages to a fixed pool of long-lived threads
+        feed_size = self.provider.max_simultaneous_requests
+        if self.provider.provides_metrics_batch:
+            feed_size = max(feed_size, self.provider.max_batch_size)
+        self.provider_queue = FedQueue(self.provider_queue, feed_size)
+        self.provider_queue.start_popper(self.name+"_popper")
+
+        for i in range(self.provider.max_simultaneous_requests):
+            t = threading.Thread(target=self.run_in_loop, name=self.name+"_thread_"+str(i))
+            t.daemon = True
             t.start()
+        logger.info(u"launched {num} worker threads for {provider}".format(
+            num=self.provider.max_simultaneous_requests, provider=self.provider_name.upper()))
+
+    def leave_unacked(self):
+        self.provider_queue.leave_unacked()
+
+    def publish_concurrency_stats(self):
+        if time.time() > self.next_stats_publish:
+            self.next_stats_publish = time.time() + self.stats_interval
+            stats = self.concurrency_limit.as_dict()
+            stats["http_connections"] = get_http_session_stats(self.provider_name)
+            self.myredis.set_provider_concurrency_stats(self.provider_name, stats)
+            # the response caches are shared by the whole process
+            self.myredis.set_cache_stats("{pid}".format(pid=os.getpid()), get_cache_stats())
+
+    def defer(self, provider_message, reason="circuit open"):
+        # back on the queue to try again once the provider is up, or our rate limit allows
+        (tiid, alias_dict, method_name, aliases_providers_run, update_id) = provider_message
+        logger.info(u"{:20}: DEFERRING {tiid} {method_name}, {provider} {reason}".format(
+            self.name, tiid=tiid, method_name=method_name.upper(), 
+            provider=self.provider_name.upper(), reason=reason))
+        self.provider_queue.push(provider_message, self.lane_for(tiid, method_name))
+
+    def pop_more_for_batch(self):
+        # waits up to the provider's batch window for more messages, up to its batch size
+        provider_messages = []
+        deadline = time.time() + self.provider.batch_window
+        while len(provider_messages) < (self.provider.max_batch_size - 1):
+            provider_message = self.pop_message(timeout=0)
+            if provider_message:
+                provider_messages.append(provider_message)
+            elif time.time() < deadline:
+                time.sleep(self.wait_interval)
+            else:
+                break
+        return provider_messages
+
+    def call_provider(self, provider_messages, call):
+        # runs call() in a provider slot; returns False if the messages were deferred
+        slot = self.slots.acquire()
+        logger.info(u"STARTING {num} messages for {provider} in {thread_name}".format(
+           num=len(provider_messages), 
+           provider=self.provider_name.upper(), thread_name=threading.current_thread().name))
+        try:
+            call()
+        except CircuitOpenError:
+            for provider_message in provider_messages:
+                self.defer(provider_message)
+            return False
+        except ProviderThrottledError:
+            for provider_message in provider_messages:
+                self.defer(provider_message, "rate limited")
+            return False
+        except Exception:
+            self.circuit_breaker.release_probe()
+            # keep this pool thread alive for the next message
+            logger.exception(u"{:20}: unexpected exception on {tiids}".format(
+                self.name, tiids=[provider_message[0] for provider_message in provider_messages]))
+        finally:
+            self.slots.release(slot)
+        return True
+
+    def run_message(self, provider_message):
+        (tiid, alias_dict, method_name, aliases_providers_run, update_id) = provider_message
+        if method_name == "aliases":
+            callback = self.add_to_alias_and_couch_queues
+        else:
+            callback = self.add_to_couch_queue_if_nonzero
+
+        return self.call_provider([provider_message], 
+            lambda: self.wrapper(tiid, alias_dict, self.provider, method_name, aliases_providers_run, callback, update_id))
+
+    def run_metrics_batch(self, provider_messages):
+        return self.call_provider(provider_messages, 
+            lambda: self.batch_wrapper(provider_messages, self.provider, self.add_to_couch_queue_if_nonzero))
+
+    def run(self):
+        # while the circuit is open, leave the work in the queue
+        wait = self.circuit_breaker.seconds_until_retry()
+        if wait:
+            time.sleep(min(wait, 1))
             return
+        # while half open, the probe's answer decides whether anything else goes,
+        # so wait for it rather than pop messages only to push them back
+        if self.circuit_breaker.probe_in_flight:
+            self.circuit_breaker.wait_for_probe(1)
+            return
+
+        self.local.lanes = {}
+        provider_message = self.pop_message()
+        if provider_message:
+            #logger.info(u"POPPED from queue for {provider}".format(
+            #    provider=self.provider_name))
+
+            provider_messages = [provider_message]
+            # no batching unless the circuit is closed, so a half-open probe is one message
+            if self.provider.provides_metrics_batch and (provider_message[2] == "metrics") and self.circuit_breaker.is_closed:
+                provider_messages += self.pop_more_for_batch()
+
+            metrics_batch = []
+            other_messages = []
+            for provider_message in provider_messages:
+                (tiid, alias_dict, method_name, aliases_providers_run, update_id) = provider_message
+                if (method_name == "metrics") and self.provider.provides_metrics:
+                    self.myredis.set_provider_started(tiid, self.provider.provider_name)
+                if (method_name == "metrics") and self.provider.provides_metrics_batch:
+                    metrics_batch.append(provider_message)
+                else:
+                    other_messages.append(provider_message)
+
+            # every provider call asks the circuit breaker, so a half-open circuit sends just one probe
+            done_messages = []
+            deferred_messages = []
+            if metrics_batch:
+                if not self.circuit_breaker.allow_request():
+                    deferred_messages += metrics_batch
+                elif self.run_metrics_batch(metrics_batch):
+                    done_messages += metrics_batch
+            for provider_message in other_messages:
+                if not self.circuit_breaker.allow_request():
+                    deferred_messages.append(provider_message)
+                elif self.run_message(provider_message):
+                    done_messages.append(provider_message)
+            for provider_message in deferred_messages:
+                self.defer(provider_message)
+
+            # done, so the next request for these runs starts a new one
+            for (tiid, alias_dict, method_name, aliases_providers_run, update_id) in done_messages:
+                self.myredis.release_provider_run(tiid, method_name, self.provider_name)
+            self.provider_queue.ack()
+            self.publish_concurrency_stats()
+            if deferred_messages:
+                # wait for the probe, rather than popping the deferred messages straight back
+                time.sleep(self.wait_interval)
+        return
 
 
 class CouchWorker(Worker):
-    def __init__(self, couch_queue, myredis, mydao):
+    def __init__(self, couch_queue, myredis, mydao, max_batch_size=50):
         self.couch_queue = couch_queue
         self.myredis = myredis
         self.mydao = mydao
+        self.max_batch_size = max_batch_size
         self.name = self.couch_queue.queue_name + "_worker"
 
     @classmethod
-    def update_item_with_new_aliases(cls, alias_dict, item_doc):
+    def update_item_with_new_aliases(cls, alias_dict, item_doc, commit=True):
         if alias_dict == item_doc["aliases"]:
             item_doc = None
         else:
-            item_obj = item_module.add_aliases_to_item_object(alias_dict, item_doc)
+            item_obj = item_module.add_aliases_to_item_object(alias_dict, item_doc, commit)
 
             merged_aliases = item_module.merge_alias_dicts(alias_dict, item_doc["aliases"])
             item_doc["aliases"] = merged_aliases
         return(item_doc)
 
     @classmethod
-    def update_item_with_new_biblio(cls, new_biblio_dict, item_doc):
+    def update_item_with_new_biblio(cls, new_biblio_dict, item_doc, commit=True):
         # return None if no changes
         # don't change if biblio already there
 
         response = item_module.get_biblio_to_update(item_doc["biblio"], new_biblio_dict)
         if response:
             item_doc["biblio"] = response
-            item_obj = item_module.add_biblio_to_item_object(new_biblio_dict, item_doc)
+            item_obj = item_module.add_biblio_to_item_object(new_biblio_dict, item_doc, commit)
         else:
             item_doc = None
 
@@ -241,52 +1003,111 @@ class CouchWorker(Worker):
 
 
     @classmethod
-    def update_item_with_new_metrics(cls, metric_name, metrics_method_response, item_doc):
+    def update_item_with_new_metrics(cls, metric_name, metrics_method_response, item_doc, commit=True):
         item_doc = item_module.add_metrics_data(metric_name, metrics_method_response, item_doc)
-        item_obj = item_module.add_metric_to_item_object(metric_name, metrics_method_response, item_doc)
+        metric_obj = item_module.add_metric_to_item_object(metric_name, metrics_method_response, item_doc, commit)
         return(item_doc)        
 
 
-    def run(self):
-        couch_message = self.couch_queue.pop()
-        if couch_message:
-            (tiid, new_content, method_name, provider_name) = couch_message
+    def add_messages_to_session(self, item_obj, couch_messages):
+        # adds everything for this item to the session without committing
+        item = item_obj.as_old_doc()
+        item_was_updated = False
+        for (tiid, new_content, method_name, provider_name) in couch_messages:
             if not new_content:
                 logger.info(u"{:20}: blank doc, nothing to save".format(
                     self.name))
+                continue
+
+            if method_name=="aliases":
+                updated_item = self.update_item_with_new_aliases(new_content, item, commit=False)
+            elif method_name=="biblio":
+                updated_item = self.update_item_with_new_biblio(new_content, item, commit=False)
+            elif method_name=="metrics":
+                updated_item = item
+                for metric_name in new_content:
+                    updated_item = self.update_item_with_new_metrics(metric_name, new_content[metric_name], updated_item, commit=False)
             else:
-                # don't need it with metrics for this purpose
-                item_obj = item_module.Item.query.get(tiid)
-                item = item_obj.as_old_doc()
-
-                if not item:
-                    if method_name=="metrics":
-                        self.myredis.set_provider_finished(tiid, provider_name)
-                    logger.error(u"Empty item from couch for tiid {tiid}, can't save {method_name}".format(
-                        tiid=tiid, method_name=method_name))
-                    return
-                if method_name=="aliases":
-                    updated_item = self.update_item_with_new_aliases(new_content, item)
-                elif method_name=="biblio":
-                    updated_item = self.update_item_with_new_biblio(new_content, item)
-                elif method_name=="metrics":
-                    updated_item = item
-                    for metric_name in new_content:
-                        updated_item = self.update_item_with_new_metrics(metric_name, new_content[metric_name], updated_item)
-                else:
-                    logger.warning(u"ack, supposed to save something i don't know about: " + str(new_content))
-                    updated_item = None
+                logger.warning(u"ack, supposed to save something i don't know about: " + str(new_content))
+                updated_item = None
+
+            if updated_item:
+                logger.info(u"{:20}: added {method_name} from {provider_name} for item {tiid}".format(
+                    self.name, method_name=method_name, provider_name=provider_name, tiid=tiid))
+                item_was_updated = True
+
+        # now that is has been updated it, change last_modified
+        if item_was_updated:
+            item_obj.last_modified = datetime.datetime.utcnow()
+            db.session.merge(item_obj)
+
+
+    def add_batch_to_session(self, messages_by_tiid):
+        # one query for all the items rather than one per tiid
+        # don't need metrics for this purpose, so don't load them
+        item_objs = item_module.Item.query.filter(item_module.Item.tiid.in_(messages_by_tiid.keys())).all()
+        item_objs_by_tiid = dict([(item_obj.tiid, item_obj) for item_obj in item_objs])
+
+        # nothing is flushed until the commit, so a bad row fails there, where it is caught
+        with db.session.no_autoflush:
+            for tiid in messages_by_tiid:
+                if tiid not in item_objs_by_tiid:
+                    logger.error(u"Empty item from db for tiid {tiid}, can't save {num} messages".format(
+                        tiid=tiid, num=len(messages_by_tiid[tiid])))
+                    continue
+                self.add_messages_to_session(item_objs_by_tiid[tiid], messages_by_tiid[tiid])
+
+
+    def save_couch_messages(self, couch_messages):
+        messages_by_tiid = OrderedDict()
+        for couch_message in couch_messages:
+            tiid = couch_message[0]
+            messages_by_tiid.setdefault(tiid, []).append(couch_message)
 
-                # now that is has been updated it, change last_modified and save
-                if updated_item:
-                    updated_item["last_modified"] = datetime.datetime.utcnow().isoformat()
-                    logger.info(u"{:20}: added {method_name}, saving item {tiid}".format(
-                        self.name, method_name=method_name, tiid=tiid))
-                    db.session.merge(item_obj)
+        try:
+            self.add_batch_to_session(messages_by_tiid)
+            db.session.commit()
+            logger.info(u"{:20}: saved {num_messages} messages for {num_tiids} items in one commit".format(
+                self.name, num_messages=len(couch_messages), num_tiids=len(messages_by_tiid)))
+        except (IntegrityError, FlushError) as e:
+            db.session.rollback()
+            logger.warning(u"{:20}: Fails Integrity check on batch commit, saving items one by one.  Message: {message}".format(
+                self.name, message=e.message)) 
+            # so one bad row doesn't lose the rest of the batch
+            for tiid in messages_by_tiid:
+                try:
+                    self.add_batch_to_session({tiid: messages_by_tiid[tiid]})
+                    db.session.commit()
+                except (IntegrityError, FlushError) as e:
+                    db.session.rollback()
+                    logger.warning(u"Fails Integrity check in save_couch_messages for {tiid}, rolling back.  Message: {message}".format(
+                        tiid=tiid, message=e.message)) 
+
+
+    def leave_unacked(self):
+        self.couch_queue.leave_unacked()
 
-                if method_name=="metrics":
-                    self.myredis.set_provider_finished(tiid, provider_name) # have to do this after the item save
+    def run(self):
+        couch_messages = self.couch_queue.pop_batch(self.max_batch_size)
+        if couch_messages:
+            try:
+                self.save_couch_messages(couch_messages)
+            except SQLAlchemyError:
+                # the database is down or broken, not just a bad row, so nothing was saved:
+                # leave the batch claimed, for the visibility timeout to redeliver, and keep this writer going
+                db.session.rollback()
                 db.session.remove()
+                self.couch_queue.leave_unacked()
+                logger.exception(u"{:20}: couldn't save {num} messages for {tiids}, leaving them to be redelivered".format(
+                    self.name, num=len(couch_messages), tiids=[couch_message[0] for couch_message in couch_messages]))
+                return
+
+            # have to do this after the item save
+            for (tiid, new_content, method_name, provider_name) in couch_messages:
+                if method_name=="metrics":
+                    self.myredis.set_provider_finished(tiid, provider_name)
+            db.session.remove()
+            self.couch_queue.ack()
         else:
             #time.sleep(0.1)  # is this necessary?
             pass
@@ -344,12 +1165,16 @@ class Backend(Worker):
             "biblio":biblio_providers,
             "metrics":metrics_providers})
 
+    def leave_unacked(self):
+        self.alias_queue.leave_unacked()
+
     def run(self):
         alias_message = self.alias_queue.pop()
         if alias_message:
             logger.info(u"/biblio_print, ALIAS_MESSAGE said {alias_message}".format(
                alias_message=alias_message))            
-            (tiid, alias_dict, aliases_providers_run) = alias_message
+            (tiid, alias_dict, aliases_providers_run, update_id) = alias_message_with_update_id(alias_message)
+            lane = self.alias_queue.current_lane()
 
             relevant_provider_names = self.sniffer(alias_dict, aliases_providers_run)
             #logger.info(u"/biblio_print, backend for {tiid} sniffer got input {alias_dict}".format(
@@ -360,45 +1185,74 @@ class Backend(Worker):
             # list out the method names so they are run in that priority, biblio before metrics
             for method_name in ["aliases", "biblio", "metrics"]:
                 for provider_name in relevant_provider_names[method_name]:
-
-                    provider_message = (tiid, alias_dict, method_name, aliases_providers_run)
-                    self.provider_queues[provider_name].push(provider_message)
+                    if not self.myredis.claim_provider_run(tiid, method_name, provider_name, lane):
+                        logger.info(u"{tiid} {method_name} {provider_name} already queued or running, not queueing again".format(
+                            tiid=tiid, method_name=method_name.upper(), provider_name=provider_name.upper()))
+                        continue
+
+                    provider_message = (tiid, alias_dict, method_name, aliases_providers_run, update_id)
+                    self.provider_queues[provider_name].push(provider_message, lane)
+            self.alias_queue.ack()
         else:
             #time.sleep(0.1)  # is this necessary?
             pass
 
 
 
-def main():
+# tiids are random strings over this alphabet, so their first character is a uniform hash.
+# This needs to match the tiid alphabet defined in item.make
+TIID_ALPHABET = "abcdefghijklmnopqrstuvwxyz1234567890"
+ALL_STAGES = ["sniffer", "providers", "couch"]
+
+def couch_partition_keys(partition, num_partitions):
+    return [key for (index, key) in enumerate(TIID_ALPHABET) if (index % num_partitions) == partition]
+
+
+def main(stages=ALL_STAGES, provider_names=None, partition=0, num_partitions=1):
+    """ Runs some or all of the backend stages in this process.
+
+    Every queue lives in redis, so any number of processes can run each stage.
+    Couch writers own disjoint partitions of the tiid space so two processes
+    never write the same item; provider concurrency limits are held in redis.
+    """
+
+    if (ENGINE == "gevent") and not gevent_engine_in_use:
+        # too late to patch here, since threading and socket are already imported
+        raise RuntimeError("BACKEND_ENGINE is gevent but this process isn't monkey patched; "
+            "start it with run_backend.py or totalimpact/backend.py")
 
     mydao = None
+    logger.info(u"running backend stages {stages} with the {engine} engine".format(
+        stages=stages, engine=ENGINE))
 
     myredis = tiredis.from_url(os.getenv("REDISTOGO_URL"))
-    alias_queue = RedisQueue("aliasqueue", myredis)
+    alias_queue = laned_redis_queue("aliasqueue", myredis)
     # to clear alias_queue:
     #import redis, os
     #myredis = redis.from_url(os.getenv("REDISTOGO_URL"))
     #myredis.delete(["aliasqueue"])
 
-
-    # these need to match the tiid alphabet defined in models:
     couch_queues = {}
-    for i in "abcdefghijklmnopqrstuvwxyz1234567890":
-        couch_queues[i] = PythonQueue(i+"_couch_queue")
-        couch_worker = CouchWorker(couch_queues[i], myredis, mydao)
-        couch_worker.spawn_and_loop() 
-        logger.info(u"launched backend couch worker with {i}_couch_queue".format(
-            i=i))
+    for i in TIID_ALPHABET:
+        couch_queues[i] = laned_redis_queue("couchqueue:"+i, myredis)
 
+    if "couch" in stages:
+        for i in couch_partition_keys(partition, num_partitions):
+            couch_worker = CouchWorker(couch_queues[i], myredis, mydao)
+            couch_worker.spawn_and_loop() 
+            logger.info(u"launched backend couch worker with {i}_couch_queue".format(
+                i=i))
 
-    polling_interval = 0.1   # how many seconds between polling to talk to provider
     provider_queues = {}
     providers = ProviderFactory.get_providers(default_settings.PROVIDERS)
     for provider in providers:
-        provider_queues[provider.provider_name] = PythonQueue(provider.provider_name+"_queue")
+        provider_queues[provider.provider_name] = laned_redis_queue("providerqueue:"+provider.provider_name, myredis)
+        if "providers" not in stages:
+            continue
+        if provider_names and (provider.provider_name not in provider_names):
+            continue
         provider_worker = ProviderWorker(
             provider, 
-            polling_interval, 
             alias_queue,
             provider_queues[provider.provider_name], 
             couch_queues,
@@ -408,10 +1262,26 @@ def main():
 
     backend = Backend(alias_queue, provider_queues, couch_queues, myredis)
     try:
-        backend.run_in_loop() # don't need to spawn this one
+        if "sniffer" in stages:
+            backend.run_in_loop() # don't need to spawn this one
+        else:
+            while True:
+                time.sleep(60)  # the worker threads are daemons, so keep the process alive
     except (KeyboardInterrupt, SystemExit): 
         # this approach is per http://stackoverflow.com/questions/2564137/python-how-to-terminate-a-thread-when-main-program-ends
         sys.exit()
  
 if __name__ == "__main__":
-    main()
+
+    # get args from the command line:
+    parser = argparse.ArgumentParser(description="Run the backend, or some of its stages, from the command line",
+        epilog="Set BACKEND_ENGINE=gevent to run the worker pools as greenlets with cooperative I/O.")
+    parser.add_argument('--stages', default=",".join(ALL_STAGES), type=str, help="Comma-separated stages to run in this process: sniffer, providers, couch.")
+    parser.add_argument('--providers', default=None, type=str, help="Comma-separated provider names for the providers stage; default all.")
+    parser.add_argument('--partition', default=0, type=int, help="Which tiid partition this process's couch stage writes.")
+    parser.add_argument('--num_partitions', default=1, type=int, help="How many couch processes split the tiid space.")
+    args = vars(parser.parse_args())
+    provider_names = None
+    if args["providers"]:
+        provider_names = args["providers"].split(",")
+    main(args["stages"].split(","), provider_names, args["partition"], args["num_partitions"])
@@ -1,12 +1,17 @@
 import os
-import sys
+import time
+import threading
 import pylibmc
 import hashlib
 import logging
 import json
+import zlib
+import cPickle
+from collections import OrderedDict
 from cPickle import PicklingError
 
 from totalimpact.utils import Retry
+from totalimpact import default_settings
 
 # set up logging
 logger = logging.getLogger("ti.cache")
@@ -14,64 +19,217 @@ logger = logging.getLogger("ti.cache")
 class CacheException(Exception):
     pass
 
+#memcached will only store things up to 1MB as per http://sendapatch.se/projects/pylibmc/misc.html
+# so leave room for the key and item overhead, and split anything bigger into chunks
+MAX_CHUNK_SIZE = 1000*1000 - 10*1000
+MAX_CHUNKS = 20
+
+def _compress(data):
+    return zlib.compress(cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL))
+
+def _decompress(payload):
+    return cPickle.loads(zlib.decompress(payload))
+
+def _split_chunks(payload, chunk_size=MAX_CHUNK_SIZE):
+    return [payload[i:i+chunk_size] for i in range(0, len(payload), chunk_size)]
+
+class LocalCache(object):
+    """ Bounded, thread-safe LRU cache with a max age, for one process """
+
+    def __init__(self, max_entries, max_age):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = OrderedDict()  # key: (expires, value), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                (expires, value) = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.time():
+                self.misses += 1
+                return None
+            self.entries[key] = (expires, value)  # now the most recently used
+            self.hits += 1
+            return value
+
+    def set(self, key, value, max_age=None):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + min(max_age or self.max_age, self.max_age), value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries)
+            }
+
+
+# shared by every Cache in the process
+_local_cache = LocalCache(default_settings.LOCAL_CACHE_MAX_ENTRIES, default_settings.LOCAL_CACHE_MAX_AGE)
+_memcached_pool = None
+_memcached_pool_lock = threading.Lock()
+_memcached_stats = {"hits": 0, "misses": 0, "revalidated": 0}
+_memcached_stats_lock = threading.Lock()
+
+def _get_memcached_pool():
+    global _memcached_pool
+    with _memcached_pool_lock:
+        if _memcached_pool is None:
+            servers = [os.environ.get('MEMCACHIER_SERVERS')]
+            username=os.environ.get('MEMCACHIER_USERNAME')
+            password=os.environ.get('MEMCACHIER_PASSWORD')
+            if "localhost" in servers:
+                username = None
+                password = None
+            mc = pylibmc.Client(
+                servers=servers, 
+                username=username,
+                password=password,
+                binary=True)
+            pool = pylibmc.ClientPool()
+            pool.fill(mc, default_settings.MEMCACHED_POOL_SIZE)
+            _memcached_pool = pool
+        return _memcached_pool
+
+def get_cache_stats():
+    # memcached hits are pages served from the cache, fresh or revalidated, and
+    # misses are pages fetched again; revalidated counts the hits that took a 304
+    return {
+        "local": _local_cache.stats(),
+        "memcached": dict(_memcached_stats)
+    }
+
+def count_revalidation(not_modified):
+    # an expired entry is counted once the provider has answered: served from
+    # the cache if it was Not Modified, otherwise fetched again
+    if not_modified:
+        _count_memcached("hits")
+        _count_memcached("revalidated")
+    else:
+        _count_memcached("misses")
+
+def _count_memcached(stat):
+    with _memcached_stats_lock:
+        _memcached_stats[stat] += 1
+
+
 class Cache(object):
-    """ Maintains a cache of URL responses in memcached """
+    """ Maintains a cache of URL responses in memcached, 
+        with recent ones also kept in this process """
 
     def _build_hash_key(self, key):
-        json_key = json.dumps(key)
+        # sorted, so the same headers always give the same key
+        json_key = json.dumps(key, sort_keys=True, separators=(",", ":"))
         hash_key = hashlib.md5(json_key.encode("utf-8")).hexdigest()
         return hash_key
 
     def _get_memcached_client(self):
-        servers = [os.environ.get('MEMCACHIER_SERVERS')]
-        username=os.environ.get('MEMCACHIER_USERNAME')
-        password=os.environ.get('MEMCACHIER_PASSWORD')
-        if "localhost" in servers:
-            username = None
-            password = None
-        mc = pylibmc.Client(
-            servers=servers, 
-            username=username,
-            password=password,
-            binary=True)
-        return mc
+        # use as "with self._get_memcached_client() as mc:", which returns it to the pool
+        return _get_memcached_pool().reserve(block=True)
  
     def __init__(self, max_cache_age=60*60):  #one hour
         self.max_cache_age = max_cache_age
 
+    def is_fresh(self, entry):
+        """ Whether an entry is younger than max_cache_age; older ones are only kept for revalidation """
+        if "cached_at" not in entry:
+            # stored before entries were timestamped, so memcached has been expiring them
+            return True
+        return entry["cached_at"] + self.max_cache_age > time.time()
+
 
     def flush_cache(self):
         #empties the cache
-        mc = self._get_memcached_client()        
-        mc.flush_all()
+        _local_cache.clear()
+        with self._get_memcached_client() as mc:
+            mc.flush_all()
 
-    @Retry(3, pylibmc.Error, 0.1)
     def get_cache_entry(self, key):
-        """ Get an entry from the cache, returns None if not found """
-        mc = self._get_memcached_client()
+        """ Get an entry from the cache, returns None if not found.
+            Check is_fresh() before using it; expired entries with validators are returned too. """
         hash_key = self._build_hash_key(key)
-        response = mc.get(hash_key)
+        response = _local_cache.get(hash_key)
+        if response is None:
+            response = self._get_memcached_entry(hash_key)
+            if response:
+                if self.is_fresh(response):
+                    _count_memcached("hits")
+                _local_cache.set(hash_key, response, self.max_cache_age)
+            else:
+                _count_memcached("misses")
         return response
 
     @Retry(3, pylibmc.Error, 0.1)
-    def set_cache_entry(self, key, data):
-        """ Store a cache entry """
+    def _get_memcached_entry(self, hash_key):
+        with self._get_memcached_client() as mc:
+            stored = mc.get(hash_key)
+            if isinstance(stored, dict) and ("chunks" in stored):
+                chunk_keys = [self._chunk_key(hash_key, stored["version"], i) for i in range(stored["chunks"])]
+                chunks = mc.get_multi(chunk_keys)
+                if len(chunks) < len(chunk_keys):
+                    # some chunks have been evicted, so the entry is gone
+                    return None
+                stored = "".join([chunks[chunk_key] for chunk_key in chunk_keys])
+        if isinstance(stored, str):
+            return _decompress(stored)
+        # entries stored before compression are plain dicts
+        return stored
 
-        #memcached will only store things up to 1MB as per http://sendapatch.se/projects/pylibmc/misc.html
-        MAX_MEMCACHED_VALUE_SIZE = 1000*1000
-        if sys.getsizeof(data["text"]) > MAX_MEMCACHED_VALUE_SIZE:
-            logger.debug(u"Not caching because payload is too large")
-            return None
+    def _chunk_key(self, hash_key, version, chunk_number):
+        return "{hash_key}:{version}:{chunk_number}".format(
+            hash_key=hash_key, version=version, chunk_number=chunk_number)
 
-        mc = self._get_memcached_client()
+    @Retry(3, pylibmc.Error, 0.1)
+    def set_cache_entry(self, key, data):
+        """ Store a cache entry, compressed, and in chunks if it is big """
         hash_key = self._build_hash_key(key)
+        data = dict(data, cached_at=time.time())
+        memcached_age = self.max_cache_age
+        if data.get("etag") or data.get("last_modified"):
+            # keep it past expiry so it can be revalidated instead of refetched
+            memcached_age += default_settings.CACHE_REVALIDATION_WINDOW
         try:
-            set_response = mc.set(hash_key, data, time=self.max_cache_age)
-            if not set_response:
-                raise CacheException("Unable to store into Memcached. Make sure memcached server is running.")
-        except PicklingError:
+            payload = _compress(data)
+        except (PicklingError, TypeError):
             # This happens when trying to cache a thread.lock object, for example.  Just don't cache.
-            logger.debug(u"In set_cache_entry but got PicklingError")
+            logger.debug(u"In set_cache_entry but couldn't pickle the data")
             return None
+
+        chunks = _split_chunks(payload)
+        if len(chunks) > MAX_CHUNKS:
+            logger.debug(u"Not caching because payload is too large")
+            return None
+
+        _local_cache.set(hash_key, data, self.max_cache_age)
+        with self._get_memcached_client() as mc:
+            if len(chunks) == 1:
+                set_response = mc.set(hash_key, payload, time=memcached_age)
+            else:
+                # chunk keys are versioned so a reader never mixes chunks from two writes
+                version = hashlib.md5(payload).hexdigest()[0:8]
+                chunk_dict = dict([(self._chunk_key(hash_key, version, i), chunk) for (i, chunk) in enumerate(chunks)])
+                failed_keys = mc.set_multi(chunk_dict, time=memcached_age)
+                set_response = not failed_keys and mc.set(hash_key, 
+                    {"chunks": len(chunks), "version": version}, 
+                    time=memcached_age)
+        if not set_response:
+            raise CacheException("Unable to store into Memcached. Make sure memcached server is running.")
         return set_response
   
@@ -3,13 +3,44 @@
 # ALL KEYS HAVE TO BE UPPERCASE TO BE STORED IN APP SETTINGS
 #
 
+import os
+
 USER_AGENT = "ImpactStory/0.4.0" # User-Agent string to use on HTTP requests
 VERSION = "cristhian" # version
 PROXY = "" # used with  providers-test-proxy.py script in the extras directory
+PROVIDER_SIMULATOR = os.getenv("PROVIDER_SIMULATOR_URL", "") # send provider calls to totalimpact/provider_simulator.py, eg http://localhost:8081
 CACHE_ENABLED = True # Memcache server enabled
+MEMCACHED_POOL_SIZE = 20 # memcached clients shared by all the threads in a process
+LOCAL_CACHE_MAX_ENTRIES = 500 # in-process cache in front of memcached
+LOCAL_CACHE_MAX_AGE = 60*5 # seconds
+CACHE_REVALIDATION_WINDOW = 60*60*24*7 # keep expired pages with an ETag or Last-Modified this long, for conditional GETs
+UPDATE_MEMO_MAX_ENTRIES = 1000 # responses shared by the provider calls of one item update, even with the cache off
+UPDATE_MEMO_MAX_AGE = 60*10 # seconds, about one update's aliases, biblio and metrics passes
+ANALYTICS_QUEUE_SIZE = 10000 # analytics events waiting for the background sender; more are dropped
+ANALYTICS_BATCH_SIZE = 50 # events sent to segment.io in one request, which takes at most 50
+ANALYTICS_FLUSH_INTERVAL = 10 # seconds the sender waits to fill a batch
+ANALYTICS_SAMPLE_RATES = {} # fraction of each event kept, by event name, eg {"Sent GET to Provider": 0.1}; others are all kept
 
 # List of desired providers and their configuration files
 # Alias methods will be called in the order of this list
+# "workers" sets the size of a provider's backend worker pool (default 20); with
+# BACKEND_ENGINE=gevent the workers are greenlets, so pools can be much bigger
+# "requests_per_second" and "burst" set a token bucket shared by all backend processes;
+# providers with the same "rate_limit_key" share one bucket (default is the provider name)
+# "circuit_failures" consecutive timeouts or server errors stop calls to a provider
+# for "circuit_reset" seconds (defaults 5 and 60)
+# providers that can get metrics for many ids in one call batch up to "batch_size" messages,
+# waiting up to "batch_window" seconds to fill a batch (defaults 50 and 1.0)
+# "pool_size" sets a provider's keep-alive connections per host (default its "workers")
+# "cache_404s" reuses cached not-found responses too (default False)
+# timeouts, lost connections and 429 or 5xx responses are retried up to "retries" times with
+# jittered backoff from "retry_backoff" seconds, or as told by Retry-After, but not past an
+# item's "item_deadline" seconds (defaults 2, 1.0 and 120)
+# a provider fetches several aliases or pages at once, up to "concurrent_fetches" (default 10),
+# and "requests_per_host" caps its GETs in flight to any one host (default no cap)
+# backend queues serve interactive work and bulk refreshes in about this ratio when both are waiting
+PRIORITY_LANE_WEIGHTS = {"interactive": 4, "bulk": 1}
+
 PROVIDERS = [
     # this is up here because it can produce dois
     ("pubmed", {}),
@@ -19,7 +50,7 @@ PROVIDERS = [
     ("crossref", {}),
     ("dryad", {}),            
     ("figshare", {}),            
-    ("github", {}),
+    ("github", {"requests_per_second": 1.3, "burst": 20}),  # 5000 per hour per client id
     ("slideshare", {}),
     ("twitter_account", {}),
     ("twitter_tweet", {}),
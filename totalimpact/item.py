@@ -489,7 +489,7 @@ def add_metrics_data(metric_name, metrics_method_response, item, timestamp=None)
     return item
 
 
-def add_metric_to_item_object(full_metric_name, metrics_method_response, item_doc):
+def add_metric_to_item_object(full_metric_name, metrics_method_response, item_doc, commit=True):
     tiid = item_doc["_id"]
     # logger.debug(u"in add_metrics_to_item_object for {tiid}".format(
     #     tiid=tiid))
@@ -508,25 +508,24 @@ def add_metric_to_item_object(full_metric_name, metrics_method_response, item_do
     metric_object = Metric(**new_style_metric_dict)
     db.session.add(metric_object)
 
-    try:
-        db.session.commit()
-    except (IntegrityError, FlushError) as e:
-        db.session.rollback()
-        logger.warning(u"Fails Integrity check in add_metric_to_item_object for {tiid}, rolling back.  Message: {message}".format(
-            tiid=tiid, 
-            message=e.message)) 
-
-    item_obj = Item.from_tiid(tiid)
+    if commit:
+        try:
+            db.session.commit()
+        except (IntegrityError, FlushError) as e:
+            db.session.rollback()
+            logger.warning(u"Fails Integrity check in add_metric_to_item_object for {tiid}, rolling back.  Message: {message}".format(
+                tiid=tiid, 
+                message=e.message)) 
 
-    return item_obj
+    return metric_object
 
 
-def add_aliases_to_item_object(aliases_dict, item_doc):
+def add_aliases_to_item_object(aliases_dict, item_doc, commit=True):
     tiid = item_doc["_id"]
     logger.debug(u"in add_aliases_to_item_object for {tiid}".format(
         tiid=tiid))        
 
-    item_obj = Item.from_tiid(tiid)
+    item_obj = Item.query.get(tiid)  # don't need metrics to add aliases
     if not item_obj:
         item_obj = create_objects_from_item_doc(item_doc)
 
@@ -538,22 +537,23 @@ def add_aliases_to_item_object(aliases_dict, item_doc):
         if not alias_obj.alias_tuple in item_obj.alias_tuples:
             item_obj.aliases.append(alias_obj)    
 
-    try:
-        db.session.commit()
-    except (IntegrityError, FlushError) as e:
-        db.session.rollback()
-        logger.warning(u"Fails Integrity check in add_aliases_to_item_object for {tiid}, rolling back.  Message: {message}".format(
-            tiid=tiid, 
-            message=e.message)) 
+    if commit:
+        try:
+            db.session.commit()
+        except (IntegrityError, FlushError) as e:
+            db.session.rollback()
+            logger.warning(u"Fails Integrity check in add_aliases_to_item_object for {tiid}, rolling back.  Message: {message}".format(
+                tiid=tiid, 
+                message=e.message)) 
     return item_obj
 
-def add_biblio_to_item_object(new_biblio_dict, item_doc):
+def add_biblio_to_item_object(new_biblio_dict, item_doc, commit=True):
     tiid = item_doc["_id"]
     logger.debug(u"in add_biblio_to_item_object for {tiid}, /biblio_print {new_biblio_dict}".format(
         tiid=tiid, 
         new_biblio_dict=new_biblio_dict))        
 
-    item_obj = Item.from_tiid(tiid)
+    item_obj = Item.query.get(tiid)  # don't need metrics to add biblio
     if not item_obj:
         item_obj = create_objects_from_item_doc(item_doc)
     item_obj.last_modified = datetime.datetime.utcnow()
@@ -561,13 +561,14 @@ def add_biblio_to_item_object(new_biblio_dict, item_doc):
 
     item_obj.biblios += create_biblio_objects([new_biblio_dict])
 
-    try:
-        db.session.commit()
-    except (IntegrityError, FlushError) as e:
-        db.session.rollback()
-        logger.warning(u"Fails Integrity check in add_biblio_to_item_object for {tiid}, rolling back.  Message: {message}".format(
-            tiid=tiid, 
-            message=e.message)) 
+    if commit:
+        try:
+            db.session.commit()
+        except (IntegrityError, FlushError) as e:
+            db.session.rollback()
+            logger.warning(u"Fails Integrity check in add_biblio_to_item_object for {tiid}, rolling back.  Message: {message}".format(
+                tiid=tiid, 
+                message=e.message)) 
         
     return item_obj
 
@@ -979,11 +980,11 @@ def get_tiid_by_alias(ns, nid, mydao=None):
     return tiid
 
 
-def start_item_update(tiid, aliases_dict, myredis):
+def start_item_update(tiid, aliases_dict, myredis, lane=tiredis.INTERACTIVE):
     logger.debug(u"In start_item_update with {tiid}, /biblio_print {aliases_dict}".format(
         tiid=tiid, aliases_dict=aliases_dict))
     myredis.init_currently_updating_status(tiid,
         ProviderFactory.providers_with_metrics(default_settings.PROVIDERS))
-    myredis.add_to_alias_queue(tiid, aliases_dict)
+    myredis.add_to_alias_queue(tiid, aliases_dict, lane=lane)
 
 
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import os, time, random, re, urlparse, logging, threading, argparse
+import BaseHTTPServer, SocketServer
+
+from totalimpact.providers.provider import ProviderFactory
+
+logger = logging.getLogger("ti.provider_simulator")
+
+SAMPLE_PAGES_DIR = os.path.join(os.path.split(__file__)[0], "../extras/sample_provider_pages")
+
+# url template attributes whose pages are stored under a different name
+PAGE_NAMES = {"member_items": "members", "uuid_from_title": "uuidlookup"}
+
+
+class Faults(object):
+    """ How the simulated providers misbehave: a latency distribution,
+        and the fraction of requests that time out, are rate limited or fail """
+
+    def __init__(self, latency_median=0.2, latency_sigma=0.5,
+            timeout_rate=0, timeout_seconds=30,
+            rate_limit_rate=0, retry_after=1,
+            error_rate=0):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma  # of the lognormal, so bigger means a longer tail
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds  # longer than the providers' http_get timeout
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+
+    def latency(self):
+        if not self.latency_median:
+            return 0
+        return random.lognormvariate(0, self.latency_sigma) * self.latency_median
+
+    def pick(self):
+        """ Returns "timeout", 429, 500, 503 or None, for a normal response """
+        roll = random.random()
+        if roll < self.timeout_rate:
+            return "timeout"
+        roll -= self.timeout_rate
+        if roll < self.rate_limit_rate:
+            return 429
+        roll -= self.rate_limit_rate
+        if roll < self.error_rate:
+            return random.choice([500, 503])
+        return None
+
+
+class RecordedPages(object):
+    """ Finds the recorded page for a provider's url, by matching it against the
+        provider's url templates.  A url matching metrics_url_template is served
+        extras/sample_provider_pages/<provider>/metrics, and so on. """
+
+    def __init__(self, sample_pages_dir=SAMPLE_PAGES_DIR):
+        self.sample_pages_dir = sample_pages_dir
+        self.routes = {}  # by provider name, a list of (url regex, page name)
+        self.pages = {}
+
+    def _routes_for(self, provider_name):
+        if provider_name not in self.routes:
+            routes = []
+            try:
+                provider_instance = ProviderFactory.get_provider(provider_name)
+            except ImportError:
+                provider_instance = None
+            for attribute in sorted(dir(provider_instance)):
+                template = getattr(provider_instance, attribute, None)
+                if ("template" not in attribute) or not isinstance(template, basestring) or ("%s" not in template):
+                    continue
+                # metrics_url_template_site is served the metrics_site page
+                page_name = attribute.replace("_url_template", "").replace("_template", "")
+                page_name = PAGE_NAMES.get(page_name, page_name)
+                pattern = ".*".join([re.escape(part) for part in template.split("%s")])
+                routes.append((re.compile(pattern), page_name))
+            self.routes[provider_name] = routes
+        return self.routes[provider_name]
+
+    def _read_page(self, provider_name, page_name):
+        key = (provider_name, page_name)
+        if key not in self.pages:
+            path = os.path.join(self.sample_pages_dir, provider_name, page_name)
+            if not os.path.isfile(path):
+                # metrics_pmc_citations falls back to metrics, for example
+                path = os.path.join(self.sample_pages_dir, provider_name, page_name.split("_")[0])
+            if os.path.isfile(path):
+                self.pages[key] = open(path).read()
+            else:
+                self.pages[key] = None
+        return self.pages[key]
+
+    def get_page(self, provider_name, url):
+        for (pattern, page_name) in self._routes_for(provider_name):
+            if pattern.match(url):
+                page = self._read_page(provider_name, page_name)
+                if page is not None:
+                    return page
+        # not one of its templates, so the provider's only recorded page is the best guess
+        page_names = []
+        provider_dir = os.path.join(self.sample_pages_dir, provider_name)
+        if os.path.isdir(provider_dir):
+            page_names = sorted(os.listdir(provider_dir))
+        if len(page_names) == 1:
+            return self._read_page(provider_name, page_names[0])
+        return None
+
+
+class SimulatorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves GET /<provider_name>?url=<the url the provider asked for> """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        parsed = urlparse.urlparse(self.path)
+        provider_name = parsed.path.strip("/")
+        url = urlparse.parse_qs(parsed.query).get("url", [""])[0]
+
+        faults = self.server.faults
+        time.sleep(faults.latency())
+        fault = faults.pick()
+        self.server.count(provider_name, fault)
+        if fault == "timeout":
+            time.sleep(faults.timeout_seconds)
+            self._send(504, "simulated timeout")
+        elif fault == 429:
+            self._send(429, "simulated rate limit", {"Retry-After": str(faults.retry_after)})
+        elif fault:
+            self._send(fault, "simulated server error")
+        else:
+            page = self.server.recorded_pages.get_page(provider_name, url)
+            if page is None:
+                self._send(404, "no recorded page for " + url)
+            else:
+                self._send(200, page)
+
+    def _send(self, status_code, body, headers={}):
+        self.send_response(status_code)
+        self.send_header("Content-Length", str(len(body)))
+        for (header, value) in headers.iteritems():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class ProviderSimulator(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Stands in for every provider API, so the backend can be load tested on one machine """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("localhost", 8081), faults=None, recorded_pages=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, SimulatorHandler)
+        self.faults = faults or Faults()
+        self.recorded_pages = recorded_pages or RecordedPages()
+        self.counts = {}
+        self.counts_lock = threading.Lock()
+
+    def count(self, provider_name, fault):
+        key = "{provider_name}:{fault}".format(provider_name=provider_name, fault=fault or "ok")
+        with self.counts_lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve recorded provider pages in place of the real provider APIs",
+        epilog="Run the backend with PROVIDER_SIMULATOR_URL=http://localhost:<port> to send its provider calls here.")
+    parser.add_argument('--port', default=8081, type=int, help="Port to listen on.")
+    parser.add_argument('--latency', default=0.2, type=float, help="Median seconds before each response.")
+    parser.add_argument('--latency_sigma', default=0.5, type=float, help="Spread of the lognormal latency; bigger means a longer tail.")
+    parser.add_argument('--timeouts', default=0, type=float, help="Fraction of requests that hang past the client timeout.")
+    parser.add_argument('--timeout_seconds', default=30, type=float, help="How long those requests hang.")
+    parser.add_argument('--rate_limits', default=0, type=float, help="Fraction of requests answered 429.")
+    parser.add_argument('--retry_after', default=1, type=int, help="Retry-After seconds sent with each 429.")
+    parser.add_argument('--errors', default=0, type=float, help="Fraction of requests answered 500 or 503.")
+    args = vars(parser.parse_args())
+
+    faults = Faults(args["latency"], args["latency_sigma"], args["timeouts"], args["timeout_seconds"],
+        args["rate_limits"], args["retry_after"], args["errors"])
+    simulator = ProviderSimulator(("", args["port"]), faults)
+    logger.info(u"provider simulator listening on port {port}".format(port=args["port"]))
+    try:
+        simulator.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info(u"served {counts}".format(counts=simulator.counts))
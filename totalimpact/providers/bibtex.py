@@ -8,7 +8,6 @@ from pybtex.scanner import PybtexSyntaxError, PybtexError
 from totalimpact.providers import provider
 from totalimpact.providers.provider import Provider, ProviderContentMalformedError, ProviderTimeout, ProviderServerError
 from totalimpact import unicode_helpers 
-from totalimpact.providers import bibtex_lookup
 
 import logging
 logger = logging.getLogger('ti.providers.bibtex')
@@ -28,6 +27,19 @@ def build_bibtex_to_unicode(unicode_to_bibtex):
         bibtex_to_unicode[bibtex] = unicode_value
     return bibtex_to_unicode
 
+# every key is a {group} with no braces inside, so one pass over the groups in a string
+# finds them all, instead of a replace() per key
+_bibtex_group_pattern = re.compile(r"\{[^{}]*\}")
+_bibtex_to_unicode = None
+
+def get_bibtex_to_unicode():
+    # built on first use and shared by every instance; two threads racing to build it get the same dict
+    global _bibtex_to_unicode
+    if _bibtex_to_unicode is None:
+        from totalimpact.providers import bibtex_lookup
+        _bibtex_to_unicode = build_bibtex_to_unicode(bibtex_lookup.unicode_to_latex)
+    return _bibtex_to_unicode
+
 
 class Bibtex(Provider):  
 
@@ -39,14 +51,13 @@ class Bibtex(Provider):
     def __init__(self):
         super(Bibtex, self).__init__()
         enable_strict_mode(True) #throw errors
-        self.bibtex_to_unicode = build_bibtex_to_unicode(bibtex_lookup.unicode_to_latex)
 
     def _to_unicode(self, text):
         text = unicode_helpers.to_unicode_or_bust(text)
         if "{" in text:
             text = text.replace("\\", "")
-            for i, j in self.bibtex_to_unicode.iteritems():
-                text = text.replace(i, j)
+            bibtex_to_unicode = get_bibtex_to_unicode()
+            text = _bibtex_group_pattern.sub(lambda match: bibtex_to_unicode.get(match.group(0), match.group(0)), text)
         return text
 
     def _parse_bibtex_entries(self, entries):
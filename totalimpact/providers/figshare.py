@@ -1,8 +1,9 @@
 from totalimpact.providers import provider
 from totalimpact.providers import crossref
-from totalimpact.providers.provider import Provider, ProviderContentMalformedError
+from totalimpact.providers.provider import Provider, ProviderContentMalformedError, ProviderItemNotFoundError
 
 import re
+import math
 
 import logging
 logger = logging.getLogger('ti.providers.figshare')
@@ -97,6 +98,12 @@ class Figshare(Provider):
             return {}
 
 
+    metrics_extractor = provider.JsonExtractor({
+        'figshare:shares' : ['shares'],
+        'figshare:downloads' : ['downloads'],
+        'figshare:views' : ['views']
+    })
+
     def _extract_metrics(self, page, status_code=200, id=None):
         if status_code != 200:
             if status_code == 404:
@@ -104,13 +111,8 @@ class Figshare(Provider):
             else:
                 raise(self._get_error(status_code))
 
-        dict_of_keylists = {
-            'figshare:shares' : ['shares'],
-            'figshare:downloads' : ['downloads'],
-            'figshare:views' : ['views']
-        }
         item = self._extract_figshare_record(page, id)
-        metrics_dict = provider._extract_from_data_dict(item, dict_of_keylists)
+        metrics_dict = self.metrics_extractor.extract_from_data(item)
         return metrics_dict
 
 
@@ -121,6 +123,18 @@ class Figshare(Provider):
         return(doi_aliases)
 
 
+    def _get_members_page(self, response):
+        if response.status_code != 200:
+            self.logger.info(u"%s status_code=%i" 
+                % (self.provider_name, response.status_code))            
+            if response.status_code == 404:
+                raise ProviderItemNotFoundError
+            elif response.status_code == 303: #redirect
+                pass                
+            else:
+                self._get_error(response.status_code, response)
+        return response.text
+
     # default method; providers can override
     def member_items(self, 
             query_string, 
@@ -136,37 +150,27 @@ class Figshare(Provider):
             provider_url_template = self.member_items_url_template
 
         figshare_userid = self.get_figshare_userid_from_author_url(query_string)
-        next_page = 1
+        first_url = provider_url_template % (figshare_userid, 1)
+        # try to get a response from the data provider  
+        first_page = self._get_members_page(self.http_get(first_url, cache_enabled=cache_enabled))
+
+        # the first page says how many more there are, so fetch the rest together
+        number_of_items_per_page = 10 #figshare default
+        try:
+            items_found = provider._load_json(first_page)["items_found"]
+        except (AttributeError, TypeError, KeyError):
+            items_found = 0
+        number_of_pages = int(math.ceil(float(items_found) / number_of_items_per_page))
+        urls = [provider_url_template % (figshare_userid, page_number) for page_number in range(2, number_of_pages+1)]
+        responses = self.http_get_multiple(urls, cache_enabled=cache_enabled)
+
         members = []
-        while next_page:
-
-            url = provider_url_template % (figshare_userid, next_page)
-            
-            # try to get a response from the data provider  
-            response = self.http_get(url, cache_enabled=cache_enabled)
-
-            if response.status_code != 200:
-                self.logger.info(u"%s status_code=%i" 
-                    % (self.provider_name, response.status_code))            
-                if response.status_code == 404:
-                    raise ProviderItemNotFoundError
-                elif response.status_code == 303: #redirect
-                    pass                
-                else:
-                    self._get_error(response.status_code, response)
-
-            # extract the member ids
-            number_of_items_per_page = 10 #figshare default
+        pages = [first_page] + [self._get_members_page(responses[url]) for url in urls]
+        for page in pages:
             try:
-                page = response.text
-                data = provider._load_json(page)
-                if data["items_found"] > next_page*number_of_items_per_page:
-                    next_page += 1
-                else:
-                    next_page = None
                 members += self._extract_members(page, query_string)
             except (AttributeError, TypeError):
-                next_page = None
+                break
 
         return(members)
 
@@ -71,16 +71,27 @@ class Github(Provider):
         members = [("url", self.repo_url_template %(query_string, hit)) for hit in list(set(hits))]
         return(members)
 
+    biblio_extractor = provider.JsonExtractor({
+        'title' : ['name'],
+        'description' : ['description'],
+        'owner' : ['owner', 'login'],
+        'url' : ['svn_url'],
+        'last_push_date' : ['pushed_at'],
+        'create_date' : ['created_at']
+    })
+
+    aliases_extractor = provider.JsonExtractor({
+        "url": ["svn_url"], 
+        "title" : ["name"]
+    })
+
+    metrics_extractor = provider.JsonExtractor({
+        'github:stars' : ['watchers'],
+        'github:forks' : ['forks']
+    })
+
     def _extract_biblio(self, page, id=None):
-        dict_of_keylists = {
-            'title' : ['name'],
-            'description' : ['description'],
-            'owner' : ['owner', 'login'],
-            'url' : ['svn_url'],
-            'last_push_date' : ['pushed_at'],
-            'create_date' : ['created_at']
-        }
-        biblio_dict = provider._extract_from_json(page, dict_of_keylists)
+        biblio_dict = self.biblio_extractor.extract(page)
         try:
             biblio_dict["year"] = biblio_dict["create_date"][0:4]
         except KeyError:
@@ -89,10 +100,7 @@ class Github(Provider):
         return biblio_dict    
        
     def _extract_aliases(self, page, id=None):
-        dict_of_keylists = {"url": ["svn_url"], 
-                            "title" : ["name"]}
-
-        aliases_dict = provider._extract_from_json(page, dict_of_keylists)
+        aliases_dict = self.aliases_extractor.extract(page)
         if aliases_dict:
             aliases_list = [(namespace, nid) for (namespace, nid) in aliases_dict.iteritems()]
         else:
@@ -110,12 +118,7 @@ class Github(Provider):
         if not "forks_count" in page:
             raise ProviderContentMalformedError
 
-        dict_of_keylists = {
-            'github:stars' : ['watchers'],
-            'github:forks' : ['forks']
-        }
-
-        metrics_dict = provider._extract_from_json(page, dict_of_keylists)
+        metrics_dict = self.metrics_extractor.extract(page)
 
         return metrics_dict
 
@@ -67,17 +67,19 @@ class Mendeley(Provider):
         relevant = (namespace=="doi")
         return(relevant)
 
+    metrics_extractor = provider.JsonExtractor({
+        "mendeley:readers": ["stats", "readers"], 
+        "mendeley:discipline": ["stats", "discipline"],
+        "mendeley:career_stage": ["stats", "status"],
+        "mendeley:country": ["stats", "country"],
+        "mendeley:groups" : ["groups"]
+    })
+
     def _extract_metrics(self, page, status_code=200, id=None):
         if not "identifiers" in page:
             raise ProviderContentMalformedError()
 
-        dict_of_keylists = {"mendeley:readers": ["stats", "readers"], 
-                            "mendeley:discipline": ["stats", "discipline"],
-                            "mendeley:career_stage": ["stats", "status"],
-                            "mendeley:country": ["stats", "country"],
-                            "mendeley:groups" : ["groups"]}
-
-        metrics_dict = provider._extract_from_json(page, dict_of_keylists)
+        metrics_dict = self.metrics_extractor.extract(page)
 
         # get count of groups
         try:
@@ -54,15 +54,43 @@ class Plosalm(Provider):
             raise ProviderContentMalformedError
 
         json_response = provider._load_json(page)
-        this_article = json_response[0]["sources"][0]["metrics"]
+        metrics_dict = self._metrics_from_article(json_response[0])
 
-        dict_of_keylists = {
-            'plosalm:html_views' : ['html'],
-            'plosalm:pdf_views' : ['pdf']
-        }
+        return metrics_dict
+
+    metrics_extractor = provider.JsonExtractor({
+        'plosalm:html_views' : ['html'],
+        'plosalm:pdf_views' : ['pdf']
+    })
 
-        metrics_dict = provider._extract_from_data_dict(this_article, dict_of_keylists)
+    def _metrics_from_article(self, article_json):
+        this_article = article_json["sources"][0]["metrics"]
+
+        metrics_dict = self.metrics_extractor.extract_from_data(this_article)
 
         return metrics_dict
 
+    # the ALM api takes a comma-separated list of dois
+    def _extract_metrics_batch(self, page, status_code=200, ids=[]):
+        if status_code != 200:
+            if status_code == 404:
+                return {}
+            else:
+                raise(self._get_error(status_code))
+
+        if not "sources" in page:
+            return {}
+
+        json_response = provider._load_json(page)
+
+        # dois are case insensitive, so match them that way
+        ids_by_lowercase_doi = dict([(id.lower(), id) for id in ids])
+        metrics_by_id = {}
+        for article_json in json_response:
+            id = ids_by_lowercase_doi.get(article_json.get("doi", "").lower())
+            if id:
+                metrics_by_id[id] = self._metrics_from_article(article_json)
+
+        return metrics_by_id
+
 
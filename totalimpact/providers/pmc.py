@@ -103,46 +103,42 @@ class Pmc(Provider):
         if "<pmc-web-stat>" not in page:
             raise ProviderContentMalformedError
 
-        (doc, lookup_function) = provider._get_doc_from_xml(page)
-        if not doc:
-            return {}
+        # monthly reports cover a whole journal, so stream through them rather than build the tree
         try:
-            articles = doc.getElementsByTagName("article")
-            for article in articles:
-                print article
+            for article in provider._iterparse_xml(page, "article"):
                 metrics_dict = {}            
-                meta_data = article.getElementsByTagName("meta-data")[0]
-                pmid = meta_data.getAttribute("pubmed-id")
+                meta_data = article.find(".//meta-data")
+                pmid = meta_data.get("pubmed-id")
                 if id == pmid:
-                    metrics = article.getElementsByTagName("usage")[0]
+                    metrics = article.find(".//usage")
                     
-                    pdf_downloads = int(metrics.getAttribute("pdf"))
+                    pdf_downloads = int(metrics.get("pdf"))
                     if pdf_downloads:
                         metrics_dict.update({'pmc:pdf_downloads': pdf_downloads})
 
-                    abstract_views = int(metrics.getAttribute("abstract"))
+                    abstract_views = int(metrics.get("abstract"))
                     if abstract_views:
                         metrics_dict.update({'pmc:abstract_views': abstract_views})
 
-                    fulltext_views = int(metrics.getAttribute("full-text"))
+                    fulltext_views = int(metrics.get("full-text"))
                     if fulltext_views:
                         metrics_dict.update({'pmc:fulltext_views': fulltext_views})
 
-                    unique_ip_views = int(metrics.getAttribute("unique-ip"))
+                    unique_ip_views = int(metrics.get("unique-ip"))
                     if unique_ip_views:
                         metrics_dict.update({'pmc:unique_ip_views': unique_ip_views})
 
-                    figure_views = int(metrics.getAttribute("figure"))
+                    figure_views = int(metrics.get("figure"))
                     if figure_views:
                         metrics_dict.update({'pmc:figure_views': figure_views})
 
-                    suppdata_views = int(metrics.getAttribute("supp-data"))
+                    suppdata_views = int(metrics.get("supp-data"))
                     if suppdata_views:
                         metrics_dict.update({'pmc:suppdata_views': suppdata_views})
 
                     return metrics_dict
 
-        except (KeyError, IndexError, TypeError):
+        except (KeyError, IndexError, TypeError, AttributeError):
             pass
 
         return {}
@@ -1,21 +1,30 @@
  # -*- coding: utf-8 -*-  # need this line because test utf-8 strings later
 
-from totalimpact.cache import Cache
+from totalimpact.cache import Cache, LocalCache, count_revalidation
+from totalimpact.ratelimit import RateLimiter
 from totalimpact import providers
 from totalimpact import default_settings
+from totalimpact import analytics_sink
 from totalimpact import utils
 from totalimpact import app
 
-import requests, os, time, threading, sys, traceback, importlib, urllib, logging, itertools
+import requests, os, time, threading, sys, traceback, importlib, urllib, urlparse, logging, itertools, cookielib, random
+import email.utils
 import simplejson
+# ujson decodes several times faster; simplejson (with its C speedups) otherwise
+try:
+    import ujson
+    _json_loads = ujson.loads
+except ImportError:
+    _json_loads = simplejson.loads
 import BeautifulSoup
 import socket
-import analytics
-import grequests
-reload(socket)
 from xml.dom import minidom 
 from xml.parsers.expat import ExpatError
+from lxml import etree
+from io import BytesIO
 import re
+from contextlib import contextmanager
 
 logger = logging.getLogger("ti.provider")
 
@@ -24,22 +33,71 @@ requests_log = logging.getLogger("requests").setLevel(logging.WARNING)
 
 
 class CachedResponse:
-    def __init__(self, cache_data):
+    def __init__(self, cache_data, is_fresh=True):
         self.status_code = cache_data['status_code']
         self.url = cache_data['url']
         self.text = cache_data['text']
-
-def get_page_from_cache(url, headers, allow_redirects, cache):
+        self.encoding = "utf-8"
+        self.headers = {
+            "etag": cache_data.get('etag'),
+            "last-modified": cache_data.get('last_modified')}
+        self.is_fresh = is_fresh  # if not, revalidate before using it
+
+class MemoizedResponse:
+    """ Just the parts of a response that providers read, kept for the rest of an update run """
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.url = response.url
+        self.text = response.text
+        self.encoding = "utf-8"
+        self.headers = requests.structures.CaseInsensitiveDict(response.headers)
+
+def get_page_from_cache(url, headers, allow_redirects, cache, cache_not_found=False):
+    """ Returns a CachedResponse, or None.  Check is_fresh before using it. """
     cache_key = headers.copy()
     cache_key.update({"url":url, "allow_redirects":allow_redirects})
 
     cache_data = cache.get_cache_entry(cache_key)
-    # use it if it was a 200, otherwise go get it again
-    if cache_data and (cache_data['status_code'] == 200):
-        logger.debug(u"returning from cache: %s" %(url))
-        return CachedResponse(cache_data)
+    # use it if it was a 200 (or a 404, if asked), otherwise go get it again
+    usable_statuses = [200]
+    if cache_not_found:
+        usable_statuses.append(404)
+    if cache_data and (cache_data['status_code'] in usable_statuses):
+        is_fresh = cache.is_fresh(cache_data)
+        if is_fresh:
+            logger.debug(u"returning from cache: %s" %(url))
+        return CachedResponse(cache_data, is_fresh)
     return None
 
+def conditional_headers(headers, cached_response):
+    """ Request headers that ask the provider to send the page only if it has
+        changed since the cached copy """
+    request_headers = headers.copy()
+    if cached_response:
+        if cached_response.headers["etag"]:
+            request_headers["If-None-Match"] = cached_response.headers["etag"]
+        if cached_response.headers["last-modified"]:
+            request_headers["If-Modified-Since"] = cached_response.headers["last-modified"]
+    return request_headers
+
+def revalidated_page(url, headers, allow_redirects, response, cached_response, cache):
+    """ Returns the cached copy, refreshed in the cache, if the provider said it
+        was Not Modified.  Otherwise returns the new response. """
+    if cached_response and (response is not None):
+        not_modified = (response.status_code == 304)
+        count_revalidation(not_modified)
+        if not_modified:
+            logger.debug(u"revalidated cache: %s" %(url))
+            for header in ["etag", "last-modified"]:
+                if response.headers.get(header):
+                    cached_response.headers[header] = response.headers.get(header)
+            cached_response.is_fresh = True
+            response = cached_response
+    # 404s are kept too, for providers that cache them
+    if (response is not None) and (response.status_code < 400 or response.status_code == 404):
+        store_page_in_cache(url, headers, allow_redirects, response, cache)
+    return response
+
 def store_page_in_cache(url, headers, allow_redirects, response, cache):
     cache_key = headers.copy()
     cache_key.update({"url":url, "allow_redirects":allow_redirects})
@@ -47,10 +105,187 @@ def store_page_in_cache(url, headers, allow_redirects, response, cache):
     cache_data = {
         'text':             response.text, 
         'status_code':      response.status_code, 
-        'url':              response.url}
+        'url':              response.url,
+        'etag':             response.headers.get("etag"),
+        'last_modified':    response.headers.get("last-modified")}
     cache.set_cache_entry(cache_key, cache_data)
 
 
+# keep-alive sessions, one per provider, shared by all its instances and threads
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+class NoCookiesPolicy(cookielib.DefaultCookiePolicy):
+    # sessions are just for reusing connections, so don't carry cookies between calls
+    def set_ok(self, cookie, request):
+        return False
+
+def get_http_session(provider_name, pool_size):
+    with _http_sessions_lock:
+        if provider_name not in _http_sessions:
+            session = requests.Session()
+            session.cookies.set_policy(NoCookiesPolicy())
+            # a pool of up to pool_size connections for each host
+            session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+            session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+            _http_sessions[provider_name] = session
+        return _http_sessions[provider_name]
+
+def get_http_session_stats(provider_name):
+    # requests and new connections by host; every request beyond the connections reused one
+    stats = {}
+    session = _http_sessions.get(provider_name)
+    if not session:
+        return stats
+    for adapter in session.adapters.values():
+        pools = adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools[pool_key]
+            host = "{scheme}://{host}:{port}".format(
+                scheme=pool.scheme, host=pool.host, port=pool.port)
+            stats[host] = {
+                "num_requests": pool.num_requests,
+                "num_connections": pool.num_connections,
+                "num_reused": max(0, pool.num_requests - pool.num_connections)
+            }
+    return stats
+
+
+# responses fetched during an item's update run, so its aliases, biblio and metrics calls,
+# and providers that call each other, fetch each url once even with the cache off.
+# Keyed by the run's update id, so a later run of the same item fetches afresh.
+_update_memo = LocalCache(default_settings.UPDATE_MEMO_MAX_ENTRIES, default_settings.UPDATE_MEMO_MAX_AGE)
+_update_scope = threading.local()
+
+@contextmanager
+def update_scope(update_id, deadline=None, get_latencies=None):
+    """ Shares http_get responses between the provider calls this thread makes for the
+        update run update_id, and stops http_get retrying past the deadline, if given.
+        Appends how long each GET took to get_latencies, if given. """
+    previous = (getattr(_update_scope, "update_id", None), getattr(_update_scope, "deadline", None), 
+        getattr(_update_scope, "get_latencies", None))
+    _update_scope.update_id = update_id
+    _update_scope.deadline = deadline
+    _update_scope.get_latencies = get_latencies
+    try:
+        yield
+    finally:
+        (_update_scope.update_id, _update_scope.deadline, _update_scope.get_latencies) = previous
+
+def _record_get_latency(latency):
+    # just the request itself, not waits for the rate limit, a host slot or a retry
+    get_latencies = getattr(_update_scope, "get_latencies", None)
+    if get_latencies is not None:
+        get_latencies.append(latency)
+
+# metrics for each relevant alias during an item's update run, from get_metrics_for_relevant_aliases,
+# so picking the alias with most metrics and its provenance url share one probe
+_alias_probes = LocalCache(default_settings.UPDATE_MEMO_MAX_ENTRIES, default_settings.UPDATE_MEMO_MAX_AGE)
+
+def _run_concurrently(calls, max_concurrent=None):
+    """ Runs each call in its own thread (a greenlet on the gevent engine), in the
+        caller's update scope, with at most max_concurrent running at once.
+        Returns their results in order, or raises the first error. """
+    if len(calls) <= 1:
+        return [call() for call in calls]
+    update_id = getattr(_update_scope, "update_id", None)
+    deadline = getattr(_update_scope, "deadline", None)
+    get_latencies = getattr(_update_scope, "get_latencies", None)
+    slots = threading.BoundedSemaphore(max_concurrent or len(calls))
+    results = [None for call in calls]
+    errors = []
+    def run(index, call):
+        try:
+            with slots:
+                if errors:
+                    return  # one has failed already, so don't start any more
+                with update_scope(update_id, deadline, get_latencies):
+                    results[index] = call()
+        except Exception:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=run, args=(index, call)) for (index, call) in enumerate(calls)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        (error_type, error, error_traceback) = errors[0]
+        raise error_type, error, error_traceback
+    return results
+
+# GETs in flight to each host, by provider, for providers with max_requests_per_host set
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+def get_host_slots(provider_name, host, size):
+    with _host_slots_lock:
+        key = (provider_name, host)
+        if key not in _host_slots:
+            _host_slots[key] = threading.BoundedSemaphore(size)
+        return _host_slots[key]
+
+def _update_memo_key(url, headers, allow_redirects):
+    update_id = getattr(_update_scope, "update_id", None)
+    if not update_id:
+        return None
+    return (update_id, url, allow_redirects, tuple(sorted(headers.items())))
+
+
+# the simulator doesn't check api keys, so let providers that need them load without them
+SIMULATED_API_KEYS = ["GITHUB_CLIENT_ID", "GITHUB_CLIENT_SECRET", "MENDELEY_KEY", "PLOS_KEY_V3",
+    "SCOPUS_INSTTOKEN", "SCOPUS_KEY", "SLIDESHARE_KEY", "SLIDESHARE_SECRET", "TOPSY_KEY", "YOUTUBE_KEY"]
+if default_settings.PROVIDER_SIMULATOR:
+    for key in SIMULATED_API_KEYS:
+        os.environ.setdefault(key, "simulated")
+
+def _simulated_url(provider_name, url):
+    """ Where to GET url from, which is the provider simulator if one is configured """
+    simulator = app.config.get("PROVIDER_SIMULATOR")
+    if not simulator:
+        return url
+    return "{simulator}/{provider_name}?url={url}".format(
+        simulator=simulator.rstrip("/"), provider_name=provider_name, url=urllib.quote(url, safe=""))
+
+
+# statuses that mean try again later, rather than a problem with the request
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def _parse_retry_after(value):
+    """ Seconds to wait from a Retry-After header, which is either seconds or an http date """
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    parsed_date = email.utils.parsedate_tz(value)
+    if not parsed_date:
+        return None
+    return max(0, email.utils.mktime_tz(parsed_date) - time.time())
+
+
+# keys allowed in a provider's config dict in default_settings.PROVIDERS,
+# and the provider attributes they set
+PROVIDER_CONFIG_ATTRIBUTES = {
+    "workers": "max_simultaneous_requests",
+    "requests_per_second": "requests_per_second",
+    "burst": "rate_limit_burst",
+    "rate_limit_key": "rate_limit_key",
+    "latency_target": "latency_target",
+    "circuit_failures": "circuit_failure_threshold",
+    "circuit_reset": "circuit_reset_timeout",
+    "batch_size": "max_batch_size",
+    "batch_window": "batch_window",
+    "pool_size": "http_pool_size",
+    "cache_404s": "cache_not_found",
+    "retries": "max_retries",
+    "retry_backoff": "retry_backoff",
+    "item_deadline": "item_deadline",
+    "concurrent_fetches": "max_concurrent_fetches",
+    "requests_per_host": "max_requests_per_host"
+}
+
 class ProviderFactory(object):
 
     @classmethod
@@ -68,6 +303,9 @@ class ProviderFactory(object):
             try:
                 prov = ProviderFactory.get_provider(provider_name)
                 prov.provider_name = provider_name
+                for (config_key, attribute_name) in PROVIDER_CONFIG_ATTRIBUTES.iteritems():
+                    if config_key in v:
+                        setattr(prov, attribute_name, v[config_key])
                 providers.append(prov)
 
                 if filter_by is not None:
@@ -133,7 +371,7 @@ class Provider(object):
 
     def __init__(self, 
             max_cache_duration=60*60,  # one hour 
-            max_retries=0, 
+            max_retries=2, 
             tool_email="mytotalimpact@gmail.com"): 
         # FIXME change email to team@impactstory.org after registering it with crossref
     
@@ -141,7 +379,22 @@ class Provider(object):
         self.max_retries = max_retries
         self.tool_email = tool_email
         self.provider_name = self.__class__.__name__.lower()
-        self.max_simultaneous_requests = 20  # max simultaneous requests, used by backend        
+        self.max_simultaneous_requests = 20  # size of the backend worker pool, override with "workers" in config
+        self.requests_per_second = None  # no rate limit unless set in config
+        self.rate_limit_burst = None  # defaults to one second's worth of requests
+        self.rate_limit_key = None  # providers sharing an API key can share a bucket; defaults to provider name
+        self.latency_target = 5.0  # seconds; slower calls make the backend cut this provider's concurrency
+        self.circuit_failure_threshold = 5  # consecutive failures before the backend stops calling this provider
+        self.circuit_reset_timeout = 60  # seconds before the backend tries this provider again
+        self.max_batch_size = 50  # most ids in one call, for providers with _extract_metrics_batch
+        self.batch_window = 1.0  # seconds the backend waits to fill a metrics batch
+        self.http_pool_size = None  # keep-alive connections per host; defaults to the worker pool size
+        self.cache_not_found = False  # reuse cached 404s instead of asking again
+        self.retry_backoff = 1.0  # seconds; http_get retries wait up to this, doubling each time
+        self.retry_max_backoff = 30  # seconds, the most one retry waits unless told by Retry-After
+        self.item_deadline = 120  # seconds an item's call to this provider may spend retrying
+        self.max_concurrent_fetches = 10  # GETs one call runs at once, for several aliases or pages
+        self.max_requests_per_host = None  # GETs in flight to one host from this process; no limit unless set
         self.logger = logging.getLogger("ti.providers." + self.provider_name)
 
     def __repr__(self):
@@ -166,7 +419,7 @@ class Provider(object):
         else:
             url = None
 
-        analytics.track("CORE", "Received error response from Provider", {
+        analytics_sink.track("CORE", "Received error response from Provider", {
             "provider": self.provider_name, 
             "url": url,
             "text": text,
@@ -177,6 +430,10 @@ class Provider(object):
             error = ProviderServerError(response)
             self.logger.info(u"%s ProviderServerError status code=%i, %s, %s" 
                 % (self.provider_name, status_code, text, str(headers)))
+        elif status_code == 429:
+            error = ProviderRateLimitError("Rate limited by provider " + self.provider_name)
+            self.logger.info(u"%s ProviderRateLimitError status code=%i, %s, %s" 
+                % (self.provider_name, status_code, text, str(headers)))
         else:
             error = ProviderClientError(response)
             self.logger.info(u"%s ProviderClientError status code=%i, %s, %s" 
@@ -231,6 +488,10 @@ class Provider(object):
     def provides_metrics(self):
          return ("_extract_metrics" in dir(self))
 
+    @property
+    def provides_metrics_batch(self):
+         return ("_extract_metrics_batch" in dir(self))
+
     @property
     def provides_static_meta(self):
          return ("static_meta_dict" in dir(self))
@@ -377,10 +638,11 @@ class Provider(object):
             #self.logger.debug(u"%s not checking aliases, no relevant alias" % (self.provider_name))
             return []
 
+        calls = [(lambda nid=nid: self._get_aliases_for_id(nid, provider_url_template, cache_enabled)) 
+            for (namespace, nid) in relevant_aliases]
         new_aliases = []
-        for alias in relevant_aliases:
-            (namespace, nid) = alias
-            new_aliases += self._get_aliases_for_id(nid, provider_url_template, cache_enabled)
+        for aliases_for_id in _run_concurrently(calls, self.max_concurrent_fetches):
+            new_aliases += aliases_for_id
         
         # get uniques for things that are unhashable
         new_aliases_unique = [k for k,v in itertools.groupby(sorted(new_aliases))]
@@ -453,6 +715,77 @@ class Provider(object):
         return metrics_and_drilldown  
 
 
+    # default method; providers can override
+    def metrics_batch(self, 
+            list_of_aliases,
+            provider_url_template=None, 
+            cache_enabled=True):
+        """ Returns a list with what metrics() would return for each list of aliases,
+            in as few calls as the provider's API allows """
+
+        if not self.provides_metrics_batch:
+            return [self.metrics(aliases, provider_url_template, cache_enabled) for aliases in list_of_aliases]
+
+        if not provider_url_template:
+            provider_url_template = self.metrics_url_template
+
+        ids = [self.get_best_id(aliases) for aliases in list_of_aliases]
+        unique_ids = []
+        for id in ids:
+            if id and (id not in unique_ids):
+                unique_ids.append(id)
+
+        metrics_by_id = {}
+        for start in range(0, len(unique_ids), self.max_batch_size):
+            batch_ids = unique_ids[start:start+self.max_batch_size]
+            metrics_by_id.update(self.get_metrics_for_ids(batch_ids, provider_url_template, cache_enabled))
+
+        metrics_and_drilldowns = []
+        for (aliases, id) in zip(list_of_aliases, ids):
+            metrics = metrics_by_id.get(id, {})
+            metrics_and_drilldown = {}
+            for metric_name in metrics:
+                drilldown_url = self.provenance_url(metric_name, aliases)
+                metrics_and_drilldown[metric_name] = (metrics[metric_name], drilldown_url)
+            metrics_and_drilldowns.append(metrics_and_drilldown)
+
+        return metrics_and_drilldowns
+
+
+    # default method; providers can override
+    def get_metrics_for_ids(self, 
+            ids, 
+            provider_url_template=None, 
+            cache_enabled=True):
+        # returns a dict of metrics dicts, keyed by id
+
+        self.logger.debug(u"%s getting metrics for %i ids in one call" % (self.provider_name, len(ids)))
+
+        if not provider_url_template:
+            provider_url_template = self.metrics_url_template
+        url = self._get_templated_batch_url(provider_url_template, ids, "metrics")
+
+        response = self.http_get(url, cache_enabled=cache_enabled, allow_redirects=True)
+
+        try:
+            metrics_by_id = self._extract_metrics_batch(response.text, response.status_code, ids=ids)
+        except socket.timeout, e:  # can apparently be thrown here
+            self.logger.info(u"%s Provider timed out *after* GET in socket" %(self.provider_name))        
+            raise ProviderTimeout("Provider timed out *after* GET in socket", e)        
+        except (AttributeError, TypeError):  # throws type error if response.text is none
+            metrics_by_id = {}
+
+        return metrics_by_id
+
+    # default method; providers can override
+    def _get_templated_batch_url(self, template, ids, method=None):
+        # each id quoted as _get_templated_url would, then comma separated
+        quoted_ids = [self._get_templated_url("%s", id, method) for id in ids]
+        if template != "%s":
+            quoted_ids = [urllib.quote(id) for id in quoted_ids]
+        url = template % ",".join(quoted_ids)
+        return(url)
+
     # default method; providers can override
     def get_metrics_for_id(self, 
             id, 
@@ -484,16 +817,39 @@ class Provider(object):
 
         return metrics_dict
 
+    def get_metrics_for_relevant_aliases(self, aliases, provider_url_template=None, cache_enabled=True):
+        """ Returns a list of (id, metrics_dict), one for each relevant alias, fetched concurrently.
+            Kept for the rest of the item update, so repeated probes of the same aliases don't refetch. """
+        ids = [nid for (namespace, nid) in self.relevant_aliases(aliases)]
+        if not ids:
+            return []
+
+        probe_key = None
+        update_id = getattr(_update_scope, "update_id", None)
+        if update_id:
+            probe_key = (update_id, self.provider_name, provider_url_template, tuple(ids))
+            metrics_for_ids = _alias_probes.get(probe_key)
+            if metrics_for_ids is not None:
+                return metrics_for_ids
+
+        calls = [(lambda id=id: self.get_metrics_for_id(id, provider_url_template, cache_enabled)) for id in ids]
+        metrics_for_ids = zip(ids, _run_concurrently(calls, self.max_concurrent_fetches))
+
+        if probe_key:
+            _alias_probes.set(probe_key, metrics_for_ids)
+        return metrics_for_ids
+
     # ideally would aggregate all tweets from all urls.  
     # the problem is this requires multiple drill-down links, which is troubling for UI at the moment
     # for now, look up all the alias urls and use metrics for url that is most tweeted
     def get_relevant_alias_with_most_metrics(self, metric_name, aliases, provider_url_template=None, cache_enabled=None):
+        metrics_for_urls = self.get_metrics_for_relevant_aliases(aliases, provider_url_template, cache_enabled)
+        return self._id_with_most_metrics(metric_name, metrics_for_urls)
+
+    def _id_with_most_metrics(self, metric_name, metrics_for_urls):
         url_with_biggest_so_far = None
         biggest_so_far = 0
-        url_aliases = self.relevant_aliases(aliases)
-        for url_alias in url_aliases:
-            (namespace, url) = url_alias
-            metrics = self.get_metrics_for_id(url, provider_url_template, cache_enabled)
+        for (url, metrics) in metrics_for_urls:
             if metric_name in metrics:
                 if (metrics[metric_name] > biggest_so_far):
                     logger.debug(u"{new_url} has higher metrics than {prev_highest}".format(
@@ -505,75 +861,159 @@ class Provider(object):
 
     # Core methods
     # These should be consistent for all providers
+
+    def http_session(self):
+        return get_http_session(self.provider_name, self.http_pool_size or self.max_simultaneous_requests)
+
+    def _wait_for_rate_limit(self, num_requests=1, max_wait=None):
+        if not self.requests_per_second:
+            return
+        bucket_name = self.rate_limit_key or self.provider_name
+        capacity = self.rate_limit_burst or max(1, self.requests_per_second)
+        rate_limiter = RateLimiter()
+        while num_requests > 0:
+            # can't take more than a full bucket at once
+            num_tokens = min(num_requests, capacity)
+            got_tokens = rate_limiter.wait_for_tokens(bucket_name, 
+                self.requests_per_second, capacity, num_tokens, max_wait)
+            if not got_tokens:
+                self.logger.info(u"%s over its rate limit, not sending GET" %(self.provider_name))
+                raise ProviderThrottledError("Over rate limit for " + bucket_name)
+            num_requests -= num_tokens
     
-    def http_get(self, url, headers={}, timeout=20, cache_enabled=True, allow_redirects=False):
-        """ Returns a requests.models.Response object or raises exception
-            on failure. Will cache requests to the same URL. """
+    def _retry_deadline(self):
+        own_deadline = time.time() + self.item_deadline
+        item_deadline = getattr(_update_scope, "deadline", None)
+        if item_deadline:
+            return min(own_deadline, item_deadline)
+        return own_deadline
+
+    def _retry_wait(self, attempt, response, error, deadline):
+        """ Seconds to wait before retrying a GET, or None to give up """
+        if attempt >= self.max_retries:
+            return None
+        if error:
+            # a timeout or no connection may well work next time, a bad url won't
+            if not (isinstance(error, ProviderTimeout) or 
+                    isinstance(error.inner, requests.exceptions.ConnectionError)):
+                return None
+        elif response.status_code not in RETRY_STATUSES:
+            return None
 
-        headers["User-Agent"] = app.config["USER_AGENT"]
+        # exponential backoff with full jitter, so retrying workers don't all come back at once
+        wait = random.uniform(0, min(self.retry_max_backoff, self.retry_backoff * (2 ** attempt)))
+        if response is not None and response.status_code in (429, 503):
+            retry_after = _parse_retry_after(response.headers.get("retry-after"))
+            if retry_after is not None:
+                wait = retry_after
 
-        # use the cache if the config parameter is set and the arg allows it
-        use_cache = app.config["CACHE_ENABLED"] and cache_enabled
-        if use_cache:
-            cache = Cache(self.max_cache_duration)
-            cached_response = get_page_from_cache(url, headers, allow_redirects, cache)
-            if cached_response:
-                return cached_response
-            
+        if time.time() + wait > deadline:
+            return None
+        return wait
+
+    @contextmanager
+    def _host_slot(self, url):
+        """ Waits until fewer than max_requests_per_host GETs to url's host are in flight """
+        if not self.max_requests_per_host:
+            yield
+            return
+        host = urlparse.urlparse(url).netloc
+        with get_host_slots(self.provider_name, host, self.max_requests_per_host):
+            yield
+
+    def _send_get(self, url, headers, timeout, allow_redirects):
         try:
-            analytics.track("CORE", "Sent GET to Provider", {"provider": self.provider_name, "url": url}, 
+            analytics_sink.track("CORE", "Sent GET to Provider", {"provider": self.provider_name, "url": url}, 
                 context={ "providers": { 'Mixpanel': False } })
-            r = requests.get(url, headers=headers, timeout=timeout, allow_redirects=allow_redirects, verify=False)
-            if r and use_cache:
-                store_page_in_cache(url, headers, allow_redirects, r, cache)
+            with self._host_slot(url):
+                start_time = time.time()
+                try:
+                    r = self.http_session().get(_simulated_url(self.provider_name, url), headers=headers, 
+                        timeout=timeout, allow_redirects=allow_redirects, verify=False)
+                finally:
+                    _record_get_latency(time.time() - start_time)
 
         except requests.exceptions.Timeout as e:
             self.logger.info(u"%s Provider timed out during GET on %s" %(self.provider_name, url))
-            analytics.track("CORE", "Received no response from Provider (timeout)", 
+            analytics_sink.track("CORE", "Received no response from Provider (timeout)", 
                 {"provider": self.provider_name, "url": url})
             raise ProviderTimeout("Provider timed out during GET on " + url, e)
 
         except requests.exceptions.RequestException as e:
             self.logger.info(u"%s RequestException during GET on %s" %(self.provider_name, url))
-            analytics.track("CORE", "Received RequestException from Provider", 
+            analytics_sink.track("CORE", "Received RequestException from Provider", 
                 {"provider": self.provider_name, "url": url})
             raise ProviderHttpError("RequestException during GET on: " + url, e)
-
-        if not r.encoding:
-            r.encoding = "utf-8"     
         return r
 
-
-    def http_get_multiple(self, urls, headers={}, timeout=20, cache_enabled=True, allow_redirects=False, num_concurrent_requests=False):
+    def http_get(self, url, headers={}, timeout=20, cache_enabled=True, allow_redirects=False):
         """ Returns a requests.models.Response object or raises exception
             on failure. Will cache requests to the same URL. """
 
         headers["User-Agent"] = app.config["USER_AGENT"]
 
+        # already fetched in this update run?
+        memo_key = _update_memo_key(url, headers, allow_redirects)
+        if memo_key:
+            memoized_response = _update_memo.get(memo_key)
+            if memoized_response is not None:
+                return memoized_response
+
         # use the cache if the config parameter is set and the arg allows it
         use_cache = app.config["CACHE_ENABLED"] and cache_enabled
+        cached_response = None
         if use_cache:
             cache = Cache(self.max_cache_duration)
+            cached_response = get_page_from_cache(url, headers, allow_redirects, cache, self.cache_not_found)
+            if cached_response and cached_response.is_fresh:
+                return cached_response
+            
+        deadline = self._retry_deadline()
+        attempt = 0
+        while True:
+            self._wait_for_rate_limit(max_wait=timeout)
+            try:
+                r = self._send_get(url, conditional_headers(headers, cached_response), timeout, allow_redirects)
+                error = None
+            except (ProviderTimeout, ProviderHttpError), e:
+                r = None
+                error = e
+            wait = self._retry_wait(attempt, r, error, deadline)
+            if wait is None:
+                break
+            self.logger.info(u"%s retrying GET on %s in %.1fs" %(self.provider_name, url, wait))
+            time.sleep(wait)
+            attempt += 1
+
+        if error:
+            raise error
+        if use_cache:
+            r = revalidated_page(url, headers, allow_redirects, r, cached_response, cache)
+
+        if not r.encoding:
+            r.encoding = "utf-8"     
+        if memo_key and (r.status_code < 400 or r.status_code == 404):
+            _update_memo.set(memo_key, MemoizedResponse(r))
+        return r
+
+
+    def http_get_multiple(self, urls, headers={}, timeout=20, cache_enabled=True, allow_redirects=False, num_concurrent_requests=None):
+        """ Returns a dict of requests.models.Response objects by url, fetched concurrently
+            with http_get, so each uses the cache, retries and rate limit, and raises 
+            the first error any of them raised.  Runs at most num_concurrent_requests 
+            at once, max_concurrent_fetches by default. """
 
-        responses = {}
+        unique_urls = []
         for url in urls:
-            responses[url] = None
-            if use_cache:
-                cached_response = get_page_from_cache(url, headers, allow_redirects, cache)
-                if cached_response:
-                    responses[url] = cached_response
-
-        uncached_urls = [url for url in responses if not responses[url]]
-        unsentrequests = (grequests.get(u, headers=headers, timeout=timeout, allow_redirects=allow_redirects) 
-                            for u in uncached_urls)
-        if unsentrequests:
-            fresh_responses = grequests.map(unsentrequests, size=num_concurrent_requests)
-            fresh_responses_dict = dict(zip(uncached_urls, fresh_responses))
-            if use_cache:
-                for url in fresh_responses_dict:
-                    store_page_in_cache(url, headers, allow_redirects, fresh_responses_dict[url], cache)
-        responses.update(fresh_responses_dict)
-        return responses
+            if url not in unique_urls:
+                unique_urls.append(url)
+
+        # http_get adds to headers, so each call gets its own
+        calls = [(lambda url=url: self.http_get(url, headers=dict(headers), timeout=timeout, 
+                cache_enabled=cache_enabled, allow_redirects=allow_redirects)) 
+            for url in unique_urls]
+        responses = _run_concurrently(calls, num_concurrent_requests or self.max_concurrent_fetches)
+        return dict(zip(unique_urls, responses))
 
 
 class ProviderError(Exception):
@@ -629,11 +1069,15 @@ class ProviderValidationFailedError(ProviderError):
 class ProviderRateLimitError(ProviderError):
     pass
 
+class ProviderThrottledError(ProviderError):
+    # our own rate limit held the call back, so the provider never saw it
+    pass
+
 def _load_json(page):
     try:
-        data = simplejson.loads(page) 
-    except simplejson.JSONDecodeError, e:
-        logger.error(u"%s json decode fail on '%s'" %("_load_json", e.msg))
+        data = _json_loads(page) 
+    except ValueError, e:  # simplejson.JSONDecodeError is one too
+        logger.error(u"%s json decode fail on '%s'" %("_load_json", e))
         raise ProviderContentMalformedError
     return(data)
 
@@ -645,24 +1089,41 @@ def _lookup_json(data, keylist):
             return None
     return(data)
 
-def _extract_from_data_dict(data, dict_of_keylists):
-    return_dict = {}
-    if dict_of_keylists:
-        for (metric, keylist) in dict_of_keylists.iteritems():
-            value = _lookup_json(data, keylist)
+class JsonExtractor(object):
+    """ A dict_of_keylists compiled once, usually as a provider class attribute,
+        rather than walked afresh for every response """
+
+    def __init__(self, dict_of_keylists):
+        self.dict_of_keylists = dict_of_keylists
+        self.plan = [(metric, tuple(keylist)) for (metric, keylist) in (dict_of_keylists or {}).iteritems()]
+
+    def extract(self, page):
+        data = _load_json(page)
+        if not data:
+            return {}
+        return self.extract_from_data(data)
+
+    def extract_from_data(self, data):
+        return_dict = {}
+        for (metric, keylist) in self.plan:
+            value = data
+            try:
+                for mykey in keylist:
+                    value = value[mykey]
+            except (KeyError, TypeError):
+                continue
 
             # only set metrics for non-zero and non-null metrics
             if value and (value != "0"):
                 return_dict[metric] = value
-    return return_dict
+        return return_dict
 
 
+def _extract_from_data_dict(data, dict_of_keylists):
+    return JsonExtractor(dict_of_keylists).extract_from_data(data)
+
 def _extract_from_json(page, dict_of_keylists):
-    data = _load_json(page)
-    if not data:
-        return {}
-    return_dict = _extract_from_data_dict(data, dict_of_keylists)
-    return return_dict
+    return JsonExtractor(dict_of_keylists).extract(page)
 
 def _get_doc_from_xml(page):
     try:
@@ -679,23 +1140,108 @@ def _get_doc_from_xml(page):
         raise ProviderContentMalformedError
     return (doc, lookup_function)
 
+# lxml parsers can't be shared between threads
+_xml_parsers = threading.local()
+
+def _get_xml_parser():
+    parser = getattr(_xml_parsers, "parser", None)
+    if parser is None:
+        parser = etree.XMLParser(resolve_entities=False, huge_tree=True)
+        _xml_parsers.parser = parser
+    return parser
+
+def _xml_bytes(page):
+    try:
+        return page.strip().encode('utf-8')
+    except UnicodeDecodeError:
+        return page.strip()
+
+def _get_tree_from_xml(page):
+    """ Parses the page once, with lxml.  Returns None if it isn't well-formed. """
+    try:
+        root = etree.fromstring(_xml_bytes(page), _get_xml_parser())
+    except (etree.XMLSyntaxError, ValueError):
+        return None
+    return root.getroottree()
+
+def _xml_name(element):
+    # the name minidom would give it: the document's prefix, not the namespace
+    local_name = element.tag.split("}")[-1]
+    if element.prefix:
+        return element.prefix + ":" + local_name
+    return local_name
+
+# compiled XPath expressions, by keylist.  lxml locks an XPath object while it
+# evaluates, so each thread compiles its own rather than waiting on the others
+_xml_paths = threading.local()
+
+def _compile_xml_path(keylist, first_only=True):
+    """ XPath that walks the keylist the way _lookup_xml_from_dom does: the first
+        element named for each key, anywhere inside the one found for the key before.
+        Unless first_only, it finds every element named for the last key. """
+    cache_key = (tuple(keylist), first_only)
+    xml_paths = getattr(_xml_paths, "compiled", None)
+    if xml_paths is None:
+        xml_paths = {}
+        _xml_paths.compiled = xml_paths
+    try:
+        return xml_paths[cache_key]
+    except KeyError:
+        pass
+    path = ""
+    for (index, mykey) in enumerate(keylist):
+        path = "{path}//*[name()='{mykey}']".format(path=path, mykey=mykey)
+        if first_only or index < len(keylist) - 1:
+            path = "({path})[1]".format(path=path)
+    compiled = etree.XPath(path)
+    xml_paths[cache_key] = compiled
+    return compiled
+
+def _lookup_xml_from_tree(tree, keylist):
+    elements = _compile_xml_path(keylist)(tree)
+    if not elements:
+        return None
+    # the first text node, like minidom's firstChild.data
+    response = elements[0].text
+    if response is None:
+        return None
+    response = unicode(response)
+    try:
+        response = int(response)
+    except ValueError:
+        pass
+    return(response)
+
+def _find_all_in_xml_tree(tree, mykey, within=[]):
+    """ Every element named mykey, or only those inside the one element
+        _lookup_xml_from_tree would find for the keylist within """
+    return _compile_xml_path(within + [mykey], first_only=False)(tree)
+
+def _iterparse_xml(page, mykey):
+    """ Yields each element named mykey as the parser streams through the page,
+        then clears it, so a big page is never held as a whole tree """
+    try:
+        for (event, element) in etree.iterparse(BytesIO(_xml_bytes(page)), events=("end",),
+                resolve_entities=False, huge_tree=True):
+            if _xml_name(element) == mykey:
+                yield element
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+    except etree.XMLSyntaxError, e:
+        logger.debug(u"%s xml parse fail, stopping early: %s" %("_iterparse_xml", e))
+
 def _count_in_xml(page, mykey): 
-    doc_list = _find_all_in_xml(page, mykey)
-    if not doc_list:
-        return 0
-    count = len(doc_list)
+    count = 0
+    for element in _iterparse_xml(page, mykey):
+        count += 1
     return(count)
 
 def _find_all_in_xml(page, mykey):  
-    (doc, lookup_function) = _get_doc_from_xml(page)  
-    if not doc:
-        return None
-    try:
-        doc_list = doc.getElementsByTagName(mykey)
-    except (KeyError, IndexError, TypeError):
+    tree = _get_tree_from_xml(page)  
+    if tree is None:
         return None
-            
-    return(doc_list)
+    return _find_all_in_xml_tree(tree, mykey)
 
 
 def _lookup_xml_from_dom(doc, keylist): 
@@ -750,7 +1296,17 @@ def _metrics_dict_as_ints(metrics_dict):
     return metrics_dict_ints
 
 def _extract_from_xml(page, dict_of_keylists):
+    tree = _get_tree_from_xml(page)
+    if tree is not None:
+        return _extract_from_xml_tree(tree, dict_of_keylists)
+    # not well-formed, so fall back to a more forgiving parser
     (doc, lookup_function) = _get_doc_from_xml(page)
+    return _extract_with_lookup(doc, lookup_function, dict_of_keylists)
+
+def _extract_from_xml_tree(tree, dict_of_keylists):
+    return _extract_with_lookup(tree, _lookup_xml_from_tree, dict_of_keylists)
+
+def _extract_with_lookup(doc, lookup_function, dict_of_keylists):
     return_dict = {}
     if dict_of_keylists:
         for (metric, keylist) in dict_of_keylists.iteritems():
@@ -98,10 +98,16 @@ class Pubmed(Provider):
                                 "title": ["PubmedArticleSet", "MedlineCitation", "Article", "ArticleTitle"],
                                 "journal": ["PubmedArticleSet", "MedlineCitation", "Article", "Journal", "Title"],
                                 }            
-        biblio_dict = provider._extract_from_xml(page, dict_of_keylists)
-        dom_authors = provider._find_all_in_xml(page, "LastName")
+        # parse once for both the biblio and the authors
+        tree = provider._get_tree_from_xml(page)
+        if tree is not None:
+            biblio_dict = provider._extract_from_xml_tree(tree, dict_of_keylists)
+            author_elements = provider._find_all_in_xml_tree(tree, "LastName")
+        else:
+            biblio_dict = provider._extract_from_xml(page, dict_of_keylists)
+            author_elements = None
         try:
-            biblio_dict["authors"] = ", ".join([author.firstChild.data for author in dom_authors])
+            biblio_dict["authors"] = ", ".join([author.text for author in author_elements])
         except (AttributeError, TypeError):
             pass
 
@@ -137,25 +143,21 @@ class Pubmed(Provider):
 
 
     def _extract_aliases_from_pmid(self, page, pmid):
-        (doc, lookup_function) = provider._get_doc_from_xml(page)
+        tree = provider._get_tree_from_xml(page)
         doi = None
-        try:
-            articleidlist = doc.getElementsByTagName("ArticleIdList")[0]
-            for articleid in articleidlist.getElementsByTagName("ArticleId"):
-                if (articleid.getAttribute("IdType") == u"doi"):
-                    doi = articleid.firstChild.data
+        if tree is not None:
+            # only the first ArticleIdList: the later ones are the references'
+            for articleid in provider._find_all_in_xml_tree(tree, "ArticleId", within=["ArticleIdList"]):
+                if (articleid.get("IdType") == u"doi"):
+                    doi = articleid.text
 
             if not doi:
                 #give it another try, in another part of the xml 
                 # see http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id=23682040&retmode=xml&email=team@total-impact.org&tool=total-impact
-                article = doc.getElementsByTagName("Article")[0]
-                for elocationid in article.getElementsByTagName("ELocationID"):
-                    if (elocationid.getAttribute("EIdType") == u"doi"):
-                        if (elocationid.getAttribute("ValidYN") == u"Y"):
-                            doi = elocationid.firstChild.data
-
-        except (IndexError, TypeError):
-            pass
+                for elocationid in provider._find_all_in_xml_tree(tree, "ELocationID", within=["Article"]):
+                    if (elocationid.get("EIdType") == u"doi"):
+                        if (elocationid.get("ValidYN") == u"Y"):
+                            doi = elocationid.text
 
         #sometimes no doi, or PMID has a doi-fragment in the doi field:
         aliases_list = []
@@ -216,13 +218,9 @@ class Pubmed(Provider):
         query_string = filter_ptype + "[ptyp] AND (" + pmcids_string + ")"
         pmcid_filter_url = self.metrics_pmc_filter_url_template %query_string
         page = self._get_eutils_page(id, pmcid_filter_url)
-        (doc, lookup_function) = provider._get_doc_from_xml(page)  
-        try:    
-            id_docs = doc.getElementsByTagName("Id")
-            pmids = [id_doc.firstChild.data for id_doc in id_docs]
-        except TypeError:
-            logger.warning(u"%20s no Id xml tags for %s" % (self.provider_name, id))
-            pmids = []
+        pmids = [id_element.text for id_element in provider._iterparse_xml(page, "Id")]
+        if not pmids:
+            logger.debug(u"%20s no Id xml tags for %s" % (self.provider_name, id))
         return pmids
 
     def _check_reviewed_by_f1000(self, id, cache_enabled):
@@ -267,13 +265,7 @@ class Pubmed(Provider):
         if (not "PubMedToPMCcitingformSET" in page):
             raise ProviderContentMalformedError()
         dict_of_keylists = {"pubmed:pmc_citations": ["PubMedToPMCcitingformSET", "REFORM"]}
-        (doc, lookup_function) = provider._get_doc_from_xml(page)
-        try:
-            pmcid_doms = doc.getElementsByTagName("PMCID")
-            pmcids = [pmcid_dom.firstChild.data for pmcid_dom in pmcid_doms]
-        except TypeError:
-            logger.warning(u"%20s no PMCID xml tags for %s" % (self.provider_name, id))            
-            pmcids = []
+        pmcids = [pmcid_element.text for pmcid_element in provider._iterparse_xml(page, "PMCID")]
         return pmcids
 
     # documentation for pubmedtopmcciting: http://www.pubmedcentral.nih.gov/utils/entrez2pmcciting.cgi
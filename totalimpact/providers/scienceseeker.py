@@ -40,15 +40,10 @@ class Scienceseeker(Provider):
         if ("subjectseeker" not in page) and ("Recent Posts" not in page):
             raise ProviderContentMalformedError
 
-        (doc, lookup_function) = provider._get_doc_from_xml(page)  
-        if not doc:
-            return {}
-        try:
-            feed_doc = doc.getElementsByTagName("feed")
-            entry_docs = feed_doc[0].getElementsByTagName("entry")
-            number_blog_posts = len(entry_docs)
-        except (KeyError, IndexError, TypeError):
+        tree = provider._get_tree_from_xml(page)
+        if tree is None:
             return {}
+        number_blog_posts = len(provider._find_all_in_xml_tree(tree, "entry", within=["feed"]))
 
         if number_blog_posts:
             metrics_dict = {'scienceseeker:blog_posts': number_blog_posts}
@@ -94,14 +94,19 @@ class Topsy(Provider):
         nid = self.get_site_id(aliases)
         if nid:
             metrics_url_template = self.metrics_url_template_site
+            metrics = self.get_metrics_for_id(nid, metrics_url_template, cache_enabled)
         else:
             metrics_url_template = self.metrics_url_template_general
-            nid = self.get_relevant_alias_with_most_metrics("topsy:tweets", aliases, metrics_url_template, cache_enabled)
+            # the probe already has the winner's metrics, and provenance_url reuses it too
+            metrics_for_urls = self.get_metrics_for_relevant_aliases(aliases, metrics_url_template, cache_enabled)
+            nid = self._id_with_most_metrics("topsy:tweets", metrics_for_urls)
+            if not nid:
+                return {}
+            metrics = dict(metrics_for_urls)[nid]
 
         if not nid:
             return {}
             
-        metrics = self.get_metrics_for_id(nid, metrics_url_template, cache_enabled)
         metrics_and_drilldown = {}
         for metric_name in metrics:
             drilldown_url = self.provenance_url(metric_name, aliases)
@@ -166,8 +171,11 @@ class Topsy(Provider):
         print urls
         responses = self.http_get_multiple(urls)
         tweeted_entries = [] 
-        for url in responses:
-            tweeted_entries += provider._load_json(responses[url].text)["response"]["list"]
+        for url in urls:
+            response = responses[url]
+            if response.status_code != 200:
+                self._get_error(response.status_code, response)
+            tweeted_entries += provider._load_json(response.text)["response"]["list"]
         sorted_list = sorted(tweeted_entries, key=itemgetter('hits'), reverse=True) 
 
         top_tweeted_urls = [] #needs to be ordered
@@ -1,7 +1,5 @@
 from totalimpact.providers import provider
 from totalimpact.providers.provider import Provider, ProviderContentMalformedError
-from xml.dom import minidom
-from xml.parsers.expat import ExpatError
 
 import logging
 logger = logging.getLogger('ti.providers.wikipedia')
@@ -48,12 +46,10 @@ class Wikipedia(Provider):
             else:
                 raise(self._get_error(status_code))
 
-        (doc, lookup_function) = provider._get_doc_from_xml(page)
-
         try:
-            searchinfo = doc.getElementsByTagName('searchinfo')
-            totalhits = int(searchinfo[0].attributes['totalhits'].value)
-        except (TypeError, IndexError):
+            searchinfo = next(provider._iterparse_xml(page, 'searchinfo'))
+            totalhits = int(searchinfo.get('totalhits'))
+        except (StopIteration, TypeError, ValueError):
             raise ProviderContentMalformedError("No searchinfo in response document")
 
         if totalhits:
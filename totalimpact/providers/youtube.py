@@ -84,6 +84,20 @@ class Youtube(Provider):
         url = template % (nid_as_video_id)
         return(url)
 
+    biblio_extractor = provider.JsonExtractor({
+        'title': ['snippet', 'title'],
+        'channel_title': ['snippet', 'channelTitle'],
+        'published_date': ['snippet', 'publishedAt']
+    })
+
+    metrics_extractor = provider.JsonExtractor({
+        'youtube:views' : ['statistics', 'viewCount'],
+        'youtube:likes' : ['statistics', 'likeCount'],
+        'youtube:dislikes' : ['statistics', 'dislikeCount'],
+        'youtube:favorites' : ['statistics', 'favoriteCount'],
+        'youtube:comments' : ['statistics', 'commentCount'],
+    })
+
     def _extract_biblio(self, page, id=None):
 
         if not "snippet" in page:
@@ -92,13 +106,7 @@ class Youtube(Provider):
         json_response = provider._load_json(page)
         this_video_json = json_response["items"][0]
 
-        dict_of_keylists = {
-            'title': ['snippet', 'title'],
-            'channel_title': ['snippet', 'channelTitle'],
-            'published_date': ['snippet', 'publishedAt']
-        }
-
-        biblio_dict = provider._extract_from_data_dict(this_video_json, dict_of_keylists)
+        biblio_dict = self.biblio_extractor.extract_from_data(this_video_json)
 
         try:
             biblio_dict["year"] = biblio_dict["published_date"][0:4]
@@ -122,18 +130,36 @@ class Youtube(Provider):
             raise ProviderContentMalformedError
 
         json_response = provider._load_json(page)
-        this_video_json = json_response["items"][0]
+        metrics_dict = self._metrics_from_video(json_response["items"][0])
 
-        dict_of_keylists = {
-            'youtube:views' : ['statistics', 'viewCount'],
-            'youtube:likes' : ['statistics', 'likeCount'],
-            'youtube:dislikes' : ['statistics', 'dislikeCount'],
-            'youtube:favorites' : ['statistics', 'favoriteCount'],
-            'youtube:comments' : ['statistics', 'commentCount'],
-        }
+        return metrics_dict
 
-        metrics_dict = provider._extract_from_data_dict(this_video_json, dict_of_keylists)
+    def _metrics_from_video(self, this_video_json):
+        metrics_dict = self.metrics_extractor.extract_from_data(this_video_json)
 
         metrics_dict = provider._metrics_dict_as_ints(metrics_dict)
 
         return metrics_dict
+
+    # the videos api takes a comma-separated list of video ids
+    def _extract_metrics_batch(self, page, status_code=200, ids=[]):
+        if status_code != 200:
+            if status_code == 404:
+                return {}
+            else:
+                raise(self._get_error(status_code))
+
+        if not "items" in page:
+            raise ProviderContentMalformedError
+
+        json_response = provider._load_json(page)
+
+        # ids are video urls, the response has video ids
+        ids_by_video_id = dict([(self._get_video_id(id), id) for id in ids])
+        metrics_by_id = {}
+        for this_video_json in json_response["items"]:
+            id = ids_by_video_id.get(this_video_json.get("id"))
+            if id:
+                metrics_by_id[id] = self._metrics_from_video(this_video_json)
+
+        return metrics_by_id
@@ -0,0 +1,91 @@
+import os
+import time
+import logging
+import redis
+
+# set up logging
+logger = logging.getLogger("ti.ratelimit")
+
+# Refills the bucket for the time since it was last touched, then takes
+# the requested tokens if they are there.  Runs atomically in redis, so the
+# bucket is shared by every backend process.
+# Returns {1 if allowed else 0, seconds to wait before enough tokens are there}
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "timestamp")
+local tokens = tonumber(bucket[1]) or capacity
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+
+local allowed = 0
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+    allowed = 1
+else
+    wait = (requested - tokens) / rate
+end
+
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "timestamp", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+_redis_client = None
+
+def _get_redis_client():
+    # one client per process; it has its own thread-safe connection pool
+    global _redis_client
+    if _redis_client is None:
+        url = os.getenv("REDISTOGO_URL")
+        if not url:
+            # a RedisError, so callers fail open as they do when redis is down
+            raise redis.ConnectionError("REDISTOGO_URL isn't set")
+        _redis_client = redis.from_url(url)
+    return _redis_client
+
+
+class RateLimiter(object):
+    """ Token buckets in redis, one per provider or per provider API key """
+
+    def __init__(self, myredis=None):
+        self.myredis = myredis
+
+    def _get_redis(self):
+        if self.myredis is None:
+            self.myredis = _get_redis_client()
+        return self.myredis
+
+    def take_tokens(self, bucket_name, rate, capacity, num_tokens=1):
+        """ Returns (True, 0) if the tokens were taken, else (False, seconds_to_wait) """
+        key = "rate_limit:" + bucket_name
+        try:
+            (allowed, wait) = self._get_redis().execute_command("EVAL", TOKEN_BUCKET_SCRIPT, 1, key,
+                rate, capacity, repr(time.time()), num_tokens)
+        except redis.RedisError, e:
+            # fail open: better to risk the quota than stop all provider calls
+            logger.warning(u"Couldn't reach redis for rate limit {bucket_name}, allowing: {e}".format(
+                bucket_name=bucket_name, e=e.__repr__()))
+            return (True, 0)
+        return (bool(allowed), float(wait))
+
+    def wait_for_tokens(self, bucket_name, rate, capacity, num_tokens=1, max_wait=None):
+        """ Blocks until the tokens are taken.  Returns False if that would take longer than max_wait """
+        # can never take more than the bucket holds
+        num_tokens = min(num_tokens, capacity)
+        deadline = None
+        if max_wait is not None:
+            deadline = time.time() + max_wait
+        while True:
+            (allowed, wait) = self.take_tokens(bucket_name, rate, capacity, num_tokens)
+            if allowed:
+                return True
+            if deadline and (time.time() + wait > deadline):
+                logger.info(u"Rate limit {bucket_name} would need {wait}s, more than allowed".format(
+                    bucket_name=bucket_name, wait=wait))
+                return False
+            time.sleep(wait)
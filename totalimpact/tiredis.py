@@ -1,4 +1,4 @@
-import redis, logging, json, datetime, os, iso8601
+import redis, logging, json, datetime, os, iso8601, time, uuid
 from collections import defaultdict
 
 from totalimpact.providers.provider import ProviderFactory
@@ -6,6 +6,17 @@ from totalimpact.providers.provider import ProviderFactory
 
 logger = logging.getLogger("ti.tiredis")
 
+# backend queues have a lane per priority class; interactive work is served ahead of bulk refreshes
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITY_LANES = [INTERACTIVE, BULK]
+
+def lane_queue_name(queue_name, lane):
+    # interactive keeps the plain name, so messages queued before there were lanes still get served
+    if lane == INTERACTIVE:
+        return queue_name
+    return queue_name + ":" + lane
+
 def from_url(url, db=0):
     r = redis.from_url(url, db)
     return r
@@ -109,11 +120,101 @@ def get_num_providers_currently_updating(self, item_id):
     return num_currently_updating
 
 
-def add_to_alias_queue(self, tiid, aliases_dict, aliases_already_run=[]):
-    queue_string = json.dumps([tiid, aliases_dict, aliases_already_run])
-    logger.debug(u"Adding to alias_queue: {tiid} /biblio_print {aliases_dict} {aliases_already_run}".format(
-        tiid=tiid, aliases_dict=aliases_dict, aliases_already_run=aliases_already_run))
-    self.lpush("aliasqueue", queue_string)
+def add_to_alias_queue(self, tiid, aliases_dict, aliases_already_run=[], lane=INTERACTIVE):
+    # every message of this update run carries its id, so the providers can share what they fetch
+    update_id = uuid.uuid4().hex
+    queue_string = json.dumps([tiid, aliases_dict, aliases_already_run, update_id])
+    logger.debug(u"Adding to alias_queue: {tiid} /biblio_print {aliases_dict} {aliases_already_run} in {lane} lane".format(
+        tiid=tiid, aliases_dict=aliases_dict, aliases_already_run=aliases_already_run, lane=lane))
+    self.lpush(lane_queue_name("aliasqueue", lane), queue_string)
+
+# a counting semaphore shared by every backend process, so provider limits hold globally
+def acquire_provider_slot(self, provider_name, limit, time_to_expire=60*5):
+    key = "provider_slots:{provider_name}".format(
+        provider_name=provider_name)
+    token = uuid.uuid4().hex
+    now = time.time()
+    pipe = self.pipeline()
+    # slots held by processes that died are freed after time_to_expire
+    pipe.zremrangebyscore(key, "-inf", now - time_to_expire)
+    pipe.zadd(key, token, now)
+    pipe.zcard(key)
+    pipe.expire(key, time_to_expire)
+    (removed, added, num_in_use, expired) = pipe.execute()
+    # counting after adding means racing callers can both back off, but never both get in
+    if num_in_use <= limit:
+        return token
+    self.zrem(key, token)
+    return None
+
+def release_provider_slot(self, provider_name, token):
+    key = "provider_slots:{provider_name}".format(
+        provider_name=provider_name)
+    released_key = "provider_slot_released:{provider_name}".format(
+        provider_name=provider_name)
+    pipe = self.pipeline()
+    pipe.zrem(key, token)
+    # wakes a thread blocked in wait_for_provider_slot_release, in any process
+    pipe.lpush(released_key, 1)
+    # often nobody is waiting, so only keep a few wakeups around
+    pipe.ltrim(released_key, 0, 9)
+    pipe.expire(released_key, 60)
+    (removed, pushed, trimmed, expired) = pipe.execute()
+    return removed
+
+def wait_for_provider_slot_release(self, provider_name, timeout=5):
+    # blocks until a slot of this provider is released or timeout seconds pass
+    released_key = "provider_slot_released:{provider_name}".format(
+        provider_name=provider_name)
+    return bool(self.blpop(released_key, timeout))
+
+def get_num_provider_slots_in_use(self, provider_name):
+    key = "provider_slots:{provider_name}".format(
+        provider_name=provider_name)
+    return self.zcard(key)
+
+# at most one run of a provider method for an item queued or running at a time,
+# so repeated refreshes attach to the run already under way
+def claim_provider_run(self, tiid, method_name, provider_name, lane=INTERACTIVE, time_to_expire=60*10):
+    key = "provider_run:{tiid}:{method_name}:{provider_name}".format(
+        tiid=tiid, method_name=method_name, provider_name=provider_name)
+    # claims by processes that died are freed after time_to_expire
+    if self.execute_command("SET", key, lane, "NX", "EX", time_to_expire):
+        return True
+    if lane != INTERACTIVE:
+        return False
+    # an interactive request doesn't wait behind a bulk run: it promotes the
+    # claim to interactive and goes through, and later ones attach to it
+    pipe = self.pipeline()
+    pipe.getset(key, lane)
+    pipe.expire(key, time_to_expire)
+    (claimed_lane, expire_set) = pipe.execute()
+    return claimed_lane in (None, BULK)
+
+def release_provider_run(self, tiid, method_name, provider_name):
+    key = "provider_run:{tiid}:{method_name}:{provider_name}".format(
+        tiid=tiid, method_name=method_name, provider_name=provider_name)
+    return self.delete(key)
+
+def set_provider_concurrency_stats(self, provider_name, stats):
+    expire = 60*60  # for an hour, so stopped providers drop out
+    self.set_hash_value("provider_concurrency", provider_name, stats, expire)
+
+def get_provider_concurrency_stats(self):
+    stats = {}
+    for (provider_name, json_value) in self.get_all_hash_values("provider_concurrency").iteritems():
+        stats[provider_name] = json.loads(json_value)
+    return stats
+
+def set_cache_stats(self, process_name, stats):
+    expire = 60*60  # for an hour, so stopped processes drop out
+    self.set_hash_value("cache_stats", process_name, stats, expire)
+
+def get_cache_stats(self):
+    stats = {}
+    for (process_name, json_value) in self.get_all_hash_values("cache_stats").iteritems():
+        stats[process_name] = json.loads(json_value)
+    return stats
 
 def set_value(self, key, value, time_to_expire):
     json_value = json.dumps(value)
@@ -195,6 +296,16 @@ redis.Redis.set_provider_finished = set_provider_finished
 redis.Redis.get_providers_currently_updating = get_providers_currently_updating
 redis.Redis.get_num_providers_currently_updating = get_num_providers_currently_updating
 redis.Redis.add_to_alias_queue = add_to_alias_queue
+redis.Redis.acquire_provider_slot = acquire_provider_slot
+redis.Redis.release_provider_slot = release_provider_slot
+redis.Redis.wait_for_provider_slot_release = wait_for_provider_slot_release
+redis.Redis.get_num_provider_slots_in_use = get_num_provider_slots_in_use
+redis.Redis.claim_provider_run = claim_provider_run
+redis.Redis.release_provider_run = release_provider_run
+redis.Redis.set_provider_concurrency_stats = set_provider_concurrency_stats
+redis.Redis.get_provider_concurrency_stats = get_provider_concurrency_stats
+redis.Redis.set_cache_stats = set_cache_stats
+redis.Redis.get_cache_stats = get_cache_stats
 redis.Redis.set_memberitems_status = set_memberitems_status
 redis.Redis.get_memberitems_status = get_memberitems_status
 redis.Redis.set_confidence_interval_table = set_confidence_interval_table
@@ -23,7 +23,8 @@ def update_by_tiids(all_tiids, number_to_update, myredis):
     for tiid in tiids_to_update:
         item_obj = item_module.Item.query.get(tiid)  # can use this method because don't need metrics
         item_doc = item_obj.as_old_doc()
-        item_module.start_item_update(tiid, item_doc["aliases"], myredis)
+        # scheduled refreshes go in the bulk lane so they don't slow down interactive requests
+        item_module.start_item_update(tiid, item_doc["aliases"], myredis, lane=tiredis.BULK)
         item_obj.last_update_run = now
         db.session.add(item_obj)
         time.sleep(QUEUE_DELAY_IN_SECONDS)
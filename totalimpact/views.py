@@ -6,7 +6,6 @@ from werkzeug.security import check_password_hash
 from collections import defaultdict
 import redis
 import shortuuid
-import analytics
 import requests
 
 from totalimpact import app, tiredis, collection, api_user, incoming_email
@@ -15,6 +14,7 @@ from totalimpact.models import MemberItems, NotAuthenticatedError
 from totalimpact.providers.provider import ProviderFactory, ProviderItemNotFoundError, ProviderError, ProviderServerError, ProviderTimeout
 from totalimpact import unicode_helpers
 from totalimpact import default_settings
+from totalimpact import analytics_sink
 import logging
 
 
@@ -161,7 +161,7 @@ def track_api_event():
                     if (request.args.get("register", 0) in ["1", "true", "True"]):
                         requested_to_create_item = True
 
-            analytics.track("CORE", "Received API request from external", {
+            analytics_sink.track("CORE", "Received API request from external", {
                 "path": request.path, 
                 "url": request.url, 
                 "method": request.method, 
@@ -282,6 +282,20 @@ def provider():
 
     return resp
 
+@app.route('/v1/provider/concurrency', methods=['GET'])
+def provider_concurrency():
+    ret = myredis.get_provider_concurrency_stats()
+    resp = make_response(json.dumps(ret, sort_keys=True, indent=4), 200)
+
+    return resp
+
+@app.route('/v1/cache/stats', methods=['GET'])
+def cache_stats():
+    ret = myredis.get_cache_stats()
+    resp = make_response(json.dumps(ret, sort_keys=True, indent=4), 200)
+
+    return resp
+
 @app.route('/v1/provider/<provider_name>/memberitems', methods=['POST'])
 def provider_memberitems(provider_name):
     """
@@ -540,12 +554,12 @@ def add_items_to_collection(cid=""):
 
 
 
-def refresh_from_tiids(tiids, myredis):
+def refresh_from_tiids(tiids, myredis, lane=tiredis.INTERACTIVE):
     for tiid in tiids:
         try:
             item_obj = item_module.Item.from_tiid(tiid)
             item = item_obj.as_old_doc()        
-            item_module.start_item_update(tiid, item["aliases"], myredis)
+            item_module.start_item_update(tiid, item["aliases"], myredis, lane)
         except AttributeError:
             logger.debug(u"couldn't find tiid {tiid} so not refreshing its metrics".format(
                 tiid=tiid))
@@ -588,7 +602,8 @@ def collection_metrics_refresh(cid=""):
         ))
         abort_custom(500, "Error doing collection_update")
 
-    refresh_from_tiids(tiids, myredis)
+    # whole collections can be thousands of items, so don't let them hold up interactive requests
+    refresh_from_tiids(tiids, myredis, tiredis.BULK)
 
     resp = make_response("true", 200)
     return resp